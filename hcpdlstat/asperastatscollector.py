@@ -1,10 +1,10 @@
 # Copyright (c) 2013 Washington University School of Medicine
 # Author: Kevin A. Archie <karchie@wustl.edu>
 
-import argparse, os
+import argparse, datetime, os
 import ConfigParser
 from collections import Counter
-import pymysql
+import database, metrics, report, sketches
 
 _status_types = ['completed', 'cancelled', 'error']
 
@@ -13,76 +13,324 @@ _counted_status_file_types = [
     ('unproc_completed', 'completed', '%_unproc.zip'),
     ('preproc_completed', 'completed', '%_preproc.zip')]
 
-def get_stats_status(db, stats, date, status):
+_sessions_query = """select date(created_at), status, count(session_id), count(distinct(cookie))
+from aspera_stats_collector.fasp_sessions
+where created_at >= %s and created_at < %s and status in ({})
+group by date(created_at), status"""
+
+_files_query = """select date(created_at), status, sum(bytes_written){}
+from aspera_stats_collector.fasp_files
+where created_at >= %s and created_at < %s and status in ({})
+group by date(created_at), status"""
+
+def as_date(d):
+    """Returns d (a datetime.date or datetime, or a string starting
+    with yyyy-mm-dd) as a datetime.date."""
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    elif isinstance(d, datetime.date):
+        return d
+    else:
+        return datetime.datetime.strptime(str(d)[:10], '%Y-%m-%d').date()
+
+def init_stats(date):
+    s = {'date':date}
+    for status in _status_types:
+        for k in ['sessions', 'users', 'bytes']:
+            s[status+'_'+k] = 0
+    for (k,status,pattern) in _counted_status_file_types:
+        s[k] = 0
+    return s
+
+def get_range_stats(db, start, end):
+    """Returns a dict mapping each date in the half-open range [start,
+    end) to its stats dict, using one grouped query on each of the
+    sessions and files tables."""
+    start, end = as_date(start), as_date(end)
+    stats = {}
+    date = start
+    while date < end:
+        stats[date] = init_stats(date)
+        date += datetime.timedelta(days=1)
+    statuses = ','.join(['%s'] * len(_status_types))
     cur = db.cursor()
     try:
-        cur.execute("select count(session_id) from aspera_stats_collector.fasp_sessions where date(created_at)='{}' and status='{}'".format(date, status))
-        stats[status+'_sessions']=int(cur.fetchall()[0][0])
-
-        cur.execute("select count(distinct(cookie)) from aspera_stats_collector.fasp_sessions where date(created_at)='{}' and status='{}'".format(date, status))
-        stats[status+'_users']=int(cur.fetchall()[0][0])
+        cur.execute(_sessions_query.format(statuses),
+                    [start, end] + _status_types)
+        for (d, status, sessions, users) in cur.fetchall():
+            s = stats[as_date(d)]
+            s[status+'_sessions'] = int(sessions)
+            s[status+'_users'] = int(users)
 
-        cur.execute("select sum(bytes_written) from aspera_stats_collector.fasp_files where date(created_at)='{}' and status='{}'".format(date, status))
-        r = cur.fetchall()[0][0]
-        stats[status+'_bytes']=int(r) if r else 0
+        counted = ''.join(', sum(case when file_fullpath like %s then 1 else 0 end)'
+                          for _ in _counted_status_file_types)
+        cur.execute(_files_query.format(counted, statuses),
+                    [pattern for (k,status,pattern) in _counted_status_file_types]
+                    + [start, end] + _status_types)
+        for row in cur.fetchall():
+            s = stats[as_date(row[0])]
+            status = row[1]
+            s[status+'_bytes'] = int(row[2]) if row[2] else 0
+            for (k,kstatus,pattern),n in zip(_counted_status_file_types, row[3:]):
+                if kstatus == status:
+                    s[k] = int(n) if n else 0
         return stats
     finally:
         cur.close()
 
-def get_counted_file_stats(db, stats, date):
+# The daily rollup table holds one row per date, with a column for
+# each stats key; the state table holds the high-water marks of the
+# source rows already rolled up. Sessions have no increasing id to
+# mark, so the sessions state table holds the number of sessions
+# created before the high-water mark instead; a change in that number
+# means rows arrived (or went) late.
+_rollup_schema = 'hcpdlstat'
+_rollup_table = _rollup_schema + '.aspera_daily'
+_rollup_state_table = _rollup_schema + '.aspera_rollup_state'
+_rollup_sessions_state_table = _rollup_schema + '.aspera_rollup_sessions'
+# HyperLogLog sketches of the distinct cookies for each date and status
+_rollup_users_table = _rollup_schema + '.aspera_daily_users'
+
+def rollup_columns():
+    return sorted(k for k in init_stats(None) if 'date' != k)
+
+def create_source_tables(db):
+    """Creates the Aspera stats collector tables (the columns used here),
+    for a scratch server."""
     cur = db.cursor()
     try:
-        for (k,status,pattern) in _counted_status_file_types:
-            cur.execute("select count(id) from aspera_stats_collector.fasp_files where date(created_at)='{}' and status='{}' and file_fullpath like '{}'".format(date, status, pattern))
-            stats[k]=int(cur.fetchall()[0][0])
+        cur.execute('create database if not exists aspera_stats_collector')
+        cur.execute('create table if not exists aspera_stats_collector.fasp_sessions ('
+                    'session_id varchar(64) not null, cookie varchar(256), status varchar(16),'
+                    ' created_at datetime, client_addr varchar(16), primary key (`session_id`) )')
+        cur.execute('create table if not exists aspera_stats_collector.fasp_files ('
+                    'id bigint not null, session_id varchar(64), file_fullpath varchar(1024),'
+                    ' bytes_written bigint, status varchar(16), created_at datetime,'
+                    ' primary key (`id`) )')
+    finally:
+        cur.close()
+
+def create_rollup_tables(db):
+    cur = db.cursor()
+    try:
+        cur.execute('create database if not exists {}'.format(_rollup_schema))
+        cur.execute('create table if not exists {} (date date not null, '.format(_rollup_table)
+                    + ','.join('{} bigint not null'.format(c) for c in rollup_columns())
+                    + ', primary key (`date`) )')
+        cur.execute('create table if not exists {} ('.format(_rollup_state_table)
+                    + 'id int not null, created_at datetime, file_id bigint,'
+                    + ' primary key (`id`) )')
+        cur.execute('create table if not exists {} ('.format(_rollup_sessions_state_table)
+                    + 'id int not null, created_at datetime, sessions bigint,'
+                    + ' primary key (`id`) )')
+        cur.execute('create table if not exists {} ('.format(_rollup_users_table)
+                    + 'date date not null, status varchar(16) not null, hll text not null,'
+                    + ' primary key (`date`, `status`) )')
+    finally:
+        cur.close()
+
+def get_range_user_sketches(db, start, end, precision=sketches.default_precision):
+    """Returns a dict mapping (date, status) to a HyperLogLog sketch of
+    the distinct cookies, for each date in [start, end) with sessions."""
+    user_sketches = {}
+    cur = db.cursor()
+    try:
+        cur.execute("""select date(created_at), status, cookie
+from aspera_stats_collector.fasp_sessions
+where created_at >= %s and created_at < %s
+group by date(created_at), status, cookie""", [start, end])
+        for (d, status, cookie) in cur:
+            key = (as_date(d), status)
+            if key not in user_sketches:
+                user_sketches[key] = sketches.init_hll(precision)
+            sketches.hll_add(user_sketches[key], cookie)
+        return user_sketches
+    finally:
+        cur.close()
+
+def _first_late_session_date(cur, before):
+    """Returns the first date before the given time whose rolled up
+    session counts differ from the sessions table, or None."""
+    statuses = ','.join(['%s'] * len(_status_types))
+    cur.execute("""select date(created_at), count(session_id)
+from aspera_stats_collector.fasp_sessions
+where created_at < %s and status in ({})
+group by date(created_at)""".format(statuses), [before] + _status_types)
+    counts = dict((as_date(d), int(n)) for d, n in cur.fetchall())
+    cur.execute('select date, {} from {} where date < %s'.format(
+            '+'.join(s + '_sessions' for s in _status_types), _rollup_table), [as_date(before)])
+    rolled = dict((as_date(d), int(n)) for d, n in cur.fetchall())
+    changed = [d for d in set(counts) | set(rolled) if counts.get(d, 0) != rolled.get(d, 0)]
+    return min(changed) if changed else None
+
+def refresh_rollup(db, precision=sketches.default_precision):
+    """Updates the rollup table with the source rows added since the
+    last refresh. Distinct user counts can't be added incrementally, so
+    every day from the one containing the earliest new row onward is
+    recomputed. New rows are found by created_at, and also by file id
+    and by the count of earlier sessions to catch rows that arrive
+    late. The distinct user sketches for the recomputed days are stored
+    with the given precision."""
+    create_rollup_tables(db)
+    cur = db.cursor()
+    try:
+        cur.execute('select created_at, file_id from {} where id = 0'.format(_rollup_state_table))
+        state = cur.fetchone()
+        cur.execute('select created_at, sessions from {} where id = 0'.format(_rollup_sessions_state_table))
+        sessions_state = cur.fetchone()
+        cur.execute('select max(created_at) from aspera_stats_collector.fasp_sessions')
+        sessions_hwm = cur.fetchone()[0]
+        cur.execute('select max(created_at), max(id) from aspera_stats_collector.fasp_files')
+        files_hwm, file_id = cur.fetchone()
+        hwms = [as_date(d) for d in [sessions_hwm, files_hwm] if d]
+        if not hwms:
+            return
+        if state:
+            start = as_date(state[0])
+            cur.execute('select min(created_at) from aspera_stats_collector.fasp_files where id > %s',
+                        [state[1] if state[1] is not None else -1])
+            late = cur.fetchone()[0]
+            if late:
+                start = min(start, as_date(late))
+            if sessions_state:
+                cur.execute('select count(session_id) from aspera_stats_collector.fasp_sessions'
+                            ' where created_at < %s', [sessions_state[0]])
+                if int(cur.fetchone()[0]) != sessions_state[1]:
+                    late = _first_late_session_date(cur, sessions_state[0])
+                    if late:
+                        start = min(start, late)
+        else:
+            cur.execute('select min(created_at) from aspera_stats_collector.fasp_sessions')
+            firsts = [cur.fetchone()[0]]
+            cur.execute('select min(created_at) from aspera_stats_collector.fasp_files')
+            firsts.append(cur.fetchone()[0])
+            start = min(as_date(d) for d in firsts if d)
+        end = max(hwms) + datetime.timedelta(days=1)
+        columns = rollup_columns()
+        rows = [[date] + [stats[c] for c in columns]
+                for date, stats in sorted(get_range_stats(db, start, end).items())]
+        cur.execute('delete from {} where date >= %s'.format(_rollup_table), [start])
+        cur.executemany('insert into {} (date,{}) values ({})'.format(
+                _rollup_table, ','.join(columns), ','.join(['%s'] * (1+len(columns)))),
+                        rows)
+        cur.execute('delete from {} where date >= %s'.format(_rollup_users_table), [start])
+        cur.executemany('insert into {} (date, status, hll) values (%s, %s, %s)'.format(_rollup_users_table),
+                        [[date, status, sketches.hll_dumps(h)] for (date, status), h
+                         in sorted(get_range_user_sketches(db, start, end, precision).items())])
+        hwm = max([d for d in [sessions_hwm, files_hwm] if d])
+        cur.execute('replace into {} (id, created_at, file_id) values (0, %s, %s)'.format(_rollup_state_table),
+                    [hwm, file_id])
+        cur.execute('select count(session_id) from aspera_stats_collector.fasp_sessions'
+                    ' where created_at < %s', [hwm])
+        cur.execute('replace into {} (id, created_at, sessions) values (0, %s, %s)'.format(
+                _rollup_sessions_state_table), [hwm, int(cur.fetchone()[0])])
+        db.commit()
+    finally:
+        cur.close()
+
+def rebuild_rollup(db, precision=sketches.default_precision):
+    """Discards the rollup table contents and recomputes all days."""
+    create_rollup_tables(db)
+    cur = db.cursor()
+    try:
+        for table in [_rollup_table, _rollup_users_table, _rollup_state_table,
+                      _rollup_sessions_state_table]:
+            cur.execute('delete from {}'.format(table))
+    finally:
+        cur.close()
+    refresh_rollup(db, precision)
+    db.commit()     # refresh_rollup doesn't commit if there are no source rows
+
+def get_distinct_users(db, start, end, status='completed'):
+    """Returns the estimated number of distinct users (cookies) with
+    sessions of the given status over the dates in [start, end), by
+    merging the daily sketches in the rollup."""
+    cur = db.cursor()
+    try:
+        cur.execute('select hll from {} where date >= %s and date < %s and status = %s'.format(
+                _rollup_users_table), [as_date(start), as_date(end), status])
+        h = None
+        for (s,) in cur.fetchall():
+            if h is None:
+                h = sketches.hll_loads(s)
+            else:
+                sketches.hll_merge(h, sketches.hll_loads(s))
+        return sketches.hll_count(h) if h else 0
+    finally:
+        cur.close()
+
+def get_rollup_stats(db, start, end):
+    """Returns a dict mapping each date in the half-open range [start,
+    end) to its stats dict, read from the rollup table. Dates with no
+    rollup row had no activity as of the last refresh."""
+    start, end = as_date(start), as_date(end)
+    stats = {}
+    date = start
+    while date < end:
+        stats[date] = init_stats(date)
+        date += datetime.timedelta(days=1)
+    columns = rollup_columns()
+    cur = db.cursor()
+    try:
+        cur.execute('select date,{} from {} where date >= %s and date < %s'.format(
+                ','.join(columns), _rollup_table), [start, end])
+        for row in cur.fetchall():
+            s = stats[as_date(row[0])]
+            for c,v in zip(columns, row[1:]):
+                s[c] = int(v)
         return stats
     finally:
         cur.close()
 
 def get_stats(db, date, stats=None):
-    if not stats:
-        stats = {'date':date}
-    for status in _status_types:
-        get_stats_status(db, stats, date, status)
-    get_counted_file_stats(db, stats, date)
-    return stats
+    """Returns the stats for the date, read from the source tables (so
+    that reading doesn't need to write the rollup)."""
+    d = as_date(date)
+    day_stats = get_range_stats(db, d, d + datetime.timedelta(days=1))[d]
+    day_stats['date'] = date
+    if stats:
+        stats.update(day_stats)
+        return stats
+    else:
+        return day_stats
 
 def array_stats(s):
-    return [str(s[f]) if f else ''
-                for f in ['date',
-                          'completed_sessions',
-                          'completed_users',
-                          'completed_bytes',
-                          None,
-                          'cancelled_sessions',
-                          'cancelled_users',
-                          None,
-                          'error_sessions',
-                          'error_users']]
+    return report.csv_fields('stats', s)
+
 def main():
     config = ConfigParser.ConfigParser()
     config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
-    get_config = lambda k: config.get('statscollector',k)
-
-    host = get_config('mysql.host')
-    port = int(get_config('mysql.port'))
-    user = get_config('mysql.user')
-    passwd = get_config('mysql.password')
+    precision = sketches.precision_from_config(config)
 
     argparser = argparse.ArgumentParser(description='Extract statistics from Aspera stats collector database.')
     argparser.add_argument('-d', '--date',
-                           help='specify the log date (yyyy-mm-dd)')
+                           help='specify the log date (yyyy-mm-dd; default yesterday)')
     argparser.add_argument('-c', '--csv',
                            help='produce CSV-formatted output',
                            action='store_true')
+    argparser.add_argument('-o', '--output',
+                           help='write the stats to PATH (.csv, .jsonl, or .db)',
+                           metavar='PATH')
+    argparser.add_argument('--rebuild-rollup',
+                           help='recompute the daily rollup table from scratch',
+                           action='store_true')
+    metrics.add_arguments(argparser)
     args = argparser.parse_args()
+    metrics.instrument('asperastatscollector', args.profile, args.metrics)
 
-    db = pymysql.connect(host=host,port=port,user=user,passwd=passwd)
+    pool = database.pool_from_config(config)
     try:
-        stats = get_stats(db, args.date)
-        if args.csv:
+        if args.rebuild_rollup:
+            database.call(pool, rebuild_rollup, precision)
+            if not args.date:
+                return
+        date = args.date or (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+        stats = database.call(pool, get_stats, date)
+        if args.output:
+            report.write_rows(args.output, 'stats', [stats])
+        elif args.csv:
             print ','.join(array_stats(stats))
         else:
             print stats
     finally:
-        db.close()
+        database.close_pool(pool)
@@ -0,0 +1,334 @@
+# Benchmarks for the download statistics tools
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import argparse, datetime, json, os, random, shutil, subprocess, sys, tempfile, time
+import ConfigParser
+from array import array
+import asperastatscollector as aspera
+import database, geodb, geolocate, metrics, packagelog, report, standin, update
+from bundles import bundles
+
+_packages = ['3T_Structural_preproc', '3T_Structural_unproc',
+             '3T_rfMRI_REST1_preproc', '3T_rfMRI_REST1_unproc',
+             '3T_rfMRI_REST2_preproc', '3T_rfMRI_REST2_unproc',
+             '3T_tfMRI_EMOTION_preproc', '3T_tfMRI_EMOTION_unproc',
+             '3T_tfMRI_WM_preproc', '3T_tfMRI_WM_unproc',
+             '3T_Diffusion_preproc', '3T_Diffusion_unproc']
+
+_resources = [('HCP_Q1', 'Q1', 'HCP_Q1-GroupAvgUnrelated20.zip'),
+              ('HCP_Q1', 'Q1', 'HCP_Q1-GroupAvgRelated20.zip')]
+
+_logins = ['user{}'.format(i) for i in range(200)]
+
+_subjects = sorted(set.union(*[s for _, s in bundles]))
+
+def package_line(rand, t, subjects=None):
+    if subjects is None:
+        subjects = rand.sample(_subjects, rand.randint(1, 5))
+    packages = rand.sample(_packages, rand.randint(1, len(_packages)))
+    return '{} {},{:03d} {} downloading {} x [{}] ({} bytes)\n'.format(
+        t.strftime('%Y-%m-%d'), t.strftime('%H:%M:%S'), t.microsecond/1000,
+        rand.choice(_logins), ','.join(packages), ', '.join(sorted(subjects)),
+        rand.randint(1, 1<<38))
+
+def resource_line(rand, t):
+    project, resource, filename = rand.choice(_resources)
+    return '{} {},{:03d} {} downloading {} from project {}, resource {} ({} bytes)\n'.format(
+        t.strftime('%Y-%m-%d'), t.strftime('%H:%M:%S'), t.microsecond/1000,
+        rand.choice(_logins), filename, project, resource,
+        rand.randint(1, 1<<30))
+
+def _weighted_choice(rand, weights):
+    r = rand.random() * sum(w for _, w in weights)
+    for item, w in weights:
+        r -= w
+        if r < 0:
+            return item
+    return weights[-1][0]
+
+def generate_log_lines(n, date=datetime.date(2013, 3, 15), seed=0,
+                       resource_fraction=0.1, bundle_weights=None):
+    """Generates n synthetic package-downloads.log lines for the given
+    date. resource_fraction of the lines are resource requests; the
+    rest are package requests, for a subject bundle chosen with the
+    given weights (a dict of bundle name to weight, where the name
+    None stands for a few arbitrary subjects; by default, all bundles
+    are equally likely and never arbitrary subjects)."""
+    rand = random.Random(seed)
+    if bundle_weights is None:
+        bundle_weights = dict.fromkeys([name for name, _ in bundles], 1)
+    subject_sets = dict(bundles)
+    weights = sorted(bundle_weights.items())
+    start = datetime.datetime.combine(date, datetime.time())
+    for i in xrange(n):
+        t = start + datetime.timedelta(seconds=86400.0*i/n)
+        if rand.random() < resource_fraction:
+            yield resource_line(rand, t)
+        else:
+            yield package_line(rand, t, subject_sets.get(_weighted_choice(rand, weights)))
+
+def write_log(path, n, **kwargs):
+    with open(path, 'w') as f:
+        f.writelines(generate_log_lines(n, **kwargs))
+    return path
+
+def write_logs(logdir, logname, dates, n, **kwargs):
+    """Writes a rotated log of n lines in logdir for each of the dates."""
+    seed = kwargs.pop('seed', 0)
+    for i, date in enumerate(dates):
+        write_log(os.path.join(logdir, logname + '.' + date.isoformat()), n,
+                  date=date, seed=seed + i, **kwargs)
+
+_statuses = [('completed', 0.9), ('cancelled', 0.05), ('error', 0.05)]
+
+def generate_transfers(db, dates, sessions, files_per_session=3, seed=0, users=500):
+    """Adds sessions Aspera sessions per date, each with up to
+    files_per_session files, to the fasp_sessions and fasp_files
+    tables. Returns the number of session and file rows added."""
+    rand = random.Random(seed)
+    cur = db.cursor()
+    nsessions = nfiles = 0
+    try:
+        cur.execute('select max(id) from aspera_stats_collector.fasp_files')
+        file_id = cur.fetchone()[0] or 0
+        for date in dates:
+            start = datetime.datetime.combine(date, datetime.time())
+            session_rows, file_rows = [], []
+            for i in xrange(sessions):
+                t = start + datetime.timedelta(seconds=int(86400.0*i/sessions))
+                session_id = '{}-{}'.format(date.isoformat(), i)
+                status = _weighted_choice(rand, _statuses)
+                user = rand.randrange(users)
+                session_rows.append([session_id, 'cookie{}'.format(user), status, t,
+                                     '10.{}.{}.{}'.format(user >> 8, user & 0xff, rand.randint(1, 4))])
+                for j in range(rand.randint(1, files_per_session)):
+                    file_id += 1
+                    file_rows.append([file_id, session_id,
+                                      '/data/{}_{}.zip'.format(rand.choice(_subjects),
+                                                               rand.choice(_packages)),
+                                      rand.randint(1, 1<<34), status,
+                                      t + datetime.timedelta(seconds=j)])
+            cur.executemany('insert into aspera_stats_collector.fasp_sessions'
+                            ' (session_id, cookie, status, created_at, client_addr)'
+                            ' values (%s, %s, %s, %s, %s)', session_rows)
+            cur.executemany('insert into aspera_stats_collector.fasp_files'
+                            ' (id, session_id, file_fullpath, bytes_written, status, created_at)'
+                            ' values (%s, %s, %s, %s, %s, %s)', file_rows)
+            nsessions += len(session_rows)
+            nfiles += len(file_rows)
+        db.commit()
+        return nsessions, nfiles
+    finally:
+        cur.close()
+
+def generate_geo_index(nblocks=10000, seed=0):
+    """Returns a synthetic geodb index of nblocks ranges covering the
+    10.0.0.0/8 addresses used by generate_transfers."""
+    rand = random.Random(seed)
+    base, size = geodb.ip_to_int('10.0.0.0'), 1 << 24
+    bounds = sorted(rand.sample(xrange(1, size), nblocks - 1))
+    starts = [0] + bounds
+    ends = bounds + [size]
+    locations = [{'country_code': 'US', 'city': 'City {}'.format(i),
+                  'latitude': rand.uniform(-90, 90), 'longitude': rand.uniform(-180, 180)}
+                 for i in range(nblocks)]
+    return (array('L', [base + s for s in starts]),
+            array('L', [base + e - 1 for e in ends]),
+            array('L', range(nblocks)), locations)
+
+def timed(f, *args):
+    """Returns the elapsed wall clock time for f(*args)."""
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def result(count, seconds, unit):
+    return {'count': count, 'seconds': seconds, 'unit': unit,
+            'rate': count/seconds if seconds else None}
+
+def time_lines(logfile, handle, fast=True):
+    return timed(lambda: handle(packagelog.read_log(logfile),
+                                packagelog.init_stats(), fast))
+
+def run_parse(tmpdir, lines, slow_lines, jobs=1, **kwargs):
+    """Times the parser engines on a synthetic log."""
+    logfile = write_log(os.path.join(tmpdir, 'package-downloads.log'), lines)
+    slowfile = write_log(os.path.join(tmpdir, 'package-downloads-slow.log'), slow_lines)
+    results = {
+        'parse.pyparsing': result(slow_lines, time_lines(slowfile, packagelog.handle_lines, False), 'lines'),
+        'parse.regex': result(lines, time_lines(logfile, packagelog.handle_lines, True), 'lines'),
+        'parse.batched': result(lines, time_lines(logfile, packagelog.handle_batches), 'lines')}
+    if jobs > 1:
+        results['parse.regex_x{}'.format(jobs)] = result(lines, timed(
+                packagelog.handle_file, logfile, packagelog.init_stats(), jobs, True), 'lines')
+    return results
+
+def run_aggregate(tmpdir, days, day_lines, jobs=1, **kwargs):
+    """Times the daily stats for a run of rotated logs, parsed and then
+    served from the stats cache, and the merge of the daily stats."""
+    logdir = os.path.join(tmpdir, 'logs')
+    os.makedirs(logdir)
+    dates = [datetime.date(2013, 3, 1) + datetime.timedelta(days=i) for i in range(days)]
+    write_logs(logdir, 'pkg.log', dates, day_lines)
+    cachedir = os.path.join(tmpdir, 'cache')
+    daily = []
+    results = {}
+    results['aggregate.parse'] = result(days*day_lines, timed(
+            lambda: daily.extend(packagelog.iter_stats(logdir, 'pkg.log', dates, jobs,
+                                                       cachedir=cachedir))), 'lines')
+    results['aggregate.cached'] = result(days, timed(
+            lambda: list(packagelog.iter_stats(logdir, 'pkg.log', dates, cachedir=cachedir))), 'days')
+    def merge():
+        total = packagelog.init_stats()
+        for stats in daily:
+            packagelog.merge_stats(total, stats)
+        packagelog.count_resources(total)
+    results['aggregate.merge'] = result(days, timed(merge), 'days')
+    return results
+
+def run_db(tmpdir, days, sessions, connect, **kwargs):
+    """Times the Aspera rollup and stats queries against synthetic
+    transfers, in the database opened by connect."""
+    db = connect()
+    aspera.create_source_tables(db)
+    dates = [datetime.date(2013, 3, 1) + datetime.timedelta(days=i) for i in range(days)]
+    results = {}
+    nsessions, nfiles = generate_transfers(db, dates, sessions)
+    start, end = dates[0], dates[-1] + datetime.timedelta(days=1)
+    results['db.range_stats'] = result(nsessions, timed(aspera.get_range_stats, db, start, end), 'sessions')
+    results['db.rebuild_rollup'] = result(nsessions, timed(aspera.rebuild_rollup, db), 'sessions')
+    generate_transfers(db, [end], sessions, seed=1)
+    results['db.refresh_rollup'] = result(sessions, timed(aspera.refresh_rollup, db), 'sessions')
+    results['db.rollup_stats'] = result(days, timed(aspera.get_rollup_stats, db, start, end), 'days')
+    return results, db
+
+def run_geolocate(tmpdir, db, blocks=10000, **kwargs):
+    """Times locating and inserting the client addresses left by
+    run_db, with a synthetic offline index."""
+    index = generate_geo_index(blocks)
+    geolocate.create_geo_table(db)
+    ips = len(geolocate.get_missing_ips(db))
+    return {'geolocate.offline': result(ips, timed(lambda: geolocate.get_missing_geo(db, index=index)),
+                                        'addresses')}
+
+def run_spreadsheet(tmpdir, days, **kwargs):
+    """Times adding a day to a spreadsheet with days of history, by
+    loading and saving the workbook and by appending to it from the
+    daily stats store."""
+    store = report.open_store(os.path.join(tmpdir, 'report.db'))
+    dates = [datetime.date(2010, 1, 1) + datetime.timedelta(days=i) for i in range(days + 2)]
+    def day(date):
+        values = dict((k, 1) for k in report.store_columns('stats') + report.store_columns('packages'))
+        values['date'] = date
+        return values, dict(values)
+    report.append_days(store, [day(d) for d in dates[:days]])
+    path = os.path.join(tmpdir, 'report.xlsx')
+    results = {'spreadsheet.write': result(days, timed(update.write_workbook, store, path,
+                                                       'Stats', 'Packages'), 'days')}
+    def legacy():
+        stats, pkgs = day(datetime.datetime.combine(dates[days], datetime.time()))
+        wb = update.load_workbook(path)
+        update.append_row_named(wb.get_sheet_by_name('Stats'), report.stats_columns, stats)
+        update.append_row_named(wb.get_sheet_by_name('Packages'), report.pkgs_columns, pkgs)
+        wb.save(path)
+    results['spreadsheet.load_save'] = result(1, timed(legacy), 'updates')
+    def stored():
+        report.append_days(store, [day(dates[days+1])])
+        update.append_workbook(store, path, 'Stats', 'Packages')
+    results['spreadsheet.store'] = result(1, timed(stored), 'updates')
+    return results
+
+benchmarks = ['parse', 'aggregate', 'db', 'geolocate', 'spreadsheet']
+
+def run_benchmarks(only=benchmarks, connect=None, **params):
+    """Runs the named benchmarks with the given parameters (see main),
+    returning a dict of results by benchmark name. The database
+    benchmarks run against the database opened by connect, if provided,
+    or else the SQLite stand-in."""
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    if connect is None:
+        connect = lambda: standin.connect(tmpdir)
+    try:
+        if 'parse' in only:
+            results.update(run_parse(tmpdir, **params))
+        if 'aggregate' in only:
+            results.update(run_aggregate(tmpdir, **params))
+        if 'db' in only or 'geolocate' in only:
+            db_results, db = run_db(tmpdir, connect=connect, **params)
+            try:
+                if 'db' in only:
+                    results.update(db_results)
+                if 'geolocate' in only:
+                    results.update(run_geolocate(tmpdir, db, **params))
+            finally:
+                db.close()
+        if 'spreadsheet' in only:
+            results.update(run_spreadsheet(tmpdir, **params))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def display_results(results, baseline=None):
+    """Prints the rates, and the ratio to the baseline rates if given."""
+    for name in sorted(results):
+        r = results[name]
+        line = '{:24s} {:12.0f} {}/s'.format(name, r['rate'] or 0, r['unit'])
+        if baseline and name in baseline and baseline[name]['rate']:
+            line += '  {:6.2f}x'.format((r['rate'] or 0)/baseline[name]['rate'])
+        print line
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark the download statistics pipeline.')
+    argparser.add_argument('-n', '--lines', type=int, default=2000000,
+                           help='number of synthetic log lines to parse')
+    argparser.add_argument('--slow-lines', type=int, default=20000,
+                           help='number of lines for the (slow) pyparsing engine')
+    argparser.add_argument('-d', '--days', type=int, default=30,
+                           help='number of days of logs, transfers, and spreadsheet rows')
+    argparser.add_argument('--day-lines', type=int, default=100000,
+                           help='number of log lines per day')
+    argparser.add_argument('--sessions', type=int, default=2000,
+                           help='number of Aspera sessions per day')
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='also time parallel parsing with this many processes')
+    argparser.add_argument('--db', metavar='SECTION',
+                           help='run the database benchmarks against the server configured in SECTION, which must be a scratch server (synthetic rows are added), instead of the SQLite stand-in')
+    argparser.add_argument('--only', action='append', choices=benchmarks,
+                           help='run only the named benchmark (may be repeated)')
+    argparser.add_argument('-o', '--output', metavar='JSON',
+                           help='write the results to JSON')
+    argparser.add_argument('--compare', metavar='JSON',
+                           help='show rates relative to earlier results')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('benchmark_dl_stats', args.profile, args.metrics)
+
+    params = {'lines': args.lines, 'slow_lines': args.slow_lines, 'days': args.days,
+              'day_lines': args.day_lines, 'sessions': args.sessions, 'jobs': args.jobs}
+    connect = None
+    if args.db:
+        config = ConfigParser.ConfigParser()
+        config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
+        connect = database.connector(config, args.db)
+    results = run_benchmarks(args.only or benchmarks, connect=connect, **params)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    display_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': _commit(),
+                       'time': datetime.datetime.now().isoformat(),
+                       'python': sys.version.split()[0],
+                       'params': params, 'results': results},
+                      f, indent=2, sort_keys=True)
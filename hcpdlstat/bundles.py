@@ -10,6 +10,60 @@ g5 = {'100307', '114924', '125525', '138231', '159239'}
 
 g1 = {'100307'}
 
+# Subject bundles: a package request counts toward a bundle when its
+# subject set is exactly the bundle's. Earlier entries win if two
+# bundles have the same subjects.
+bundles = [('g1', g1), ('g5', g5), ('g20', g20)]
+
+# Package types, counted when the type name appears in a package name.
+package_types = ['unproc', 'preproc']
+
 counted_resources = {
     'g20_avg':['HCP_Q1','Q1','HCP_Q1-GroupAvgUnrelated20.zip']
 }
+
+def compile_bundles(bundles):
+    """Returns an index mapping each bundle's subjects (as a frozenset)
+    to the bundle name."""
+    return dict((frozenset(subjects), name) for name, subjects in reversed(bundles))
+
+_bundle_index = compile_bundles(bundles)
+
+# Results for distinct requests (here and in packagelog) share one memo.
+# Requests are user-chosen combinations, so to bound its size in
+# long-running processes the memo is cleared once it holds memo_size
+# entries.
+memo_size = 1 << 16
+_memo = {}
+
+def memoized(key, compute):
+    """Returns the memoized value for key, calling compute() to get it
+    if there is none."""
+    value = _memo.get(key)
+    if value is None:
+        if len(_memo) >= memo_size:
+            _memo.clear()
+        value = _memo[key] = compute()
+    return value
+
+def clear_memo():
+    _memo.clear()
+
+def bundle_of(subjects):
+    """Returns the name of the bundle with exactly these subjects, or None."""
+    return _bundle_index.get(frozenset(subjects))
+
+def types_of(package):
+    """Returns the tuple of package types whose names appear in the
+    package name."""
+    return tuple(t for t in package_types if t in package)
+
+def classify(packages, subjects):
+    """Returns (bundle, types) for a request of the packages for the
+    subjects: the bundle name (or None), and the list of all package
+    types over the packages, one entry per package of that type.
+    Results are memoized for each distinct signature."""
+    subjects = frozenset(subjects)
+    return memoized(('classify', tuple(packages), subjects),
+                    lambda: (_bundle_index.get(subjects),
+                             [t for package in packages for t in types_of(package)]))
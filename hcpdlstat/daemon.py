@@ -0,0 +1,179 @@
+# Long-running collector: scheduled incremental refresh and a JSON endpoint
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import argparse, datetime, json, os, signal, sys, threading, time, traceback
+import BaseHTTPServer, ConfigParser
+import asperastatscollector, database, geolocate, metrics, packagelog, sketches
+
+# Each task runs on its own thread, every interval seconds, and
+# publishes its latest results in the shared state. The connection
+# pool, the tail checkpoint, and the geolocation index are kept between
+# runs, so each run does only the work that is new since the last.
+
+def init_state():
+    return {'lock': threading.Lock(), 'started': time.time(),
+            'tasks': {}, 'results': {}}
+
+def publish(state, key, value):
+    with state['lock']:
+        state['results'][key] = value
+
+def snapshot(state):
+    """Returns the published results and the task status, in a form
+    that can be encoded as JSON."""
+    with state['lock']:
+        s = dict(state['results'])
+        s['tasks'] = dict((k, dict(v)) for k, v in state['tasks'].iteritems())
+    s['uptime'] = time.time() - state['started']
+    return s
+
+def run_task(state, name, fn, *args):
+    """Runs fn(state, *args) as the named task, recording the time and
+    outcome. Errors are reported and recorded, not raised, so that the
+    task is tried again on its next run."""
+    with state['lock']:
+        status = state['tasks'].setdefault(name, {'runs': 0, 'errors': 0,
+                                                  'last_run': None, 'last_error': None})
+    start = time.time()
+    try:
+        with metrics.timer('daemon.' + name):
+            fn(state, *args)
+    except Exception as e:
+        traceback.print_exc()
+        metrics.count('daemon.errors')
+        with state['lock']:
+            status['errors'] += 1
+            status['last_error'] = '{}: {}'.format(type(e).__name__, e)
+    with state['lock']:
+        status['runs'] += 1
+        status['last_run'] = start
+        status['seconds'] = time.time() - start
+
+def schedule(state, stop, name, interval, fn, *args):
+    """Starts a thread that runs the task every interval seconds until
+    stop is set, and returns it."""
+    def loop():
+        while not stop.is_set():
+            run_task(state, name, fn, *args)
+            stop.wait(interval)
+    thread = threading.Thread(target=loop, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def tail_packages(state, logdir, logname, checkpoint_path, quarantine_path=None,
+                  precision=sketches.default_precision):
+    """Parses the lines added to today's package log and publishes
+    today's package stats. Lines that can't be parsed are quarantined
+    if quarantine_path is provided (see packagelog.tail_log). If the
+    log can't be read, stats published for an earlier day are
+    withdrawn rather than served as today's."""
+    try:
+        stats = packagelog.tail_log(logdir, logname, checkpoint_path,
+                                    quarantine_path=quarantine_path, precision=precision)
+    except Exception:
+        with state['lock']:
+            published = state['results'].get('packages')
+            if published and published['date'] != datetime.date.today().isoformat():
+                del state['results']['packages']
+        raise
+    stats['date'] = stats['date'].isoformat()
+    stats['logins'] = sketches.hll_count(stats['logins'])
+    publish(state, 'packages', stats)
+
+def refresh_aspera(state, pool, precision=sketches.default_precision):
+    """Rolls up the Aspera sessions and files added since the last
+    refresh, and publishes the stats for yesterday and today."""
+    database.call(pool, asperastatscollector.refresh_rollup, precision)
+    today = datetime.date.today()
+    days = database.call(pool, asperastatscollector.get_rollup_stats,
+                         today - datetime.timedelta(days=1), today + datetime.timedelta(days=1))
+    publish(state, 'aspera', dict((d.isoformat(), dict(s, date=d.isoformat()))
+                                  for d, s in days.iteritems()))
+
+def geolocate_new(state, pool, options):
+    """Locates the client addresses seen since the last run, and
+    publishes the number located since the daemon started."""
+    n = database.call(pool, geolocate.get_missing_geo, **options)
+    with state['lock']:
+        located = state['results'].get('geolocate', {}).get('located', 0) + n
+    publish(state, 'geolocate', {'located': located, 'last': n})
+
+class _StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the daemon state at / (or /stats) and the metrics report
+    at /metrics, as JSON."""
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path in ['', '/stats']:
+            body = snapshot(self.server.state)
+        elif '/metrics' == path:
+            body = metrics.report()
+        else:
+            self.send_error(404)
+            return
+        content = json.dumps(body, sort_keys=True, default=str)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(state, host='127.0.0.1', port=8765):
+    """Returns an HTTP server for the state; call serve_forever to run it."""
+    server = BaseHTTPServer.HTTPServer((host, port), _StatsHandler)
+    server.state = state
+    return server
+
+def main():
+    config = ConfigParser.ConfigParser()
+    config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
+    get = lambda s, k, default=None: config.get(s, k) if config.has_option(s, k) else default
+
+    argparser = argparse.ArgumentParser(description='Collect download statistics continuously and serve them as JSON.')
+    argparser.add_argument('--host', default=get('daemon', 'host', '127.0.0.1'),
+                           help='address to serve on (default: localhost only)')
+    argparser.add_argument('-p', '--port', type=int, default=int(get('daemon', 'port', 8765)),
+                           help='port to serve on')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('dl_stats_daemon', args.profile, args.metrics)
+
+    # intervals are in seconds; 0 turns a task off
+    intervals = dict((k, float(get('daemon', k + '.interval', default)))
+                     for k, default in [('tail', 60), ('aspera', 300), ('geolocate', 3600)])
+    precision = sketches.precision_from_config(config)
+
+    state = init_state()
+    server = serve(state, args.host, args.port)
+    pool = database.pool_from_config(config)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threads = []
+    try:
+        if intervals['tail']:
+            checkpoint = get('daemon', 'tail.checkpoint',
+                             os.path.expanduser('~/.hcpdlstat.tail'))
+            threads.append(schedule(state, stop, 'tail', intervals['tail'], tail_packages,
+                                    config.get('packagelog', 'logdir'),
+                                    config.get('packagelog', 'logname'), checkpoint,
+                                    get('packagelog', 'quarantine'), precision))
+        if intervals['aspera']:
+            threads.append(schedule(state, stop, 'aspera', intervals['aspera'],
+                                    refresh_aspera, pool, precision))
+        if intervals['geolocate']:
+            database.call(pool, geolocate.create_geo_table)
+            threads.append(schedule(state, stop, 'geolocate', intervals['geolocate'],
+                                    geolocate_new, pool, geolocate.lookup_options(config)))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        for thread in threads:
+            thread.join()
+        database.close_pool(pool)
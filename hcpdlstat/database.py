@@ -0,0 +1,111 @@
+# Shared database access: configuration, connection pooling, and retry
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import threading, time
+import pymysql, pymysql.cursors
+import metrics
+
+# MySQL client errors meaning the server connection was lost: server
+# gone away, lost connection during query, commands out of sync,
+# connection unusable.
+_disconnect_codes = set([2006, 2013, 2014, 2045, 2055])
+
+# Errors from a bad statement or bad values, as opposed to a bad connection
+statement_errors = (pymysql.err.ProgrammingError,)
+
+def is_disconnect(e):
+    """Returns True if the exception means the connection was dropped
+    and the operation can be retried on a new one."""
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    return (isinstance(e, pymysql.err.OperationalError)
+            and bool(e.args) and e.args[0] in _disconnect_codes)
+
+class _TimedCursor(pymysql.cursors.Cursor):
+    """Times each statement sent to the server (executemany sends its
+    statements through execute)."""
+    def execute(self, query, args=None):
+        with metrics.timer('db.query'):
+            return super(_TimedCursor, self).execute(query, args)
+
+def connector(config, section='statscollector'):
+    """Returns a function that opens a new connection using the mysql.*
+    options in the given config section."""
+    get = lambda k, default=None: config.get(section, k) if config.has_option(section, k) else default
+    params = {'host': get('mysql.host'),
+              'port': int(get('mysql.port', 3306)),
+              'user': get('mysql.user'),
+              'passwd': get('mysql.password'),
+              'cursorclass': _TimedCursor}
+    return lambda: pymysql.connect(**params)
+
+def init_pool(connect, size=4, retries=2, backoff=0.5):
+    """Returns a pool that keeps up to size idle connections opened by
+    connect, for reuse across calls."""
+    return {'connect': connect, 'size': size, 'idle': [],
+            'lock': threading.Lock(),
+            'retries': retries, 'backoff': backoff}
+
+def pool_from_config(config, section='statscollector'):
+    """Returns a pool for the database configured in the given section,
+    with the optional mysql.pool.size and mysql.retries options."""
+    options = {}
+    for k, option in [('size', 'mysql.pool.size'), ('retries', 'mysql.retries')]:
+        if config.has_option(section, option):
+            options[k] = int(config.get(section, option))
+    return init_pool(connector(config, section), **options)
+
+def acquire(pool):
+    """Returns an idle connection from the pool, or a new one."""
+    with pool['lock']:
+        if pool['idle']:
+            return pool['idle'].pop()
+    metrics.count('db.connect')
+    return pool['connect']()
+
+def release(pool, db, discard=False):
+    """Returns the connection to the pool, or closes it if it is to be
+    discarded or the pool is full."""
+    if not discard:
+        with pool['lock']:
+            if len(pool['idle']) < pool['size']:
+                pool['idle'].append(db)
+                return
+    try:
+        db.close()
+    except Exception:
+        pass
+
+def close_pool(pool):
+    with pool['lock']:
+        idle, pool['idle'] = pool['idle'], []
+    for db in idle:
+        release(pool, db, discard=True)
+
+def call(pool, fn, *args, **kwargs):
+    """Returns fn(db, *args, **kwargs) for a pooled connection db. If
+    the connection is dropped, fn is retried on a new connection (with
+    exponential backoff), so fn should commit only once its work is
+    done. Other errors roll back and are raised."""
+    for attempt in range(pool['retries'] + 1):
+        db = acquire(pool)
+        try:
+            result = fn(db, *args, **kwargs)
+        except Exception as e:
+            if not is_disconnect(e):
+                try:
+                    db.rollback()
+                except Exception:
+                    release(pool, db, discard=True)
+                else:
+                    release(pool, db)
+                raise
+            release(pool, db, discard=True)
+            if attempt == pool['retries']:
+                raise
+            metrics.count('db.retry')
+            time.sleep(pool['backoff'] * 2**attempt)
+        else:
+            release(pool, db)
+            return result
@@ -0,0 +1,155 @@
+# Columnar, date-partitioned store of parsed package log records
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import cPickle as pickle
+import argparse, datetime, os, ConfigParser
+from array import array
+from collections import Counter
+from itertools import izip
+import metrics
+
+# Each column is an array; string columns are dictionary encoded, with
+# code 0 standing for no value. time is milliseconds since midnight.
+_columns = [('time', 'l'), ('login', 'l'), ('packages', 'l'),
+            ('subjects', 'l'), ('bytes', 'l'), ('project', 'l'),
+            ('resource', 'l'), ('filename', 'l')]
+_string_columns = ['login', 'packages', 'subjects',
+                   'project', 'resource', 'filename']
+
+def new_table():
+    return {'columns': dict((name, array(t)) for name, t in _columns),
+            'strings': dict((name, ['']) for name in _string_columns),
+            'codes': dict((name, {'': 0}) for name in _string_columns)}
+
+def encode(table, column, value):
+    """Returns the dictionary code for value in the named string column,
+    adding it to the column's dictionary if necessary."""
+    codes = table['codes'][column]
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(codes)
+        table['strings'][column].append(value)
+    return code
+
+def add_record(table, parse_results):
+    """Appends the parsed log line to the table."""
+    t = parse_results['time']
+    ms = ((int(t[0])*60 + int(t[1]))*60 + int(t[2]))*1000 + int(t[3])
+    if 'packages' in parse_results:
+        values = {'packages': ','.join(parse_results['packages']),
+                  'subjects': ','.join(sorted(set(parse_results['subjects'])))}
+    else:
+        values = {'project': parse_results['project'],
+                  'resource': parse_results['resource'],
+                  'filename': parse_results['filename']}
+    values['login'] = parse_results['login']
+    columns = table['columns']
+    columns['time'].append(ms)
+    columns['bytes'].append(int(parse_results['bytes_requested'][0]))
+    for name in _string_columns:
+        columns[name].append(encode(table, name, values.get(name, '')))
+
+def partition_path(storedir, date):
+    return os.path.join(storedir, date.isoformat() + '.events')
+
+def has_partition(storedir, date):
+    return os.path.exists(partition_path(storedir, date))
+
+def write_partition(storedir, date, table):
+    """Writes the table as the partition for the given date, replacing
+    any existing partition."""
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+    path = partition_path(storedir, date)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'columns': dict((name, a.tostring())
+                                     for name, a in table['columns'].iteritems()),
+                     'strings': table['strings']},
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def read_partition(storedir, date):
+    """Returns the partition for the given date, as a dict with
+    'columns' (arrays) and 'strings' (the dictionaries for the string
+    columns), or None if there is no partition for that date."""
+    try:
+        with open(partition_path(storedir, date), 'rb') as f:
+            data = pickle.load(f)
+    except IOError:
+        return None
+    columns = {}
+    for name, t in _columns:
+        columns[name] = array(t)
+        columns[name].fromstring(data['columns'][name])
+    return {'columns': columns, 'strings': data['strings']}
+
+def scan(storedir, start, end):
+    """Yields (date, partition) for each stored date in [start, end)."""
+    date = start
+    while date < end:
+        p = read_partition(storedir, date)
+        if p:
+            yield date, p
+        date += datetime.timedelta(days=1)
+
+def _keys(date, p, key):
+    if 'hour' == key:
+        return (t // 3600000 for t in p['columns']['time'])
+    elif 'date' == key:
+        return [date] * len(p['columns']['time'])
+    else:
+        return p['columns'][key]
+
+def _decode(p, key, k):
+    if key in _string_columns:
+        return p['strings'][key][k] or None
+    else:
+        return k
+
+def sum_by(storedir, start, end, key, value='bytes'):
+    """Returns a Counter mapping each value of the key column (a string
+    column, or 'hour' or 'date') over the dates in [start, end) to the
+    sum of the value column, or to the number of records if value is
+    None. Sums are accumulated on dictionary codes and decoded once
+    per partition."""
+    totals = Counter()
+    for date, p in scan(storedir, start, end):
+        keys = _keys(date, p, key)
+        if value:
+            sums = Counter()
+            for k, v in izip(keys, p['columns'][value]):
+                sums[k] += v
+        else:
+            sums = Counter(keys)
+        for k, v in sums.iteritems():
+            totals[_decode(p, key, k)] += v
+    return totals
+
+def main():
+    config = ConfigParser.ConfigParser()
+    config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
+    to_date = lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+    argparser = argparse.ArgumentParser(description='Aggregate parsed package log records.')
+    argparser.add_argument('--from', dest='start', type=to_date, required=True,
+                           help='first date (yyyy-mm-dd)')
+    argparser.add_argument('--to', dest='end', type=to_date, required=True,
+                           help='last date (yyyy-mm-dd), inclusive')
+    argparser.add_argument('-b', '--by', default='login',
+                           choices=_string_columns + ['hour', 'date'],
+                           help='column to group by')
+    argparser.add_argument('--count', action='store_true',
+                           help='count records instead of summing bytes')
+    argparser.add_argument('-n', '--top', type=int,
+                           help='show only the N largest groups')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('query_dl_events', args.profile, args.metrics)
+
+    totals = sum_by(config.get('packagelog', 'eventdir'),
+                    args.start, args.end + datetime.timedelta(days=1),
+                    args.by, None if args.count else 'bytes')
+    for k, v in totals.most_common(args.top):
+        print '{},{}'.format(k, v)
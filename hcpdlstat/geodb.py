@@ -0,0 +1,150 @@
+# Offline IP geolocation from a local GeoLite City CSV database
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import cPickle as pickle
+import csv, os, socket, struct
+from array import array
+from bisect import bisect_right
+
+_source = 'GeoLite City'
+
+# GeoLite City location fields, mapped to geolocation.geo columns.
+# The locations have only country and region codes; the names come from
+# MaxMind's separate code tables (ISO 3166 country codes, and region
+# codes), if provided, and are otherwise left empty.
+_location_columns = [None, 'country_code', 'region_code', 'city', 'zipcode',
+                     'latitude', 'longitude', 'metro_code', 'areacode']
+
+def ip_to_int(ip):
+    """Returns the dotted-quad IPv4 address as an integer, or None if
+    it isn't one."""
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return None
+
+def _data_rows(f):
+    """Yields the CSV rows after the copyright and header lines."""
+    rows = csv.reader(f)
+    for row in rows:
+        if row and row[0][:1].isdigit():
+            yield row
+
+def _location(row):
+    loc = {}
+    for k,v in zip(_location_columns, row):
+        if k and v:
+            v = v.decode('latin-1')
+            loc[k] = float(v) if k in ('latitude', 'longitude') else v
+    return loc
+
+def _code_names(path, width):
+    """Returns a dict mapping the codes (the first width - 1 fields) of
+    each row of a MaxMind code table CSV to the name (the last field)."""
+    names = {}
+    if path:
+        with open(path, 'rb') as f:
+            for row in csv.reader(f):
+                if width == len(row):
+                    names[tuple(row[:-1])] = row[-1].decode('latin-1')
+    return names
+
+def load_csv(blocks_path, locations_path, countries_path=None, regions_path=None):
+    """Builds an index from the GeoLite City blocks and locations CSV
+    files, with the country and region names from the country
+    (code,name) and region (country,region,name) code tables if
+    provided. The index is a tuple (starts, ends, locs, locations): the
+    first three are arrays sorted by range start, with locs holding
+    indices into the list of location dicts."""
+    countries = _code_names(countries_path, 2)
+    regions = _code_names(regions_path, 3)
+    locations = []
+    loc_index = {}
+    with open(locations_path, 'rb') as f:
+        for row in _data_rows(f):
+            loc = _location(row)
+            country, region = loc.get('country_code'), loc.get('region_code')
+            if (country,) in countries:
+                loc['country_name'] = countries[(country,)]
+            if (country, region) in regions:
+                loc['region_name'] = regions[(country, region)]
+            loc_index[int(row[0])] = len(locations)
+            locations.append(loc)
+    blocks = []
+    with open(blocks_path, 'rb') as f:
+        for row in _data_rows(f):
+            loc_id = int(row[2])
+            if loc_id in loc_index:
+                blocks.append((int(row[0]), int(row[1]), loc_index[loc_id]))
+    blocks.sort()
+    starts, ends, locs = array('L'), array('L'), array('L')
+    for start, end, loc in blocks:
+        starts.append(start)
+        ends.append(end)
+        locs.append(loc)
+    return (starts, ends, locs, locations)
+
+def save_index(index, path):
+    """Writes the index in a compact binary form for fast loading."""
+    starts, ends, locs, locations = index
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump((starts.tostring(), ends.tostring(), locs.tostring(), locations),
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def load_index(path):
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    arrays = []
+    for s in data[:3]:
+        a = array('L')
+        a.fromstring(s)
+        arrays.append(a)
+    return tuple(arrays) + (data[3],)
+
+def index_for(index_path, blocks_path, locations_path, countries_path=None, regions_path=None):
+    """Returns the index saved at index_path. If it's missing or older
+    than any of the CSV files (see load_csv), it is first built from
+    them and saved there."""
+    try:
+        built = os.path.getmtime(index_path)
+    except OSError:
+        built = None
+    paths = [p for p in [blocks_path, locations_path, countries_path, regions_path] if p]
+    if built is None or any(os.path.getmtime(p) > built for p in paths):
+        index = load_csv(blocks_path, locations_path, countries_path, regions_path)
+        save_index(index, index_path)
+        return index
+    return load_index(index_path)
+
+def lookup(index, ip):
+    """Returns the location dict for the address, or None if the
+    address isn't in any range."""
+    starts, ends, locs, locations = index
+    n = ip_to_int(ip)
+    if n is None:
+        return None
+    i = bisect_right(starts, n) - 1
+    if i >= 0 and n <= ends[i]:
+        return locations[locs[i]]
+    return None
+
+def get_geo(index, ip):
+    """Returns a geo dict for the address with the same keys as the
+    remote lookup, or None if the address can't be located."""
+    loc = lookup(index, ip)
+    if loc is None:
+        return None
+    geo = dict(loc)
+    geo['ip'] = ip
+    geo['source'] = _source
+    return geo
+
+def resolve(ips, index):
+    """Yields the geo dict for each of the ips that can be located."""
+    for ip in ips:
+        geo = get_geo(index, ip)
+        if geo:
+            yield geo
@@ -1,8 +1,10 @@
 # Copyright (c) 2013 Washington University School of Medicine
 # Author: Kevin A. Archie <karchie@wustl.edu>
 
-import ConfigParser
-import json, os, pymysql, urllib2
+import argparse, ConfigParser
+import httplib, json, os, sys, threading, time, urllib2, urlparse
+from multiprocessing.pool import ThreadPool
+import database, geodb, metrics
 
 columns = {'ip':'varchar(16) not null',
            'country_code':'varchar(2)',
@@ -29,60 +31,185 @@ def create_geo_table(db):
     finally:
         cur.close()
 
-def get_geo(ip):
-    response = urllib2.urlopen('http://freegeoip.net/json/{0}'.format(ip))
+_geo_url = 'http://freegeoip.net/json/{0}'
+_geo_timeout = 10
+
+def get_geo(ip, url=_geo_url, timeout=_geo_timeout):
+    """Looks up ip at the service url, giving up after timeout seconds.
+    The source recorded is the service's scheme and host."""
+    response = urllib2.urlopen(url.format(ip), timeout=timeout)
     geo = json.load(response)
-    geo['source']='http://freegeoip.net'
+    parts = urlparse.urlsplit(url)
+    geo['source'] = '{}://{}'.format(parts.scheme, parts.netloc)
     return geo
+
+def rate_limiter(rate):
+    """Returns a function that blocks as needed so that, across all
+    threads calling it, calls return no more than rate times per second.
+    If rate is None, calls never block."""
+    lock = threading.Lock()
+    next_time = [time.time()]
+    def wait():
+        if not rate:
+            return
+        with lock:
+            now = time.time()
+            t = max(now, next_time[0])
+            next_time[0] = t + 1.0/rate
+        if t > now:
+            time.sleep(t - now)
+    return wait
+
+def get_geo_retry(ip, url=_geo_url, wait=rate_limiter(None), retries=3, backoff=1.0,
+                  timeout=_geo_timeout):
+    """Looks up ip, retrying failed (or timed out, or garbled) requests
+    with exponential backoff. Returns None if every attempt fails."""
+    for attempt in range(retries+1):
+        wait()
+        try:
+            with metrics.timer('geolocate.lookup'):
+                return get_geo(ip, url, timeout)
+        except (IOError, ValueError, httplib.HTTPException) as e:
+            if attempt == retries:
+                metrics.count('geolocate.failed')
+                sys.stderr.write('unable to locate {}: {}\n'.format(ip, e))
+                return None
+            time.sleep(backoff * 2**attempt)
+
+def resolve(ips, url=_geo_url, threads=8, rate=None, retries=3, backoff=1.0,
+            timeout=_geo_timeout):
+    """Yields the geo dict for each of the ips (in no particular order),
+    with at most threads lookups in flight and no more than rate lookups
+    started per second. Each request gives up after timeout seconds.
+    Addresses that can't be located are skipped."""
+    wait = rate_limiter(rate)
+    lookup = lambda ip: get_geo_retry(ip, url, wait, retries, backoff, timeout)
+    pool = ThreadPool(threads)
+    try:
+        for geo in pool.imap_unordered(lookup, ips):
+            if geo:
+                yield geo
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
     
-def column_value(k, entry):
-    if 'created' == k:
-        return 'now()'
-    else:
-        v = entry[k]
-        return u"'{0}'".format(str(v).replace("'","''")) if v else 'NULL'
+def _geo_row(geo, names):
+    return [geo.get(k) if geo.get(k) else None for k in names]
 
-def insert_geo(db, geo):
-    cur = db.cursor()
+def _insert_statement(names, nrows=1):
+    row = u'(' + u','.join(['%s'] * len(names) + ['now()']) + u')'
+    return (u'insert into geolocation.geo ('
+            + u','.join(names + ['created'])
+            + u') values '
+            + u','.join([row] * nrows))
+
+def insert_geo(db, geo, cur=None):
+    """Inserts a single geo dict, skipping (with a message) one that
+    can't be stored. Uses the given cursor, if any."""
+    names = [k for k in columns.keys() if 'created' != k]
+    own = cur is None
+    if own:
+        cur = db.cursor()
     try:
-        cur.execute(u'insert into geolocation.geo ('
-                    + u','.join(columns.keys())
-                    + u') values ('
-                    + u','.join([column_value(k, geo) for k in columns.keys()])
-                    + u')')
-    except UnicodeEncodeError as e:
-        print 'skipping', geo['ip'], '-', geo, ':', e
-    except pymysql.err.ProgrammingError as e:
+        cur.execute(_insert_statement(names), _geo_row(geo, names))
+    except (UnicodeEncodeError,) + database.statement_errors as e:
         print 'skipping', geo['ip'], '-', geo, ':', e
+    finally:
+        if own:
+            cur.close()
+
+def insert_geos(db, geos):
+    """Inserts the geo dicts as a single multi-row insert. If that
+    fails, falls back to inserting them one at a time so that only the
+    bad rows are skipped."""
+    names = [k for k in columns.keys() if 'created' != k]
+    cur = db.cursor()
+    try:
+        cur.execute(_insert_statement(names, len(geos)),
+                    [v for geo in geos for v in _geo_row(geo, names)])
+    except (UnicodeEncodeError,) + database.statement_errors:
+        for geo in geos:
+            insert_geo(db, geo, cur)
     finally:
         cur.close()
+    db.commit()
+    metrics.count('geolocate.inserted', len(geos))
 
-def get_missing_geo(db):
+def get_missing_ips(db):
     cur = db.cursor()
     try:
         cur.execute('select distinct s.client_addr from aspera_stats_collector.fasp_sessions as s '
                     + 'left join geolocation.geo as g on s.client_addr = g.ip '
                     + 'where g.ip is null')
-        for r in cur.fetchall():
-            if r[0]:
-                geo = get_geo(r[0])
-                insert_geo(db, geo)
+        return [r[0] for r in cur.fetchall() if r[0]]
     finally:
         cur.close()
 
+def get_missing_geo(db, batch=500, index=None, **kwargs):
+    """Locates all client addresses without geolocation entries,
+    inserting the results in batches of the given size. If an offline
+    geodb index is provided, it is used instead of the remote service;
+    otherwise lookups are concurrent (see resolve for kwargs). Returns
+    the number of addresses located."""
+    ips = get_missing_ips(db)
+    if index:
+        located = geodb.resolve(ips, index)
+    else:
+        located = resolve(ips, **kwargs)
+    geos = []
+    n = 0
+    for geo in located:
+        geos.append(geo)
+        n += 1
+        if len(geos) >= batch:
+            insert_geos(db, geos)
+            geos = []
+    if geos:
+        insert_geos(db, geos)
+    return n
+
+def lookup_options(config):
+    """Returns the configured keyword arguments for get_missing_geo:
+    the lookup tuning options and, for the geolite backend, the index."""
+    kwargs = {}
+    for k,convert in [('threads', int), ('rate', float), ('retries', int), ('url', str),
+                      ('timeout', float)]:
+        if config.has_option('geolocate', k):
+            kwargs[k] = convert(config.get('geolocate', k))
+
+    # backend is freegeoip (the default) or geolite, which reads the
+    # GeoLite City blocks and locations CSVs, and the optional MaxMind
+    # country and region code tables (geolite.countries and
+    # geolite.regions) for the country and region names, which are
+    # otherwise left empty. If geolite.index is set, the index is saved
+    # there when first built from the CSVs (and rebuilt when they
+    # change), and is read from there after that.
+    if config.has_option('geolocate', 'backend') and 'geolite' == config.get('geolocate', 'backend'):
+        get = lambda k: config.get('geolocate', k) if config.has_option('geolocate', k) else None
+        index_path, blocks, locations, countries, regions = [get('geolite.' + k) for k in [
+                'index', 'blocks', 'locations', 'countries', 'regions']]
+        if index_path and blocks and locations:
+            kwargs['index'] = geodb.index_for(index_path, blocks, locations, countries, regions)
+        elif index_path:
+            kwargs['index'] = geodb.load_index(index_path)
+        else:
+            kwargs['index'] = geodb.load_csv(blocks, locations, countries, regions)
+    return kwargs
+
 def main():
     config = ConfigParser.ConfigParser()
     config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
-    get_config = lambda k: config.get('statscollector',k)
 
-    host = get_config('mysql.host')
-    port = int(get_config('mysql.port'))
-    user = get_config('mysql.user')
-    passwd = get_config('mysql.password')
+    argparser = argparse.ArgumentParser(description='Geolocate Aspera client addresses.')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('geolocate', args.profile, args.metrics)
 
-    db = pymysql.connect(host=host,port=port,user=user,passwd=passwd)
+    kwargs = lookup_options(config)
+    pool = database.pool_from_config(config)
     try:
-        create_geo_table(db)
-        get_missing_geo(db)
+        database.call(pool, create_geo_table)
+        database.call(pool, get_missing_geo, **kwargs)
     finally:
-        db.close()
+        database.close_pool(pool)
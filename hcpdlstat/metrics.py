@@ -0,0 +1,105 @@
+# Pipeline instrumentation: counters, stage timers, and profiling
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import atexit, cProfile, json, os, socket, threading, time
+from collections import Counter
+from contextlib import contextmanager
+
+# Counters and timers are kept per process. A counter with the same
+# name as a timer counts the items handled in that stage, and the
+# report includes their rate.
+_lock = threading.Lock()
+_counters = Counter()
+_timers = {}            # name -> [calls, total seconds, max seconds]
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+def add_time(name, seconds, calls=1, longest=None):
+    with _lock:
+        t = _timers.setdefault(name, [0, 0.0, 0.0])
+        t[0] += calls
+        t[1] += seconds
+        t[2] = max(t[2], seconds if longest is None else longest)
+
+@contextmanager
+def timer(name):
+    """Times the enclosed block as a call of the named timer."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def snapshot():
+    """Returns the counters and timers, in a form that can be pickled
+    (to return from a worker process) and passed to merge."""
+    with _lock:
+        return {'counters': dict(_counters),
+                'timers': dict((k, list(v)) for k, v in _timers.iteritems())}
+
+def merge(snap):
+    """Adds the counters and timers from a snapshot."""
+    for k, n in snap['counters'].iteritems():
+        count(k, n)
+    for k, (calls, seconds, longest) in snap['timers'].iteritems():
+        add_time(k, seconds, calls, longest)
+
+def collected(fn, *args):
+    """Returns (fn(*args), snapshot) for just the metrics recorded by
+    the call. For worker processes, which inherit the parent's metrics."""
+    reset()
+    result = fn(*args)
+    return result, snapshot()
+
+def report():
+    """Returns the counters, and for each timer its calls, total and
+    longest seconds, and the rate of its counter if it has one."""
+    snap = snapshot()
+    timers = {}
+    for k, (calls, seconds, longest) in snap['timers'].iteritems():
+        timers[k] = {'calls': calls, 'seconds': seconds, 'max': longest}
+        if k in snap['counters'] and seconds:
+            timers[k]['rate'] = snap['counters'][k]/seconds
+    return {'counters': snap['counters'], 'timers': timers}
+
+def write_metrics(path, program):
+    """Appends the report for this run to the metrics file, as one JSON
+    object per line."""
+    entry = {'program': program, 'host': socket.gethostname(), 'pid': os.getpid(),
+             'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    entry.update(report())
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+def add_arguments(argparser):
+    argparser.add_argument('--profile', metavar='PATH',
+                           help='write cProfile output (pstats format) to PATH')
+    argparser.add_argument('--metrics', metavar='PATH',
+                           help='append stage timers and counters (JSON Lines) to PATH')
+
+def instrument(program, profile=None, metrics_path=None):
+    """Starts timing the run of the named program and, if a profile
+    path is given, profiling it. At exit the profile is written, and the
+    metrics are appended to metrics_path if it is given. Worker
+    processes aren't profiled, but their metrics are merged in."""
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    def finish():
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        add_time(program, time.time() - start)
+        if metrics_path:
+            write_metrics(metrics_path, program)
+    atexit.register(finish)
@@ -2,10 +2,12 @@
 # Copyright (c) 2013 Washington University School of Medicine
 # Author: Kevin A. Archie <karchie@wustl.edu>
 
-import argparse, datetime, fileinput, os, re, sys, ConfigParser
+import argparse, bz2, datetime, fileinput, gzip, hashlib, multiprocessing, os, re, sys, ConfigParser
 from collections import defaultdict, Counter
+from contextlib import contextmanager
 from pyparsing import Suppress, Word, alphanums, delimitedList, nums, printables, ParseException
-from bundles import g1, g5, g20, counted_resources
+from bundles import bundles, package_types, counted_resources, classify, memoized
+import eventstore, metrics, report, sketches, statscache
 
 def date():
     year = Word(nums, exact=4)
@@ -59,26 +61,58 @@ def resource_line():
              
 def logline():
     return package_line() | resource_line()
-                
+
+# Precompiled patterns for the two line shapes we actually see in the
+# log. These are deliberately stricter than the pyparsing grammar above
+# (single spaces, no optional whitespace around delimiters); anything
+# they don't recognize falls back to the full grammar.
+_line_prefix = r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d+) (\w+) downloading '
+_package_re = re.compile(_line_prefix +
+                         r'(\w+(?:,\w+)*) x \[([A-Za-z0-9]+(?:, ?[A-Za-z0-9]+)*)\] \((\d+) bytes\)')
+_resource_re = re.compile(_line_prefix +
+                          r'(\S+) from project (\w+), resource (\w+) \((\d+) bytes\)')
+_subject_sep = re.compile(r', ?')
+
+def fast_parse(line):
+    """Parses a package or resource line with the precompiled patterns,
+    returning a dict with the same result names as the pyparsing grammar,
+    or None if the line isn't one of the known shapes."""
+    m = _package_re.match(line)
+    if m:
+        g = m.groups()
+        return {'date': list(g[0:3]), 'time': list(g[3:7]), 'login': g[7],
+                'packages': g[8].split(','),
+                'subjects': _subject_sep.split(g[9]),
+                'bytes_requested': [g[10]]}
+    m = _resource_re.match(line)
+    if m:
+        g = m.groups()
+        return {'date': list(g[0:3]), 'time': list(g[3:7]), 'login': g[7],
+                'filename': g[8], 'project': g[9], 'resource': g[10],
+                'bytes_requested': [g[11]]}
+    return None
+
+def line_parser(fast=True):
+    """Returns a function that parses a single log line. If fast is
+    True, the precompiled patterns are tried first and the pyparsing
+    grammar is used only for lines they don't recognize."""
+    grammar = logline()
+    if not fast:
+        return grammar.parseString
+    def parse(line):
+        return fast_parse(line) or grammar.parseString(line)
+    return parse
+
 
 def handle_line_packages(stats, parse_results):
     subjects = set(parse_results['subjects'])
     packages = parse_results['packages']
-    if g1 == subjects:
-        group = 'g1'
-    elif g5 == subjects:
-        group = 'g5'
-    elif g20 == subjects:
-        group = 'g20'
-    else:
-        group = None
+    group, types = classify(packages, subjects)
     if group:
         stats[group] = stats[group] + 1
         stats[group + '_files'] = stats[group + '_files'] + len(packages)
-    for package in packages:
-        for type in ['unproc', 'preproc']:
-            if re.search(type, package):
-                stats[type] = stats[type] + len(subjects)
+    for type in types:
+        stats[type] = stats[type] + len(subjects)
     stats['files'] = stats['files'] + len(subjects) * len(packages)
     stats['bytes'] = stats['bytes'] + int(parse_results['bytes_requested'][0])
 
@@ -91,39 +125,227 @@ def handle_line_resource(stats, parse_results):
     stats['bytes'] = stats['bytes'] + int(parse_results['bytes_requested'][0])
     
 def handle_line(stats, parse_results):
+    sketches.hll_add(stats['logins'], parse_results['login'])
     if 'packages' in parse_results:
         handle_line_packages(stats, parse_results)
     else:
         handle_line_resource(stats, parse_results)
 
-def handle_lines(lines, stats):
-    parser = logline()
-    for line in lines:
-        try:
-            handle_line(stats, parser.parseString(line))
-        except ParseException as e:
-            print e.markInputline()
-            raise
+def count_resources(stats):
+    """Sets the counted_resources entries from the resources tree,
+    without adding empty entries to the tree for missing resources."""
     for k,v in counted_resources.items():
-        stats[k] = reduce(lambda e,k: e[k], v, stats['resources'])
+        stats[k] = reduce(lambda e,k: e.get(k, {}), v[:-1],
+                          stats['resources']).get(v[-1], 0)
+
+def parse_error(stats, e, errors, offset, line):
+    """Handles a line that can't be parsed. Without an errors function,
+    the line is shown and the exception raised; otherwise the line is
+    counted in stats and errors is called with its offset and text."""
+    metrics.count('packagelog.parse_errors')
+    if not errors:
+        print e.markInputline()
+        raise
+    stats['parse_errors'] = stats.get('parse_errors', 0) + 1
+    errors(offset, line)
 
-def init_stats():
+def quarantine(f, logfile, base=0):
+    """Returns an errors function (see parse_lines) that writes each bad
+    line to the open quarantine file f, as the log file name, the line's
+    byte offset in the log (plus base), and the line, separated by tabs.
+    Offsets in compressed logs are of the uncompressed text."""
+    def errors(offset, line):
+        f.write('{}\t{}\t{}'.format(logfile, base + offset,
+                                    line if line.endswith('\n') else line + '\n'))
+    return errors
+
+@contextmanager
+def quarantined(path, logfile, base=0):
+    """Yields the quarantine errors function for the log file, writing
+    to the quarantine file at path, or None if path is None. The file is
+    opened once, for appending and unbuffered, so that each line is one
+    write and lines from parallel workers don't interleave."""
+    if not path:
+        yield None
+        return
+    with open(path, 'ab', 0) as f:
+        yield quarantine(f, logfile, base)
+
+def parse_lines(lines, stats, fast=True, record=None, errors=None):
+    """Adds each of the lines to stats, without computing the
+    counted_resources entries. If provided, record is also called with
+    the parse results for each line. If errors is provided, lines that
+    can't be parsed are passed to it instead of stopping the parse (see
+    parse_error)."""
+    parse = line_parser(fast)
+    n = offset = 0
+    try:
+        for n, line in enumerate(lines, 1):
+            try:
+                parse_results = parse(line)
+                handle_line(stats, parse_results)
+                if record:
+                    record(parse_results)
+            except ParseException as e:
+                parse_error(stats, e, errors, offset, line)
+            offset += len(line)
+    finally:
+        metrics.count('packagelog.parse', n)
+
+def handle_lines(lines, stats, fast=True, record=None, errors=None):
+    parse_lines(lines, stats, fast, record, errors)
+    count_resources(stats)
+
+def _request_increments(packages, subjects):
+    scratch = dict.fromkeys(_count_keys, 0)
+    handle_line_packages(scratch, {'packages': packages.split(','),
+                                   'subjects': _subject_sep.split(subjects),
+                                   'bytes_requested': ['0']})
+    return [(k, v) for k, v in scratch.iteritems() if v]
+
+def request_increments(packages, subjects):
+    """Returns the list of (key, increment) for one request of the
+    comma-separated packages for the comma-separated subjects, not
+    counting bytes. Computed once by handle_line_packages for each
+    distinct request (see bundles.memoized) and reused for every batch."""
+    return memoized(('increments', packages, subjects),
+                    lambda: _request_increments(packages, subjects))
+
+def batches(lines, batchsize):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def parse_batches(lines, stats, fast=True, batchsize=1<<16, errors=None):
+    """Adds the lines to stats like parse_lines, but a batch at a time:
+    each batch is reduced to counts of distinct requests and resources,
+    and the stats are updated once per distinct value instead of once
+    per line."""
+    grammar = logline()
+    offset = 0
+    for batch in batches(lines, batchsize):
+        requests = Counter()
+        resources = Counter()
+        logins = set()
+        nbytes = 0
+        for line in batch:
+            line_offset = offset
+            offset += len(line)
+            m = fast and _package_re.match(line)
+            if m:
+                requests[(m.group(9), m.group(10))] += 1
+                logins.add(m.group(8))
+                nbytes += int(m.group(11))
+                continue
+            m = fast and _resource_re.match(line)
+            if m:
+                resources[(m.group(10), m.group(11), m.group(9))] += 1
+                logins.add(m.group(8))
+                nbytes += int(m.group(12))
+                continue
+            try:
+                r = grammar.parseString(line)
+            except ParseException as e:
+                parse_error(stats, e, errors, line_offset, line)
+                continue
+            logins.add(r['login'])
+            if 'packages' in r:
+                requests[(','.join(r['packages']), ','.join(r['subjects']))] += 1
+            else:
+                resources[(r['project'], r['resource'], r['filename'])] += 1
+            nbytes += int(r['bytes_requested'][0])
+        metrics.count('packagelog.parse', len(batch))
+        stats['bytes'] = stats['bytes'] + nbytes
+        for (packages, subjects), n in requests.iteritems():
+            for k, v in request_increments(packages, subjects):
+                stats[k] = stats[k] + v*n
+        for (p, r, f), n in resources.iteritems():
+            stats['resources'][p][r][f] += n
+        stats['files'] = stats['files'] + sum(resources.itervalues())
+        for login in logins:
+            sketches.hll_add(stats['logins'], login)
+
+def handle_batches(lines, stats, fast=True, batchsize=1<<16, errors=None):
+    parse_batches(lines, stats, fast, batchsize, errors)
+    count_resources(stats)
+
+def init_stats(precision=sketches.default_precision):
     s = {'date':'',
-         'g1': 0, 'g5': 0, 'g20': 0,
-         'g1_files': 0, 'g5_files': 0, 'g20_files': 0,
-         'files': 0, 'bytes': 0,
+         'files': 0, 'bytes': 0, 'parse_errors': 0,
          'resources': defaultdict(lambda: defaultdict(Counter)),
-         'unproc': 0, 'preproc': 0}
+         'logins': sketches.init_hll(precision)}
+    for k in _count_keys:
+        s[k] = 0
     for k in counted_resources:
         s[k] = 0
     return s
 
+# The stats entries that are simple counts, summed when merging.
+_count_keys = ([name for name, _ in bundles] +
+               [name + '_files' for name, _ in bundles] +
+               ['files', 'bytes'] + package_types)
+
+# The version of the stats format, for the stats cache: stats cached
+# with a different layout (format number) or different bundles, package
+# types, or counted resources are parsed again. The format number
+# changes with the structure of the stats.
+_stats_format = 2
+
+def _stats_version():
+    layout = ([(name, sorted(members)) for name, members in bundles],
+              package_types, sorted(counted_resources.items()))
+    return '{}-{}'.format(_stats_format, hashlib.sha1(repr(layout)).hexdigest()[:12])
+
+stats_version = _stats_version()
+
+def portable_stats(stats):
+    """Returns a copy of stats that can be pickled: the resources tree
+    is converted from nested defaultdicts to plain dicts of Counters."""
+    s = dict(stats)
+    s['resources'] = dict((p, dict((r, Counter(c)) for r,c in rmap.iteritems()))
+                          for p,rmap in stats['resources'].iteritems())
+    s['logins'] = sketches.hll_copy(stats['logins'])
+    return s
+
+def merge_stats(stats, other):
+    """Adds the counts and resources from other (which may be portable)
+    into stats. The counted_resources entries are not updated; call
+    count_resources after the last merge."""
+    for k in _count_keys:
+        stats[k] = stats[k] + other[k]
+    stats['parse_errors'] = stats.get('parse_errors', 0) + other.get('parse_errors', 0)
+    for p,rmap in other['resources'].iteritems():
+        for r,counter in rmap.iteritems():
+            stats['resources'][p][r].update(counter)
+    if 'logins' in other:
+        sketches.hll_merge(stats['logins'], other['logins'])
+    return stats
+
+def distinct_logins(stats_list):
+    """Returns the estimated number of distinct logins over all of the
+    stats, by merging their login sketches."""
+    h = None
+    for stats in stats_list:
+        if h is None:
+            h = sketches.hll_copy(stats['logins'])
+        else:
+            sketches.hll_merge(h, stats['logins'])
+    return sketches.hll_count(h) if h else 0
+
 def display_stats(stats):
     print stats['files'], 'files,', stats['bytes'], 'bytes'
+    print 'About', sketches.hll_count(stats['logins']), 'distinct logins'
     print stats['unproc'], 'unprocessed,', stats['preproc'], 'preprocessed'
     print 'Group of  1:', stats['g1'], 'request =', stats['g1_files'], 'files'
     print 'Group of  5:', stats['g5'], 'request =', stats['g5_files'], 'files'
     print 'Group of 20:', stats['g20'], 'request =', stats['g20_files'], 'files'
+    if stats.get('parse_errors'):
+        print stats['parse_errors'], 'lines could not be parsed'
     if stats['resources']:
         print 'Resources:'
     for project,rmap in stats['resources'].iteritems():
@@ -132,15 +354,8 @@ def display_stats(stats):
                 print ' ', project, resource, f, count
 
 def array_stats(stats):
-    return [str(stats[f]) if f else ''
-            for f in ['date',
-                      'g1', 'g1_files',
-                      'g5', 'g5_files',
-                      'g20', 'g20_files',
-                      None,
-                      'preproc', None,
-                      'unproc', None]]
-    
+    return report.csv_fields('packages', stats)
+
 def build_log_path(stats, dir, name, s):
     """Builds the full pathname of a log file from the log directory,
     the log basename, and the date (datetime.date, 'today', 'yesterday',
@@ -157,28 +372,291 @@ def build_log_path(stats, dir, name, s):
     stats['date'] = date
     return os.path.join(dir, name + '.' + date.isoformat())
 
-def get_stats(logdir, logname, date):
+# Rotated logs may have been compressed; these are the suffixes we
+# look for, and how to open each.
+_log_openers = [('', open), ('.gz', gzip.open), ('.bz2', bz2.BZ2File)]
+
+def find_log(path):
+    """Returns the path of the log file, or of its compressed form if
+    only that exists. Returns path unchanged if no form exists."""
+    for suffix, _ in _log_openers:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+def open_log(path):
+    """Opens a log file for reading, decompressing if the name ends in
+    .gz or .bz2."""
+    for suffix, opener in reversed(_log_openers):
+        if path.endswith(suffix):
+            return opener(path, 'rb')
+
+def is_compressed(path):
+    return any(path.endswith(suffix) for suffix, _ in _log_openers if suffix)
+
+def iter_lines(f, bufsize=1<<20, limit=None):
+    """Yields the lines from file-like object f, reading bufsize bytes
+    at a time so that memory use doesn't depend on the file size. If
+    limit is provided, at most that many bytes are read."""
+    tail = ''
+    while limit is None or limit > 0:
+        chunk = f.read(bufsize if limit is None else min(bufsize, limit))
+        if not chunk:
+            break
+        if limit is not None:
+            limit -= len(chunk)
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+def read_log(path, bufsize=1<<20):
+    """Yields the lines from the named (possibly compressed) log file."""
+    with open_log(path) as f:
+        for line in iter_lines(f, bufsize):
+            yield line
+
+def split_log(path, n):
+    """Splits the named (uncompressed) log file into at most n byte
+    ranges (start, end), each beginning at the start of a line."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n):
+            offset = size*i/n
+            if offset <= bounds[-1]:
+                continue
+            # finish the line containing the byte before offset
+            f.seek(offset-1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+def _parse_range(args):
+    path, start, end, fast, quarantine_path = args
     stats = init_stats()
-    logfile = build_log_path(stats, logdir, logname, date)
+    with open(path, 'rb') as f, quarantined(quarantine_path, path, start) as errors:
+        f.seek(start)
+        parse_batches(iter_lines(f, limit=end-start), stats, fast, errors=errors)
+    return portable_stats(stats)
+
+def _parse_range_worker(args):
+    return metrics.collected(_parse_range, args)
+
+def handle_file(path, stats, processes=1, fast=True, record=None, quarantine_path=None):
+    """Adds the named log file to stats. If processes > 1 and the log is
+    uncompressed, the file is split into line-aligned byte ranges that
+    are parsed in a pool of worker processes and merged; the
+    counted_resources entries are computed once, after the merge.
+    Records (see parse_lines) are only collected by serial parsing. If
+    quarantine_path is provided, lines that can't be parsed are written
+    there (see quarantine) instead of stopping the parse."""
+    with metrics.timer('packagelog.parse'):
+        if record or processes <= 1 or is_compressed(path):
+            with quarantined(quarantine_path, path) as errors:
+                if record:
+                    handle_lines(read_log(path), stats, fast, record, errors)
+                else:
+                    handle_batches(read_log(path), stats, fast, errors=errors)
+            return stats
+        ranges = [(path, start, end, fast, quarantine_path)
+                  for start, end in split_log(path, processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for partial, snap in pool.imap_unordered(_parse_range_worker, ranges):
+                merge_stats(stats, partial)
+                metrics.merge(snap)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        count_resources(stats)
+        return stats
+
+def get_stats(logdir, logname, date, processes=1, cachedir=None, cachesize=None,
+              eventdir=None, bucket=None, topk=None,
+              precision=sketches.default_precision, quarantine_path=None):
+    """Returns the stats for the log from the given date. If cachedir is
+    provided, stats for rotated logs are looked up in and stored to the
+    on-disk cache there (limited to cachesize bytes, if provided). If
+    eventdir is provided, the parsed records are also written to the
+    event store there. If bucket (minutes) or topk is provided, the
+    stats include a timeseries entry (see init_timeseries). precision
+    is that of the distinct login sketch. If quarantine_path is
+    provided, unparseable lines are quarantined there (see
+    handle_file)."""
+    stats = init_stats(precision)
+    logfile = find_log(build_log_path(stats, logdir, logname, date))
+    # the live log is still growing, so isn't worth caching
+    use_cache = cachedir and 'today' != date and os.path.exists(logfile)
+    recorders = []
+    if eventdir:
+        table = eventstore.new_table()
+        recorders.append(lambda r: eventstore.add_record(table, r))
+    if bucket or topk:
+        stats['timeseries'] = init_timeseries(bucket or 60, topk or 10)
+        recorders.append(lambda r: record_timeseries(stats['timeseries'], r))
+    record = combine_recorders(recorders)
+    if use_cache:
+        # cached stats are no help if the parsed records are needed
+        need_records = ('timeseries' in stats or
+                        (eventdir and not eventstore.has_partition(eventdir, stats['date'])))
+        if not need_records:
+            cached = statscache.lookup(cachedir, logfile, stats_version)
+            metrics.count('statscache.hit' if cached else 'statscache.miss')
+            if cached:
+                merge_stats(stats, cached)
+                count_resources(stats)
+                return stats
+        fp = statscache.fingerprint(logfile)
     try:
-        with open(logfile) as logf:
-            handle_lines(logf.readlines(), stats)
-    except IOError as e:
+        handle_file(logfile, stats, processes, record=record,
+                    quarantine_path=quarantine_path)
+    except (IOError, OSError) as e:
         # no logfile probably just means no downloads for that date;
         # that's the initial value of the stats dict anyway.
         if os.path.exists(logfile):
             raise e         # file exists but something went wrong
         else:
             sys.stderr.write('No logfile for {} - assuming zero downloads\n'.format(date))
+    else:
+        if use_cache:
+            statscache.store(cachedir, fp, portable_stats(stats), cachesize, stats_version)
+    if eventdir:
+        with metrics.timer('eventstore.write'):
+            eventstore.write_partition(eventdir, stats['date'], table)
+        metrics.count('eventstore.write', len(table['columns']['time']))
     return stats
 
 
+def init_timeseries(width=60, k=10):
+    """Returns an empty time series: request and byte counts in buckets
+    of width minutes, and a sketch of the k logins requesting the most
+    bytes (see sketches.init_top)."""
+    return {'width': width, 'buckets': {}, 'top': sketches.init_top(k)}
+
+def record_timeseries(ts, parse_results):
+    t = parse_results['time']
+    bucket = (int(t[0])*60 + int(t[1])) // ts['width']
+    nbytes = int(parse_results['bytes_requested'][0])
+    counts = ts['buckets'].setdefault(bucket, [0, 0])
+    counts[0] += 1
+    counts[1] += nbytes
+    sketches.top_add(ts['top'], parse_results['login'], nbytes)
+
+def combine_recorders(recorders):
+    """Returns a function that calls each of the recorders, or None if
+    there are none."""
+    if not recorders:
+        return None
+    elif 1 == len(recorders):
+        return recorders[0]
+    def record(parse_results):
+        for r in recorders:
+            r(parse_results)
+    return record
+
+def display_timeseries(ts):
+    print 'Requests per {} minutes:'.format(ts['width'])
+    for bucket, (requests, nbytes) in sorted(ts['buckets'].iteritems()):
+        minutes = bucket * ts['width']
+        print '  {:02d}:{:02d}'.format(minutes // 60, minutes % 60), requests, 'requests,', nbytes, 'bytes'
+    print 'Top logins by bytes:'
+    for login, total, error in sketches.top_items(ts['top']):
+        print ' ', login, total, 'bytes' + (' (+/- {})'.format(error) if error else '')
+
+def _get_portable_stats(args):
+    args, kwargs = args
+    return portable_stats(get_stats(*args, **kwargs))
+
+def _get_portable_stats_worker(args):
+    return metrics.collected(_get_portable_stats, args)
+
+def iter_stats(logdir, logname, dates, processes=1, **kwargs):
+    """Yields the (portable) stats for each of the given dates, in
+    order. If processes > 1, the logs are parsed in a pool of that many
+    worker processes. Any other keyword arguments are passed to
+    get_stats."""
+    args = [((logdir, logname, date), kwargs) for date in dates]
+    if processes <= 1:
+        for a in args:
+            yield _get_portable_stats(a)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for stats, snap in pool.imap(_get_portable_stats_worker, args):
+            metrics.merge(snap)
+            yield stats
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def load_checkpoint(path):
+    """Returns the checkpoint stored at path, or None."""
+    return statscache.read_pickle(path)
+
+def save_checkpoint(path, checkpoint):
+    statscache.write_pickle(path, checkpoint)
+
+def tail_log(logdir, logname, checkpoint_path, fast=True, quarantine_path=None,
+             precision=sketches.default_precision):
+    """Returns the stats for today's live log, parsing only the complete
+    lines appended since the last call. The date, the log's inode, the
+    offset parsed so far, and the partial stats are kept in the
+    checkpoint file; if the log has been rotated (a new day, a different
+    inode, or shorter than the offset), parsing starts over from the
+    beginning. If the log doesn't exist yet (after rotation, before the
+    day's first request), the stats are empty. If quarantine_path is
+    provided, lines that can't be parsed are written there (see
+    quarantine) and passed over, instead of stopping every call at the
+    same line. precision is that of the distinct login sketch."""
+    stats = init_stats(precision)
+    logfile = build_log_path(stats, logdir, logname, 'today')
+    try:
+        st = os.stat(logfile)
+    except OSError:
+        count_resources(stats)
+        save_checkpoint(checkpoint_path, {'date': stats['date'], 'inode': None, 'offset': 0,
+                                          'stats': portable_stats(stats)})
+        return stats
+    checkpoint = load_checkpoint(checkpoint_path)
+    if (checkpoint and checkpoint.get('date') == stats['date']
+        and checkpoint['inode'] == st.st_ino and checkpoint['offset'] <= st.st_size):
+        merge_stats(stats, checkpoint['stats'])
+        offset = checkpoint['offset']
+    else:
+        offset = 0
+    parsed = [offset]
+    def complete_lines(f):
+        for line in iter_lines(f, limit=st.st_size-offset):
+            if not line.endswith('\n'):
+                break   # still being written; pick it up next time
+            yield line
+            parsed[0] += len(line)
+    with open(logfile, 'rb') as f, quarantined(quarantine_path, logfile, offset) as errors:
+        f.seek(offset)
+        parse_lines(complete_lines(f), stats, fast, errors=errors)
+    count_resources(stats)
+    save_checkpoint(checkpoint_path, {'date': stats['date'],
+                                      'inode': st.st_ino,
+                                      'offset': parsed[0],
+                                      'stats': portable_stats(stats)})
+    return stats
 
 def main():
     config = ConfigParser.ConfigParser()
     config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
     get_config = lambda k: config.get('packagelog',k)
-    
+    precision = sketches.precision_from_config(config)
+    stats = init_stats(precision)
+
     argparser = argparse.ArgumentParser(description='Extract statistics from XNAT package request log.')
     argparser.add_argument('-d', '--date',
                            help='specify the log date (today, yesterday, or yyyy-mm-dd)',
@@ -191,18 +669,55 @@ def main():
     argparser.add_argument('-c', '--csv',
                            help='produce CSV-formatted output',
                            action='store_true')
+    argparser.add_argument('-o', '--output',
+                           help='write the stats to PATH (.csv, .jsonl, or .db; a .db store must already have the day, whose package columns are updated)',
+                           metavar='PATH')
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of processes for parsing a single log file')
+    argparser.add_argument('-b', '--bucket', type=int,
+                           help='also count requests in time buckets of this many minutes',
+                           metavar='MINUTES')
+    argparser.add_argument('-k', '--top', type=int,
+                           help='also report the top K logins by bytes requested',
+                           metavar='K')
+    argparser.add_argument('-t', '--tail',
+                           help='incrementally parse today\'s log, keeping state in CHECKPOINT',
+                           metavar='CHECKPOINT')
+    argparser.add_argument('-q', '--quarantine',
+                           help='write unparseable lines to PATH and keep going, instead of stopping',
+                           metavar='PATH')
+    metrics.add_arguments(argparser)
     argparser.add_argument('logfiles', nargs='*',
                            metavar='[LOG-FILE-PATH ...]')
     args = argparser.parse_args()
-    if args.logfile:
-        with open(args.logfile) as f:
-            lines = f.readlines()
+    if args.output and 'sqlite' == report.sink_for(args.output) and not (args.logfile or args.tail):
+        argparser.error('the stats store is keyed by date, so writing to it needs -d/--date or -t/--tail')
+    if args.tail and (args.bucket or args.top):
+        argparser.error('-b/--bucket and -k/--top can\'t be used with -t/--tail, which checkpoints only the day\'s stats')
+    metrics.instrument('packagelog', args.profile, args.metrics)
+    record = None
+    if args.bucket or args.top:
+        stats['timeseries'] = init_timeseries(args.bucket or 60, args.top or 10)
+        record = lambda r: record_timeseries(stats['timeseries'], r)
+    if args.tail:
+        stats = tail_log(get_config('logdir'), get_config('logname'), args.tail,
+                         quarantine_path=args.quarantine, precision=precision)
+    elif args.logfile:
+        handle_file(find_log(args.logfile), stats, args.jobs, record=record,
+                    quarantine_path=args.quarantine)
+    elif 1 == len(args.logfiles):
+        handle_file(args.logfiles[0], stats, args.jobs, record=record,
+                    quarantine_path=args.quarantine)
     else:
-        lines = fileinput.input(files=args.logfiles)
-
-    stats = init_stats()
-    handle_lines(lines, stats)
-    if args.csv:
+        with quarantined(args.quarantine, '-') as errors:
+            handle_lines(fileinput.input(files=args.logfiles,
+                                         openhook=fileinput.hook_compressed),
+                         stats, record=record, errors=errors)
+    if args.output:
+        report.write_rows(args.output, 'packages', [stats])
+    elif args.csv:
         print ','.join(array_stats(stats))
     else:
         display_stats(stats)
+        if 'timeseries' in stats:
+            display_timeseries(stats['timeseries'])
@@ -0,0 +1,219 @@
+# Range queries over the per-day package and Aspera stats
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import argparse, datetime, json, os, sys, ConfigParser
+from collections import OrderedDict
+from bundles import bundles, package_types, counted_resources
+import asperastatscollector, database, metrics, packagelog, report, sketches
+from asperastatscollector import as_date
+
+# The package stats for each complete day are kept in the report store,
+# one row per day, so that totals over any range are a single grouped
+# query. Days missing from the store are parsed (in parallel) the first
+# time they're asked for. The distinct login sketch is kept too, but
+# merging sketches is much slower than summing, so distinct counts are
+# only estimated on request.
+day_columns = ([name for name, _ in bundles] + [name + '_files' for name, _ in bundles]
+               + ['files', 'bytes'] + package_types + sorted(counted_resources)
+               + ['parse_errors'])
+
+_days_table = 'package_days'
+
+# SQLite expressions for the first date of the period containing date:
+# weeks start on Monday.
+_period_sql = {'day': 'date',
+               'week': "date(date, '-6 days', 'weekday 1')",
+               'month': "substr(date, 1, 7) || '-01'"}
+
+def period_of(date, by='day'):
+    """Returns the first date of the day, week, or month containing date."""
+    if 'week' == by:
+        return date - datetime.timedelta(days=date.weekday())
+    elif 'month' == by:
+        return date.replace(day=1)
+    return date
+
+def next_period(first, by='day'):
+    """Returns the first date of the period after the one starting at first."""
+    if 'month' == by:
+        return (first + datetime.timedelta(days=31)).replace(day=1)
+    return first + datetime.timedelta(days={'day': 1, 'week': 7}[by])
+
+def iter_dates(start, end):
+    date = start
+    while date < end:
+        yield date
+        date += datetime.timedelta(days=1)
+
+def create_days_table(store):
+    store.execute('create table if not exists {} (date text not null primary key, '.format(_days_table)
+                  + ','.join('{} integer'.format(c) for c in day_columns)
+                  + ', logins text)')
+
+def save_days(store, stats_list):
+    """Adds the (portable) package stats for each day to the store,
+    replacing any already there, in a single transaction."""
+    names = ['date'] + day_columns + ['logins']
+    with store:
+        store.executemany('insert or replace into {} ({}) values ({})'.format(
+                _days_table, ','.join(names), ','.join(['?'] * len(names))),
+                          ([s['date'].isoformat()] + [s.get(k, 0) for k in day_columns]
+                           + [sketches.hll_dumps(s['logins'])] for s in stats_list))
+
+def stored_dates(store, start, end):
+    """Returns the set of dates in [start, end) with stats in the store."""
+    return set(as_date(d) for d, in store.execute(
+            'select date from {} where date >= ? and date < ?'.format(_days_table),
+            [start.isoformat(), end.isoformat()]))
+
+def fill_days(store, logdir, logname, start, end, processes=1, **kwargs):
+    """Parses the package logs for the days in [start, end) that have a
+    log but aren't yet in the store, and stores their stats. Days
+    without a log have no downloads, and aren't stored in case the log
+    turns up later. Logs are parsed in a pool of processes; any other
+    keyword arguments are passed to get_stats. Returns the number of
+    days parsed."""
+    end = min(end, datetime.date.today())     # today's log is incomplete
+    stored = stored_dates(store, start, end)
+    missing = [d for d in iter_dates(start, end) if d not in stored and os.path.exists(
+            packagelog.find_log(packagelog.build_log_path({}, logdir, logname, d)))]
+    batch = []
+    for stats in packagelog.iter_stats(logdir, logname, missing, processes, **kwargs):
+        batch.append(stats)
+        if len(batch) >= 100:
+            save_days(store, batch)
+            batch = []
+    save_days(store, batch)
+    metrics.count('query.parsed_days', len(missing))
+    return len(missing)
+
+def package_totals(store, start, end, by='day', distinct=False):
+    """Returns an OrderedDict mapping the first date of each period
+    (day, week, or month) with stats in [start, end) to the totals of
+    the stored package stats over the days of the period in the range.
+    If distinct is set, the totals include the estimated number of
+    distinct logins."""
+    query = 'select {} as period, {} from {} where date >= ? and date < ? group by period order by period'.format(
+        _period_sql[by], ','.join('sum({})'.format(c) for c in day_columns), _days_table)
+    totals = OrderedDict()
+    with metrics.timer('query.packages'):
+        for row in store.execute(query, [start.isoformat(), end.isoformat()]):
+            totals[as_date(row[0])] = dict(zip(day_columns, row[1:]))
+        if distinct:
+            logins = {}
+            for d, s in store.execute('select date, logins from {} where date >= ? and date < ?'.format(
+                    _days_table), [start.isoformat(), end.isoformat()]):
+                h = sketches.hll_loads(s)
+                key = period_of(as_date(d), by)
+                if key in logins:
+                    sketches.hll_merge(logins[key], h)
+                else:
+                    logins[key] = h
+            for key, h in logins.iteritems():
+                totals[key]['logins'] = sketches.hll_count(h)
+    return totals
+
+def aspera_totals(db, start, end, by='day', distinct=False):
+    """Returns an OrderedDict mapping the first date of each period in
+    [start, end) to the totals of the Aspera rollup stats over the days
+    of the period in the range. Distinct user counts can't be summed, so
+    for periods longer than a day they are estimated from the rollup
+    sketches if distinct is set, and are otherwise None."""
+    columns = asperastatscollector.rollup_columns()
+    totals = OrderedDict()
+    with metrics.timer('query.aspera'):
+        days = asperastatscollector.get_rollup_stats(db, start, end)
+        for date in sorted(days):
+            t = totals.setdefault(period_of(date, by), dict.fromkeys(columns, 0))
+            for k in columns:
+                t[k] += days[date][k]
+        if 'day' != by:
+            for first, t in totals.iteritems():
+                for k in columns:
+                    if k.endswith('_users'):
+                        t[k] = (asperastatscollector.get_distinct_users(
+                                db, max(first, start), min(end, next_period(first, by)),
+                                k[:-len('_users')]) if distinct else None)
+    return totals
+
+def query(store, start, end, by='day', db=None, distinct=False):
+    """Returns a list of (first date, totals) for each period in [start,
+    end), with the stored package stats and, if db is provided, the
+    Aspera rollup stats. Periods without package stats have zero
+    counts."""
+    packages = package_totals(store, start, end, by, distinct)
+    aspera = aspera_totals(db, start, end, by, distinct) if db else {}
+    periods = []
+    for first in sorted(set(period_of(d, by) for d in iter_dates(start, end))):
+        totals = packages.get(first) or dict.fromkeys(day_columns + (['logins'] if distinct else []), 0)
+        totals.update(aspera.get(first, {}))
+        periods.append((first, totals))
+    return periods
+
+def main():
+    config = ConfigParser.ConfigParser()
+    config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
+    get = lambda s, k, default=None: config.get(s, k) if config.has_option(s, k) else default
+    to_date = lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+    argparser = argparse.ArgumentParser(description='Report download totals over a range of dates.')
+    argparser.add_argument('--from', dest='start', type=to_date, required=True,
+                           help='first date (yyyy-mm-dd)')
+    argparser.add_argument('--to', dest='end', type=to_date,
+                           help='last date (yyyy-mm-dd), inclusive; default yesterday')
+    argparser.add_argument('-g', '--group-by', default='day', choices=['day', 'week', 'month'],
+                           help='report totals for each day, week (from Monday), or month')
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of processes for parsing package logs missing from the store')
+    argparser.add_argument('--store', default=get('reporting', 'store'),
+                           help='daily stats store (SQLite) holding the per-day stats')
+    argparser.add_argument('-u', '--distinct', action='store_true',
+                           help='also estimate distinct logins and users for each period (slower for long ranges)')
+    argparser.add_argument('-P', '--packages-only', action='store_true',
+                           help='report only package log stats, without querying the Aspera database')
+    argparser.add_argument('--json', action='store_true',
+                           help='write JSON Lines instead of CSV')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('query_dl_stats', args.profile, args.metrics)
+
+    start = args.start
+    end = (args.end or datetime.date.today() - datetime.timedelta(days=1)) + datetime.timedelta(days=1)
+    kwargs = {'cachedir': get('packagelog', 'cachedir'),
+              'precision': sketches.precision_from_config(config),
+              'quarantine_path': get('packagelog', 'quarantine')}
+    if get('packagelog', 'cache.maxsize'):
+        kwargs['cachesize'] = int(get('packagelog', 'cache.maxsize'))
+
+    if not args.store:
+        sys.stderr.write('No store configured; per-day stats will not be kept\n')
+    store = report.open_store(args.store or ':memory:')
+    create_days_table(store)
+    fill_days(store, config.get('packagelog', 'logdir'), config.get('packagelog', 'logname'),
+              start, end, args.jobs, **kwargs)
+    pool = None if args.packages_only else database.pool_from_config(config)
+    try:
+        if pool:
+            database.call(pool, asperastatscollector.refresh_rollup, kwargs['precision'])
+            periods = database.call(pool, lambda db: query(store, start, end, args.group_by,
+                                                           db, args.distinct))
+        else:
+            periods = query(store, start, end, args.group_by, distinct=args.distinct)
+    finally:
+        if pool:
+            database.close_pool(pool)
+        store.close()
+
+    columns = day_columns + (['logins'] if args.distinct else [])
+    if pool:
+        columns += asperastatscollector.rollup_columns()
+    if args.json:
+        for first, totals in periods:
+            print json.dumps(OrderedDict([('period', first.isoformat())] +
+                                         [(c, totals.get(c)) for c in columns]))
+    else:
+        print ','.join(['period'] + columns)
+        for first, totals in periods:
+            print ','.join([first.isoformat()] + ['' if totals.get(c) is None else str(totals[c])
+                                                  for c in columns])
@@ -0,0 +1,186 @@
+# Reconciliation of XNAT package requests with Aspera file transfers
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import argparse, datetime, os, ConfigParser
+from bisect import bisect_right
+from itertools import izip
+import database, eventstore, metrics
+from bundles import bundle_of
+
+def expected_files(packages, subjects):
+    """Returns the names of the archive files that satisfy a request for
+    the packages for the subjects: <subject>_<package>.zip for each."""
+    return ['{}_{}.zip'.format(s, p) for s in subjects for p in packages]
+
+def iter_requests(eventdir, start, end):
+    """Yields a request dict (time, login, bundle, files, bytes) for
+    each package or resource request in the event store over the dates
+    in [start, end). bundle is the subject bundle name, 'resource' for
+    resource requests, or None."""
+    for date, p in eventstore.scan(eventdir, start, end):
+        midnight = datetime.datetime.combine(date, datetime.time())
+        columns, strings = p['columns'], p['strings']
+        for ms, login, packages, subjects, nbytes, filename in izip(
+            columns['time'], columns['login'], columns['packages'],
+            columns['subjects'], columns['bytes'], columns['filename']):
+            if packages:
+                subjects = strings['subjects'][subjects].split(',')
+                files = expected_files(strings['packages'][packages].split(','), subjects)
+                bundle = bundle_of(subjects)
+            else:
+                files = [strings['filename'][filename]]
+                bundle = 'resource'
+            yield {'time': midnight + datetime.timedelta(milliseconds=ms),
+                   'login': strings['login'][login], 'bundle': bundle,
+                   'files': files, 'bytes': nbytes}
+
+def as_datetime(t):
+    if isinstance(t, datetime.datetime):
+        return t
+    return datetime.datetime.strptime(str(t)[:19], '%Y-%m-%d %H:%M:%S')
+
+def get_transfers(db, start, end):
+    """Returns (created_at, file name, bytes written, status) for each
+    fasp_files row created in [start, end), in time order."""
+    cur = db.cursor()
+    try:
+        cur.execute('select created_at, file_fullpath, bytes_written, status'
+                    ' from aspera_stats_collector.fasp_files'
+                    ' where created_at >= %s and created_at < %s order by created_at',
+                    [start, end])
+        return [(as_datetime(t), os.path.basename(path or ''), int(nbytes or 0), status)
+                for t, path, nbytes, status in cur.fetchall()]
+    finally:
+        cur.close()
+
+# The Aspera tables don't record the XNAT login behind a transfer, so
+# transfers can only be matched to requests by file name and time. When
+# more than one login requested the file within the window, the match
+# is ambiguous: it still counts toward the request's bundle, but isn't
+# credited to its login.
+
+def build_index(requests):
+    """Returns a dict mapping each requested file name to three parallel
+    lists: the request times (sorted), request indices, and logins."""
+    entries = {}
+    for i, r in enumerate(requests):
+        for f in r['files']:
+            entries.setdefault(f, []).append((r['time'], i, r.get('login')))
+    index = {}
+    for f, e in entries.iteritems():
+        e.sort()
+        index[f] = ([t for t, _, _ in e], [i for _, i, _ in e], [l for _, _, l in e])
+    return index
+
+def match(index, transfers, window):
+    """Yields (request index, transfer, ambiguous) for each transfer of a
+    requested file, matched to the latest request for that file made no
+    more than window before the transfer. ambiguous is True if requests
+    by other logins were also in the window. Unmatched transfers have
+    index None."""
+    for transfer in transfers:
+        i, ambiguous = None, False
+        e = index.get(transfer[1])
+        if e:
+            times, ids, logins = e
+            j = bisect_right(times, transfer[0]) - 1
+            if j >= 0 and transfer[0] - times[j] <= window:
+                i = ids[j]
+                k = j - 1
+                while k >= 0 and transfer[0] - times[k] <= window and not ambiguous:
+                    ambiguous = logins[k] != logins[j]
+                    k -= 1
+        yield i, transfer, ambiguous
+
+def reconcile(requests, transfers, window=datetime.timedelta(hours=24)):
+    """Matches the transfers to the requests, adding to each request
+    dict the delivered files and bytes (for each file, the largest bytes
+    written by a completed transfer), and the attributed files and bytes,
+    delivered by unambiguous matches only. Returns the number of
+    transfers that match no request."""
+    delivered = [{} for _ in requests]
+    attributed = [{} for _ in requests]
+    unmatched = ambiguous_matches = 0
+    for i, (t, f, nbytes, status), ambiguous in match(build_index(requests), transfers, window):
+        if i is None:
+            unmatched += 1
+            continue
+        ambiguous_matches += ambiguous
+        if 'completed' == status:
+            delivered[i][f] = max(delivered[i].get(f, 0), nbytes)
+            if not ambiguous:
+                attributed[i][f] = max(attributed[i].get(f, 0), nbytes)
+    for r, d, a in izip(requests, delivered, attributed):
+        r['delivered_files'] = len(d)
+        r['delivered_bytes'] = sum(d.itervalues())
+        r['attributed_files'] = len(a)
+        r['attributed_bytes'] = sum(a.itervalues())
+    metrics.count('reconcile.matched', len(transfers) - unmatched)
+    metrics.count('reconcile.unmatched', unmatched)
+    metrics.count('reconcile.ambiguous', ambiguous_matches)
+    return unmatched
+
+def summarize(requests, key):
+    """Returns a dict mapping each value of the request key ('bundle' or
+    'login') to the totals of the reconciled requests, with the
+    completion ratios by files and by bytes. By login, only the
+    attributed deliveries are counted (see reconcile)."""
+    delivered = 'attributed' if 'login' == key else 'delivered'
+    totals = {}
+    for r in requests:
+        t = totals.setdefault(r[key], {'requests': 0, 'files': 0, 'bytes': 0,
+                                       'delivered_files': 0, 'delivered_bytes': 0})
+        t['requests'] += 1
+        t['files'] += len(r['files'])
+        t['bytes'] += r['bytes']
+        t['delivered_files'] += r[delivered + '_files']
+        t['delivered_bytes'] += r[delivered + '_bytes']
+    for t in totals.itervalues():
+        t['file_completion'] = float(t['delivered_files'])/t['files'] if t['files'] else None
+        t['byte_completion'] = float(t['delivered_bytes'])/t['bytes'] if t['bytes'] else None
+    return totals
+
+def reconcile_range(db, eventdir, start, end, window=datetime.timedelta(hours=24)):
+    """Returns the reconciled requests over the dates in [start, end),
+    and the number of unmatched transfers. Transfers are taken up to
+    window past the end, to catch those for late requests."""
+    requests = list(iter_requests(eventdir, start, end))
+    transfers = get_transfers(db, datetime.datetime.combine(start, datetime.time()),
+                              datetime.datetime.combine(end, datetime.time()) + window)
+    return requests, reconcile(requests, transfers, window)
+
+_summary_columns = ['requests', 'files', 'delivered_files', 'file_completion',
+                    'bytes', 'delivered_bytes', 'byte_completion']
+
+def main():
+    config = ConfigParser.ConfigParser()
+    config.read(['site.cfg', os.path.expanduser('~/.hcpdlstat.cfg')])
+    to_date = lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+    argparser = argparse.ArgumentParser(description='Reconcile package requests with Aspera transfers.')
+    argparser.add_argument('--from', dest='start', type=to_date, required=True,
+                           help='first date (yyyy-mm-dd)')
+    argparser.add_argument('--to', dest='end', type=to_date, required=True,
+                           help='last date (yyyy-mm-dd), inclusive')
+    argparser.add_argument('-b', '--by', default='bundle', choices=['bundle', 'login'],
+                           help='summarize completion by bundle or by user (by user, transfers of files'
+                           ' also requested by others in the window are left out)')
+    argparser.add_argument('-w', '--window', type=float, default=24,
+                           help='hours after a request in which its transfers are matched')
+    metrics.add_arguments(argparser)
+    args = argparser.parse_args()
+    metrics.instrument('reconcile_dl_stats', args.profile, args.metrics)
+
+    pool = database.pool_from_config(config)
+    try:
+        requests, unmatched = database.call(pool, reconcile_range,
+                                            config.get('packagelog', 'eventdir'),
+                                            args.start, args.end + datetime.timedelta(days=1),
+                                            datetime.timedelta(hours=args.window))
+    finally:
+        database.close_pool(pool)
+    print ','.join([args.by] + _summary_columns)
+    for k, t in sorted(summarize(requests, args.by).iteritems()):
+        print ','.join([str(k or '')] + ['' if t[c] is None else str(t[c]) for c in _summary_columns])
+    print 'unmatched transfers,{}'.format(unmatched)
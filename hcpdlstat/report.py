@@ -0,0 +1,228 @@
+# Report column layouts, the daily stats store, and report sinks
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import csv, datetime, json, sqlite3, sys
+from collections import OrderedDict
+import metrics, sketches
+
+stats_columns = ['date',
+                 'completed_sessions',
+                 'completed_users',
+                 'completed_bytes',
+                 None,
+                 'cancelled_sessions',
+                 'cancelled_users',
+                 None,
+                 'error_sessions',
+                 'error_users']
+
+pkgs_columns = ['date',
+                'g1', 'g1_files',
+                'g5', 'g5_files',
+                'g20', 'g20_files',
+                'g20_avg',
+                'preproc', None,
+                'unproc', None]
+
+# Some of the packages worksheet values are retrieved from the
+# Aspera stats collector database. This is the map of aspera stats
+# keys to packages worksheet columns.
+add_pkgs_columns = {
+    'preproc_completed':9,
+    'unproc_completed':11
+}
+
+# The store also keeps each day's distinct login sketch with its
+# packages row (as text, see sketches.hll_dumps), so that distinct
+# logins can be estimated over any range of days.
+_sketch_columns = ['logins']
+
+def store_columns(table):
+    """Returns the list of column names for the named store table,
+    'stats' or 'packages'. The first is always 'date'."""
+    if 'stats' == table:
+        return [c for c in stats_columns if c]
+    else:
+        return [c for c in pkgs_columns if c] + sorted(add_pkgs_columns) + _sketch_columns
+
+def package_row(pkgstats, filestats):
+    """Returns the values for a packages row: the package log stats
+    and login sketch, plus the values that come from the Aspera
+    stats."""
+    row = dict((k, pkgstats[k]) for k in pkgs_columns if k)
+    row['logins'] = pkgstats.get('logins')
+    for k in add_pkgs_columns:
+        row[k] = filestats[k]
+    return row
+
+def _stored(values, k):
+    """Returns the store value for column k of the row: sketches are
+    stored as text."""
+    v = values.get(k)
+    return sketches.hll_dumps(v) if k in _sketch_columns and isinstance(v, dict) else v
+
+def sheet_cells(table, values):
+    """Returns the list of worksheet cell values for a row of the named
+    table, from the values dict."""
+    if 'stats' == table:
+        return [values[k] if k else None for k in stats_columns]
+    cells = [values[k] if k else None for k in pkgs_columns]
+    for k, col in add_pkgs_columns.iteritems():
+        cells[col] = values.get(k)
+    return cells
+
+def open_store(path):
+    """Opens (creating if necessary) the SQLite daily stats store."""
+    store = sqlite3.connect(path)
+    column_type = lambda c: 'text' if c in _sketch_columns else 'integer'
+    for table in ['stats', 'packages']:
+        store.execute('create table if not exists {} (date text not null primary key, '.format(table)
+                      + ','.join('{} {}'.format(c, column_type(c)) for c in store_columns(table)[1:])
+                      + ')')
+        # stores made before a column was added get it now, empty
+        have = set(r[1] for r in store.execute('pragma table_info({})'.format(table)))
+        for c in store_columns(table)[1:]:
+            if c not in have:
+                store.execute('alter table {} add column {} {}'.format(table, c, column_type(c)))
+    return store
+
+def _iso(d):
+    return d.isoformat() if hasattr(d, 'isoformat') else str(d)
+
+def _as_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+def last_date(store):
+    """Returns the last date in the store, or None if the store is
+    empty. Raises an Exception if the two tables' last dates differ."""
+    statsdate, = store.execute('select max(date) from stats').fetchone()
+    pkgsdate, = store.execute('select max(date) from packages').fetchone()
+    if statsdate != pkgsdate:
+        raise Exception('last date of stats ({}) != last date of packages ({}) in store;\n'
+                        'manual intervention is required'.format(statsdate, pkgsdate))
+    return _as_date(statsdate) if statsdate else None
+
+def _insert_rows(store, table, rows, verb='insert'):
+    names = store_columns(table)
+    store.executemany('{} into {} ({}) values ({})'.format(
+            verb, table, ','.join(names), ','.join(['?'] * len(names))),
+                      ([_iso(values['date'])] + [_stored(values, k) for k in names[1:]]
+                       for values in rows))
+
+def append_days(store, days):
+    """Adds the (stats, packages) row value dicts for each day to the
+    store, in a single transaction."""
+    days = list(days)
+    metrics.count('report.store_rows', len(days))
+    with store:
+        _insert_rows(store, 'stats', [d[0] for d in days])
+        _insert_rows(store, 'packages', [d[1] for d in days])
+
+def iter_rows(store, table, start=None, end=None):
+    """Yields the value dicts for the rows of the named table, in date
+    order, optionally limited to dates in [start, end)."""
+    names = store_columns(table)
+    query = 'select {} from {} where date >= ? and date < ? order by date'.format(','.join(names), table)
+    for r in store.execute(query, [(start or datetime.date.min).isoformat(),
+                                   (end or datetime.date.max).isoformat()]):
+        values = dict(zip(names, r))
+        values['date'] = _as_date(values['date'])
+        yield values
+
+# Report sinks write a batch of daily rows for one table ('stats' or
+# 'packages') in a single flush or transaction. The CSV sink uses the
+# worksheet layout, so its columns line up with the spreadsheet; the
+# JSON Lines and SQLite sinks use the store columns.
+
+def _open_output(path):
+    return sys.stdout if '-' == path else open(path, 'ab')
+
+def _close_output(f):
+    if f is sys.stdout:
+        f.flush()
+    else:
+        f.close()
+
+def csv_fields(table, values):
+    """Returns the CSV fields for a row of the named table; missing
+    values are empty."""
+    return ['' if v is None else str(v) for v in sheet_cells(table, values)]
+
+def write_csv(path, table, rows, header=True):
+    """Appends the rows to the CSV file, starting with a header row if
+    header is set and the file is new."""
+    f = _open_output(path)
+    try:
+        w = csv.writer(f)
+        if header and (f is sys.stdout or 0 == f.tell()):
+            columns = list(stats_columns if 'stats' == table else pkgs_columns)
+            if 'packages' == table:
+                for k, col in add_pkgs_columns.iteritems():
+                    columns[col] = k
+            w.writerow([c or '' for c in columns])
+        w.writerows(csv_fields(table, values) for values in rows)
+    finally:
+        _close_output(f)
+
+def write_jsonl(path, table, rows):
+    """Appends the rows to the JSON Lines file, one object per day."""
+    names = store_columns(table)
+    f = _open_output(path)
+    try:
+        f.write(''.join(json.dumps(OrderedDict([('date', _iso(values['date']))] +
+                                               [(k, _stored(values, k)) for k in names[1:]])) + '\n'
+                        for values in rows))
+    finally:
+        _close_output(f)
+
+def _update_row(store, table, values):
+    names = [k for k in store_columns(table)[1:] if k in values]
+    if names and not store.execute('update {} set {} where date = ?'.format(
+            table, ','.join('{} = ?'.format(k) for k in names)),
+                                   [_stored(values, k) for k in names] + [_iso(values['date'])]).rowcount:
+        raise ValueError('no {} row for {} in the store to update; a new day needs every column'
+                         ' (e.g. from update_dl_stats)'.format(table, _iso(values['date'])))
+
+def write_sqlite(path, table, rows):
+    """Writes the rows into the named table of the SQLite store, in a
+    single transaction. Rows with every store column replace any
+    existing rows for the same dates. Rows with only some of the
+    columns (e.g. packages rows from the package log alone, without the
+    Aspera columns) update just those columns of existing rows, and
+    raise a ValueError for a date that isn't in the store. Every row
+    must have a date."""
+    if not all(values.get('date') for values in rows):
+        raise ValueError('rows written to the store need a date')
+    names = store_columns(table)
+    store = open_store(path)
+    try:
+        with store:
+            _insert_rows(store, table, [values for values in rows
+                                        if all(k in values for k in names)], 'insert or replace')
+            for values in rows:
+                if not all(k in values for k in names):
+                    _update_row(store, table, values)
+    finally:
+        store.close()
+
+sinks = {'csv': write_csv, 'jsonl': write_jsonl, 'sqlite': write_sqlite}
+
+def sink_for(path):
+    """Returns the name of the sink for the given output path, by its
+    extension: .jsonl or .json, .db or .sqlite, otherwise csv."""
+    ext = path.rsplit('.', 1)[-1].lower() if '.' in path else ''
+    if ext in ('jsonl', 'json'):
+        return 'jsonl'
+    elif ext in ('db', 'sqlite', 'sqlite3'):
+        return 'sqlite'
+    else:
+        return 'csv'
+
+def write_rows(path, table, rows, sink=None):
+    """Writes the rows for the named table to path through the named
+    sink, or the one implied by the path."""
+    rows = list(rows)
+    with metrics.timer('report.write'):
+        sinks[sink or sink_for(path)](path, table, rows)
+    metrics.count('report.write', len(rows))
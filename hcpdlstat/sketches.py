@@ -0,0 +1,124 @@
+# Bounded-memory summaries for download statistics
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import base64, hashlib, heapq, math, struct
+
+def init_top(k):
+    """Returns an empty space-saving sketch that tracks the (at most) k
+    items with the largest total weight."""
+    return {'k': k, 'counts': {}, 'heap': []}
+
+def top_add(sketch, item, weight=1):
+    """Adds weight to item's total. If the sketch is full and item isn't
+    tracked, the item with the smallest total is replaced; the new item
+    inherits that total as its overestimate."""
+    counts = sketch['counts']
+    if item in counts:
+        counts[item][0] += weight
+        return
+    heap = sketch['heap']
+    error = 0
+    if len(counts) >= sketch['k']:
+        # heap entries may be stale (totals only grow); refresh those
+        while True:
+            count, victim = heapq.heappop(heap)
+            if counts[victim][0] == count:
+                break
+            heapq.heappush(heap, (counts[victim][0], victim))
+        del counts[victim]
+        error = count
+    counts[item] = [error + weight, error]
+    heapq.heappush(heap, (error + weight, item))
+
+def top_items(sketch, n=None):
+    """Returns up to n (item, total, error) tuples, largest total first.
+    Each true total is between total-error and total."""
+    items = sorted(((item, c[0], c[1]) for item, c in sketch['counts'].iteritems()),
+                   key=lambda e: (-e[1], e[0]))
+    return items[:n] if n else items
+
+# HyperLogLog sketches estimate the number of distinct items using
+# 2**p one-byte registers; the standard error is about 1.04/sqrt(2**p).
+default_precision = 12
+
+_mask64 = (1<<64) - 1
+
+def precision_from_config(config):
+    """Returns the precision set by hll.precision in the [reporting]
+    section, which applies to every sketch (package logins and Aspera
+    users alike) so that they can be merged at full precision."""
+    if config.has_option('reporting', 'hll.precision'):
+        return int(config.get('reporting', 'hll.precision'))
+    return default_precision
+
+def init_hll(p=default_precision):
+    """Returns an empty HyperLogLog sketch with precision p (4-16)."""
+    if not 4 <= p <= 16:
+        raise ValueError('HyperLogLog precision must be between 4 and 16')
+    return {'p': p, 'registers': bytearray(1<<p)}
+
+def _hash64(item):
+    if isinstance(item, unicode):
+        item = item.encode('utf-8')
+    return struct.unpack('<Q', hashlib.sha1(str(item)).digest()[:8])[0]
+
+def hll_add(h, item):
+    """Adds item to the HyperLogLog sketch."""
+    p = h['p']
+    x = _hash64(item)
+    w = (x << p) & _mask64
+    rho = 64 - w.bit_length() + 1 if w else 64 - p + 1
+    registers = h['registers']
+    i = x >> (64 - p)
+    if rho > registers[i]:
+        registers[i] = rho
+
+def hll_fold(h, p):
+    """Returns a copy of the sketch reduced to the lower precision p."""
+    shift = h['p'] - p
+    folded = init_hll(p)
+    registers = folded['registers']
+    for i, r in enumerate(h['registers']):
+        if r:
+            # the index bits dropped become the leading bits of the hash tail
+            low = i & ((1<<shift) - 1)
+            r = shift - low.bit_length() + 1 if low else shift + r
+            if r > registers[i >> shift]:
+                registers[i >> shift] = r
+    return folded
+
+def hll_merge(h, other):
+    """Merges other into h, giving the sketch of the union. If the
+    precisions differ, h is reduced to the lower one."""
+    if other['p'] < h['p']:
+        h.update(hll_fold(h, other['p']))
+    elif other['p'] > h['p']:
+        other = hll_fold(other, h['p'])
+    registers = h['registers']
+    for i, r in enumerate(other['registers']):
+        if r > registers[i]:
+            registers[i] = r
+    return h
+
+def hll_copy(h):
+    return {'p': h['p'], 'registers': bytearray(h['registers'])}
+
+def hll_count(h):
+    """Returns the estimated number of distinct items added."""
+    registers = h['registers']
+    m = len(registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213/(1 + 1.079/m))
+    e = alpha*m*m / sum(2.0**-r for r in registers)
+    zeros = registers.count('\x00')
+    if e <= 2.5*m and zeros:
+        e = m*math.log(float(m)/zeros)     # small range correction
+    return int(round(e))
+
+def hll_dumps(h):
+    """Returns the sketch as a string, for storing in a text column."""
+    return '{}:{}'.format(h['p'], base64.b64encode(str(h['registers'])))
+
+def hll_loads(s):
+    p, registers = s.split(':', 1)
+    return {'p': int(p), 'registers': bytearray(base64.b64decode(registers))}
@@ -0,0 +1,83 @@
+# SQLite stand-in for the MySQL server, for the tests and benchmarks
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import datetime, os, re, sqlite3, sys
+from contextlib import contextmanager
+import pymysql
+import metrics
+
+# The stand-in has a database attached for each MySQL schema used here.
+# Statements are written for MySQL with %s placeholders; the stand-in
+# translates those to SQLite's, and SQLite's errors to the PyMySQL
+# errors the server would cause.
+schemas = ['aspera_stats_collector', 'hcpdlstat', 'geolocation']
+_create_schema = re.compile(r'\s*create database if not exists \w+\s*$', re.I)
+
+_errors = [(sqlite3.IntegrityError, pymysql.err.IntegrityError),
+           ((sqlite3.ProgrammingError, sqlite3.OperationalError), pymysql.err.ProgrammingError)]
+
+@contextmanager
+def _translated():
+    try:
+        yield
+    except sqlite3.Error as e:
+        for sqlite_error, mysql_error in _errors:
+            if isinstance(e, sqlite_error):
+                raise mysql_error, mysql_error(0, str(e)), sys.exc_info()[2]
+        raise pymysql.err.DatabaseError, pymysql.err.DatabaseError(0, str(e)), sys.exc_info()[2]
+
+class _SQLiteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=()):
+        if _create_schema.match(query):
+            return      # the schemas are attached by connect
+        with metrics.timer('db.query'), _translated():
+            return self.cursor.execute(query.replace('%s', '?'), args)
+
+    def executemany(self, query, args):
+        with metrics.timer('db.query'), _translated():
+            return self.cursor.executemany(query.replace('%s', '?'), args)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+class _SQLiteConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return _SQLiteCursor(self.db.cursor())
+
+    def commit(self):
+        with _translated():
+            self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+def connect(path=':memory:', schemas=schemas):
+    """Opens a SQLite stand-in for the MySQL server. Each schema is kept
+    in path/<schema>.db if path is a directory, otherwise in memory."""
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.text_factory = str
+    db.create_function('now', 0,
+                       lambda: datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    for schema in schemas:
+        dbpath = os.path.join(path, schema + '.db') if os.path.isdir(path) else ':memory:'
+        db.execute("attach ? as {}".format(schema), [dbpath])
+    return _SQLiteConnection(db)
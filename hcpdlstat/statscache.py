@@ -0,0 +1,113 @@
+# On-disk cache of parsed package log stats, keyed by log file fingerprint
+# Copyright (c) 2013 Washington University School of Medicine
+# Author: Kevin A. Archie <karchie@wustl.edu>
+
+import cPickle as pickle
+import hashlib, os
+
+def file_hash(path, bufsize=1<<20):
+    """Returns the SHA-1 hex digest of the named file's contents."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(bufsize), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(path):
+    """Returns the path, size, and mtime of the named file as a dict."""
+    st = os.stat(path)
+    return {'path': os.path.abspath(path),
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+
+def _entry_path(cachedir, path):
+    name = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(cachedir, name + '.pickle')
+
+def read_pickle(path):
+    """Returns the object pickled in the named file, or None if there is
+    none or it can't be read."""
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+def write_pickle(path, obj):
+    """Pickles obj to the named file, replacing it atomically."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def lookup(cachedir, path, version=None):
+    """Returns the cached stats for the named log file, or None if there
+    are none, they were stored with a different version (of the stats
+    format, see store), or the file has changed since they were stored.
+    This costs a stat() unless the size matches but the mtime doesn't,
+    in which case the contents are hashed to decide."""
+    entry_path = _entry_path(cachedir, path)
+    entry = read_pickle(entry_path)
+    if not entry or entry.get('version') != version:
+        return None
+    try:
+        fp = fingerprint(path)
+    except OSError:
+        return None
+    if fp['path'] != entry['path'] or fp['size'] != entry['size']:
+        return None
+    if fp['mtime'] != entry['mtime']:
+        if file_hash(path) != entry['sha1']:
+            return None
+        entry['mtime'] = fp['mtime']     # touched, but not changed
+        write_pickle(entry_path, entry)
+    os.utime(entry_path, None)           # most recently used
+    return entry['stats']
+
+def store(cachedir, fp, stats, maxsize=None, version=None):
+    """Stores the (portable) stats for the log file with fingerprint fp,
+    which should be taken before the file was parsed. Nothing is stored
+    if the file has changed since. The stats are looked up only with
+    the same version, which should identify the stats format. If
+    maxsize is provided, least recently used entries are evicted to
+    keep the cache under that many bytes."""
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    entry = dict(fp)
+    entry['version'] = version
+    entry['sha1'] = file_hash(fp['path'])
+    if fingerprint(fp['path']) != fp:
+        return
+    entry['stats'] = stats
+    write_pickle(_entry_path(cachedir, fp['path']), entry)
+    if maxsize is not None:
+        evict(cachedir, maxsize)
+
+def invalidate(cachedir, path):
+    """Removes any cached stats for the named log file."""
+    try:
+        os.remove(_entry_path(cachedir, path))
+    except OSError:
+        pass
+
+def _entries(cachedir):
+    if not os.path.isdir(cachedir):
+        return []       # nothing cached yet
+    paths = [os.path.join(cachedir, name) for name in os.listdir(cachedir)
+             if name.endswith('.pickle')]
+    return [(os.path.getmtime(p), os.path.getsize(p), p) for p in paths]
+
+def evict(cachedir, maxsize):
+    """Removes least recently used entries until the cache occupies no
+    more than maxsize bytes."""
+    entries = sorted(_entries(cachedir))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in entries:
+        if total <= maxsize:
+            break
+        os.remove(p)
+        total -= size
+
+def clear(cachedir):
+    """Removes all cached stats."""
+    evict(cachedir, 0)
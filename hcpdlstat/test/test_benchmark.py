@@ -0,0 +1,26 @@
+import datetime, unittest
+import hcpdlstat.benchmark as benchmark
+import hcpdlstat.packagelog as ppl
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_log_lines(self):
+        stats = ppl.init_stats()
+        lines = list(benchmark.generate_log_lines(1000, bundle_weights={'g1': 3, 'g20': 1},
+                                                  resource_fraction=0.2))
+        ppl.handle_lines(lines, stats)
+        self.assertEqual(0, stats['g5'])
+        self.assertTrue(stats['g1'] > 2*stats['g20'] > 0)
+        packages = [line for line in lines if ' x [' in line]
+        self.assertTrue(700 < len(packages) < 900)
+        self.assertEqual(len(packages), stats['g1'] + stats['g20'])
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(lines=200, slow_lines=20, days=2, day_lines=100,
+                                           sessions=50)
+        for name in ['parse.regex', 'aggregate.parse', 'db.rebuild_rollup',
+                     'geolocate.offline', 'spreadsheet.store']:
+            self.assertTrue(results[name]['count'] > 0, name)
+        self.assertEqual(50, results['db.refresh_rollup']['count'])
+
+if __name__ == '__main__':
+    unittest.main()
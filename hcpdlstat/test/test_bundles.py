@@ -0,0 +1,37 @@
+import unittest
+import hcpdlstat.bundles as bundles
+
+class TestBundles(unittest.TestCase):
+    def test_bundle_of(self):
+        self.assertEqual('g1', bundles.bundle_of(['100307']))
+        self.assertEqual('g5', bundles.bundle_of(set(bundles.g5)))
+        self.assertEqual('g20', bundles.bundle_of(list(bundles.g20)))
+        self.assertEqual(None, bundles.bundle_of(['100307', '114924']))
+
+    def test_compile_bundles(self):
+        index = bundles.compile_bundles([('a', {'1', '2'}), ('b', {'3'}), ('c', {'2', '1'})])
+        self.assertEqual({frozenset(['1', '2']): 'a', frozenset(['3']): 'b'}, index)
+
+    def test_classify(self):
+        packages = ['3T_Structural_preproc', '3T_rfMRI_REST1_unproc', 'other']
+        self.assertEqual(('g1', ['preproc', 'unproc']),
+                         bundles.classify(packages, {'100307'}))
+        self.assertTrue(bundles.classify(packages, {'100307'}) is
+                        bundles.classify(packages, ['100307']))
+        self.assertEqual((None, []), bundles.classify(['other'], {'1', '2'}))
+
+    def test_memo_bound(self):
+        size = bundles.memo_size
+        bundles.memo_size = 3
+        try:
+            bundles.clear_memo()
+            for i in range(10):
+                bundles.classify(['p{}_preproc'.format(i)], {'100307'})
+                self.assertTrue(len(bundles._memo) <= 3)
+            self.assertEqual(('g1', ['preproc']), bundles.classify(['p0_preproc'], ['100307']))
+        finally:
+            bundles.memo_size = size
+            bundles.clear_memo()
+
+if __name__ == '__main__':
+    unittest.main()
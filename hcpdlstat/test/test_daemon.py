@@ -0,0 +1,103 @@
+import datetime, json, os, shutil, tempfile, threading, unittest, urllib2
+import hcpdlstat.asperastatscollector as aspera
+import hcpdlstat.benchmark as benchmark
+import hcpdlstat.daemon as daemon
+import hcpdlstat.database as database
+import hcpdlstat.geolocate as geolocate
+import hcpdlstat.standin as standin
+from hcpdlstat.test.test_database import populate
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = standin.connect()
+        aspera.create_source_tables(self.db)
+        self.pool = database.init_pool(lambda: self.db, backoff=0)
+        self.state = daemon.init_state()
+
+    def tearDown(self):
+        database.close_pool(self.pool)
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, server, path):
+        url = 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+        return json.loads(urllib2.urlopen(url).read())
+
+    def test_refresh_and_serve(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        populate(self.db, [('s1', 'c1', 'completed', str(now), '10.0.0.1'),
+                           ('s2', 'c2', 'completed', str(now), '10.0.0.2')],
+                 [(1, 's1', '/data/100307_3T_unproc.zip', 1000, 'completed', str(now))])
+        with open(os.path.join(self.tmpdir, 'pkg.log'), 'w') as f:
+            for name in ['g1', 'g5']:
+                with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                    f.write(src.read())
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        database.call(self.pool, geolocate.create_geo_table)
+        options = {'index': benchmark.generate_geo_index(100)}
+        daemon.run_task(self.state, 'tail', daemon.tail_packages, self.tmpdir, 'pkg.log', checkpoint)
+        daemon.run_task(self.state, 'aspera', daemon.refresh_aspera, self.pool)
+        daemon.run_task(self.state, 'geolocate', daemon.geolocate_new, self.pool, options)
+
+        # later rows are picked up by the next run
+        populate(self.db, [('s3', 'c1', 'completed', str(now), '10.0.0.3')],
+                 [(2, 's3', '/data/100307_3T_preproc.zip', 500, 'completed', str(now))])
+        daemon.run_task(self.state, 'aspera', daemon.refresh_aspera, self.pool)
+        daemon.run_task(self.state, 'geolocate', daemon.geolocate_new, self.pool, options)
+
+        server = daemon.serve(self.state, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            s = self.fetch(server, '/stats')
+            self.assertEqual(1, s['packages']['g1'])
+            self.assertEqual(1, s['packages']['g5'])
+            self.assertEqual(datetime.date.today().isoformat(), s['packages']['date'])
+            today = s['aspera'][now.date().isoformat()]
+            self.assertEqual(3, today['completed_sessions'])
+            self.assertEqual(1500, today['completed_bytes'])
+            self.assertEqual({'located': 3, 'last': 1}, s['geolocate'])
+            self.assertEqual(2, s['tasks']['aspera']['runs'])
+            self.assertEqual(0, s['tasks']['tail']['errors'])
+            self.assertTrue('counters' in self.fetch(server, '/metrics'))
+            self.assertRaises(urllib2.HTTPError, self.fetch, server, '/nothing')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_tail_rollover(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        daemon.publish(self.state, 'packages', {'date': '2013-03-15', 'g1': 5})
+        # no log yet today
+        daemon.run_task(self.state, 'tail', daemon.tail_packages, self.tmpdir, 'pkg.log',
+                        checkpoint, None, 8)
+        s = daemon.snapshot(self.state)
+        self.assertEqual(datetime.date.today().isoformat(), s['packages']['date'])
+        self.assertEqual(0, s['packages']['g1'])
+        # a log that can't be read doesn't leave an earlier day's stats up
+        daemon.publish(self.state, 'packages', {'date': '2013-03-15', 'g1': 5})
+        os.mkdir(os.path.join(self.tmpdir, 'pkg.log'))
+        daemon.run_task(self.state, 'tail', daemon.tail_packages, self.tmpdir, 'pkg.log', checkpoint)
+        s = daemon.snapshot(self.state)
+        self.assertFalse('packages' in s)
+        self.assertEqual(1, s['tasks']['tail']['errors'])
+
+    def test_schedule(self):
+        runs = []
+        def task(state):
+            runs.append(len(runs))
+            if 1 == len(runs):
+                raise ValueError('first run fails')
+            if len(runs) >= 3:
+                stop.set()
+        stop = threading.Event()
+        daemon.schedule(self.state, stop, 'test', 0.01, task).join(5)
+        self.assertEqual([0, 1, 2], runs)
+        status = daemon.snapshot(self.state)['tasks']['test']
+        self.assertEqual(3, status['runs'])
+        self.assertEqual(1, status['errors'])
+        self.assertEqual('ValueError: first run fails', status['last_error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import datetime, shutil, tempfile, unittest
+import pymysql
+import hcpdlstat.asperastatscollector as aspera
+import hcpdlstat.database as database
+import hcpdlstat.geolocate as geolocate
+import hcpdlstat.standin as standin
+
+sessions = [('s1', 'c1', 'completed', '2013-03-15 10:00:00', '10.0.0.1'),
+            ('s2', 'c1', 'completed', '2013-03-15 11:00:00', '10.0.0.1'),
+            ('s3', 'c2', 'completed', '2013-03-15 12:00:00', '10.0.0.2'),
+            ('s4', 'c3', 'error', '2013-03-15 13:00:00', '10.0.0.3'),
+            ('s5', 'c2', 'completed', '2013-03-16 09:00:00', '10.0.0.2')]
+
+files = [(1, 's1', '/data/100307_3T_unproc.zip', 1000, 'completed', '2013-03-15 10:30:00'),
+         (2, 's2', '/data/100307_3T_preproc.zip', 2000, 'completed', '2013-03-15 11:30:00'),
+         (3, 's3', '/data/100408_3T_unproc.zip', 500, 'completed', '2013-03-15 12:30:00'),
+         (4, 's4', '/data/100408_3T_preproc.zip', 10, 'error', '2013-03-15 13:30:00'),
+         (5, 's5', '/data/100408_3T_unproc.zip', 700, 'completed', '2013-03-16 09:30:00')]
+
+def populate(db, sessions, files):
+    cur = db.cursor()
+    try:
+        cur.executemany('insert into aspera_stats_collector.fasp_sessions'
+                        ' (session_id, cookie, status, created_at, client_addr)'
+                        ' values (%s, %s, %s, %s, %s)', sessions)
+        cur.executemany('insert into aspera_stats_collector.fasp_files'
+                        ' (id, session_id, file_fullpath, bytes_written, status, created_at)'
+                        ' values (%s, %s, %s, %s, %s, %s)', files)
+    finally:
+        cur.close()
+    db.commit()
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.db = standin.connect()
+        aspera.create_source_tables(self.db)
+        populate(self.db, sessions, files)
+        self.pool = database.init_pool(lambda: self.db, backoff=0)
+
+    def tearDown(self):
+        database.close_pool(self.pool)
+
+    def test_pool_reuse_and_retry(self):
+        opened = []
+        def connect():
+            opened.append(standin.connect())
+            return opened[-1]
+        pool = database.init_pool(connect, size=1, backoff=0)
+        self.assertTrue(database.call(pool, lambda db: db) is database.call(pool, lambda db: db))
+        self.assertEqual(1, len(opened))
+
+        failures = [pymysql.err.OperationalError(2006, 'MySQL server has gone away')]
+        def flaky(db):
+            if failures:
+                raise failures.pop()
+            return db
+        db = database.call(pool, flaky)
+        self.assertEqual(2, len(opened))
+        self.assertTrue(opened[1] is db)
+
+        def broken(db):
+            raise pymysql.err.ProgrammingError(1064, 'syntax error')
+        self.assertRaises(pymysql.err.ProgrammingError, database.call, pool, broken)
+        # the stand-in raises the server's errors
+        self.assertRaises(pymysql.err.ProgrammingError, database.call, pool,
+                          lambda db: db.cursor().execute('select nothing from nowhere'))
+        self.assertEqual(2, len(opened))
+        database.close_pool(pool)
+
+    def test_rollup(self):
+        d = datetime.date(2013, 3, 15)
+        database.call(self.pool, aspera.refresh_rollup, 10)
+        stats = database.call(self.pool, aspera.get_rollup_stats, d, d + datetime.timedelta(days=2))
+        self.assertEqual(3, stats[d]['completed_sessions'])
+        self.assertEqual(2, stats[d]['completed_users'])
+        self.assertEqual(3500, stats[d]['completed_bytes'])
+        self.assertEqual(1, stats[d]['preproc_completed'])
+        self.assertEqual(2, stats[d]['unproc_completed'])
+        self.assertEqual(1, stats[d]['error_sessions'])
+        self.assertEqual(700, stats[d + datetime.timedelta(days=1)]['completed_bytes'])
+
+        # late rows are picked up incrementally
+        populate(self.db, [('s6', 'c4', 'completed', '2013-03-16 10:00:00', '10.0.0.4')],
+                 [(6, 's6', '/data/100307_3T_preproc.zip', 300, 'completed', '2013-03-15 23:00:00')])
+        database.call(self.pool, aspera.refresh_rollup, 10)
+        stats = database.call(self.pool, aspera.get_stats, '2013-03-15')
+        self.assertEqual(3800, stats['completed_bytes'])
+        self.assertEqual(3, database.call(self.pool, aspera.get_distinct_users,
+                                          d, d + datetime.timedelta(days=2)))
+
+        # so are late sessions without files
+        populate(self.db, [('s7', 'c5', 'completed', '2013-03-15 14:00:00', '10.0.0.5')], [])
+        database.call(self.pool, aspera.refresh_rollup, 10)
+        stats = database.call(self.pool, aspera.get_rollup_stats, d, d + datetime.timedelta(days=1))
+        self.assertEqual(4, stats[d]['completed_sessions'])
+        self.assertEqual(3, stats[d]['completed_users'])
+
+    def test_rebuild_commits(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = standin.connect(tmpdir)
+            aspera.create_source_tables(db)
+            populate(db, sessions, files)
+            aspera.refresh_rollup(db)
+            cur = db.cursor()
+            cur.execute('delete from aspera_stats_collector.fasp_sessions')
+            cur.execute('delete from aspera_stats_collector.fasp_files')
+            db.commit()
+            aspera.rebuild_rollup(db)
+            other = standin.connect(tmpdir)
+            cur = other.cursor()
+            cur.execute('select count(*) from hcpdlstat.aspera_daily')
+            self.assertEqual(0, cur.fetchone()[0])
+            other.close()
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_geo(self):
+        database.call(self.pool, geolocate.create_geo_table)
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                         sorted(database.call(self.pool, geolocate.get_missing_ips)))
+        database.call(self.pool, geolocate.insert_geos,
+                      [{'ip': '10.0.0.1', 'city': "St. Mary's"},
+                       {'ip': '10.0.0.2', 'latitude': 38.6}])
+        self.assertEqual(['10.0.0.3'], database.call(self.pool, geolocate.get_missing_ips))
+        cur = self.db.cursor()
+        cur.execute('select city, created from geolocation.geo where ip = %s', ['10.0.0.1'])
+        city, created = cur.fetchone()
+        cur.close()
+        self.assertEqual("St. Mary's", city)
+        self.assertTrue(created)
+
+if __name__ == '__main__':
+    unittest.main()
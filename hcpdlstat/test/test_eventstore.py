@@ -0,0 +1,45 @@
+import datetime, os, shutil, tempfile, unittest
+import hcpdlstat.eventstore as es
+import hcpdlstat.packagelog as ppl
+
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.eventdir = os.path.join(self.tmpdir, 'events')
+        self.dates = [datetime.date(2013, 3, 15), datetime.date(2013, 3, 16)]
+        for date, names in zip(self.dates, [['g1', 'g20', 'g1'], ['q1_group_avg', 'g5']]):
+            with open(os.path.join(self.tmpdir, 'pkg.log.' + date.isoformat()), 'w') as f:
+                for name in names:
+                    with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                        f.write(src.read())
+        for date in self.dates:
+            ppl.get_stats(self.tmpdir, 'pkg.log', date, eventdir=self.eventdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_partition(self):
+        p = es.read_partition(self.eventdir, self.dates[0])
+        self.assertEqual(3, len(p['columns']['time']))
+        self.assertEqual(['', 'clyde', 'pangloss'], p['strings']['login'])
+        self.assertEqual(['clyde', 'pangloss', 'clyde'],
+                         [p['strings']['login'][c] for c in p['columns']['login']])
+        self.assertEqual(((11*60 + 49)*60 + 41)*1000 + 682, p['columns']['time'][0])
+        self.assertEqual('100307', p['strings']['subjects'][p['columns']['subjects'][0]])
+        self.assertEqual(None, es.read_partition(self.eventdir, datetime.date(2013, 3, 17)))
+
+    def test_sum_by(self):
+        start, end = self.dates[0], self.dates[-1] + datetime.timedelta(days=1)
+        by_login = es.sum_by(self.eventdir, start, end, 'login')
+        self.assertEqual(2*3020622548, by_login['clyde'])
+        self.assertEqual(313468534, by_login['zamboni'])
+        counts = es.sum_by(self.eventdir, start, end, 'date', None)
+        self.assertEqual({self.dates[0]: 3, self.dates[1]: 2}, dict(counts))
+        by_hour = es.sum_by(self.eventdir, start, end, 'hour', None)
+        self.assertEqual(2, by_hour[11])
+        by_file = es.sum_by(self.eventdir, start, end, 'filename', None)
+        self.assertEqual(1, by_file['HCP_Q1-GroupAvgUnrelated20.zip'])
+        self.assertEqual(4, by_file[None])
+
+if __name__ == '__main__':
+    unittest.main()
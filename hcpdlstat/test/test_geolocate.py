@@ -0,0 +1,167 @@
+import json, os, shutil, tempfile, threading, time, unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import hcpdlstat.geodb as geodb
+import hcpdlstat.geolocate as geolocate
+
+class StubGeoHandler(BaseHTTPRequestHandler):
+    """Answers /json/<ip> in the freegeoip format. Each address in
+    the server's flaky set fails once before succeeding, and each in
+    its garbled set gets no response once."""
+    def do_GET(self):
+        ip = self.path.split('/')[-1]
+        with self.server.lock:
+            self.server.requests.append(ip)
+            fail = ip in self.server.flaky
+            self.server.flaky.discard(ip)
+            garble = ip in self.server.garbled
+            self.server.garbled.discard(ip)
+            slow = ip in self.server.slow
+        if slow:
+            time.sleep(1)
+        if garble:
+            return      # closed without a status line
+        if fail:
+            self.send_error(503)
+            return
+        body = json.dumps({'ip': ip, 'country_code': 'US',
+                           'country_name': 'United States',
+                           'region_code': 'MO', 'region_name': 'Missouri',
+                           'city': 'St. Louis', 'zipcode': '63110',
+                           'latitude': 38.6, 'longitude': -90.3,
+                           'metro_code': '609', 'areacode': '314'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestGeolocate(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubGeoHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.flaky = set()
+        self.server.slow = set()
+        self.server.garbled = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/json/{{0}}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_resolve(self):
+        ips = ['10.0.0.{}'.format(i) for i in range(20)]
+        self.server.flaky.update(ips[:3])
+        geos = list(geolocate.resolve(ips, self.url, threads=4, backoff=0.01))
+        self.assertEqual(sorted(ips), sorted(g['ip'] for g in geos))
+        self.assertEqual(23, len(self.server.requests))
+        self.assertEqual('St. Louis', geos[0]['city'])
+        self.assertEqual('http://127.0.0.1:{}'.format(self.server.server_port), geos[0]['source'])
+
+    def test_resolve_retries_bad_responses(self):
+        self.server.garbled.add('10.0.0.1')
+        geos = list(geolocate.resolve(['10.0.0.1', '10.0.0.2'], self.url, backoff=0.01))
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], sorted(g['ip'] for g in geos))
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_resolve_times_out(self):
+        self.server.slow.add('10.0.0.1')
+        start = time.time()
+        geos = list(geolocate.resolve(['10.0.0.1'], self.url, retries=0, timeout=0.2))
+        self.assertEqual([], geos)
+        self.assertTrue(time.time() - start < 0.9)
+
+    def test_resolve_gives_up(self):
+        self.server.flaky.add('10.0.0.1')
+        geos = list(geolocate.resolve(['10.0.0.1'], self.url, retries=0))
+        self.assertEqual([], geos)
+
+    def test_rate_limit(self):
+        ips = ['10.0.0.{}'.format(i) for i in range(11)]
+        start = time.time()
+        geos = list(geolocate.resolve(ips, self.url, threads=4, rate=100))
+        self.assertEqual(11, len(geos))
+        self.assertTrue(time.time() - start >= 0.1)
+
+_blocks_csv = """Copyright (c) 2013 MaxMind LLC.  All Rights Reserved.
+startIpNum,endIpNum,locId
+"167772160","167772415","2"
+"16777216","16777471","1"
+"167772672","167772927","3"
+"""
+
+_locations_csv = """Copyright (c) 2013 MaxMind LLC.  All Rights Reserved.
+locId,country,region,city,postalCode,latitude,longitude,metroCode,areaCode
+1,"AU","","",,-27.0000,133.0000,,
+2,"US","MO","St. Louis","63110",38.6312,-90.1922,609,314
+3,"DE","02","M\xfcnchen","",48.1500,11.5833,,
+"""
+
+class TestGeoDB(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        blocks = os.path.join(self.tmpdir, 'blocks.csv')
+        locations = os.path.join(self.tmpdir, 'locations.csv')
+        with open(blocks, 'w') as f:
+            f.write(_blocks_csv)
+        with open(locations, 'w') as f:
+            f.write(_locations_csv)
+        self.index = geodb.load_csv(blocks, locations)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        geo = geodb.get_geo(self.index, '10.0.0.17')
+        self.assertEqual('St. Louis', geo['city'])
+        self.assertEqual(38.6312, geo['latitude'])
+        self.assertEqual('10.0.0.17', geo['ip'])
+        self.assertEqual('AU', geodb.get_geo(self.index, '1.0.0.255')['country_code'])
+        self.assertEqual(u'M\xfcnchen', geodb.get_geo(self.index, '10.0.2.0')['city'])
+        self.assertEqual(None, geodb.get_geo(self.index, '10.0.1.0'))
+        self.assertEqual(None, geodb.get_geo(self.index, '0.0.0.1'))
+        self.assertEqual(None, geodb.get_geo(self.index, '::1'))
+
+    def test_code_names(self):
+        countries = os.path.join(self.tmpdir, 'countries.csv')
+        regions = os.path.join(self.tmpdir, 'regions.csv')
+        with open(countries, 'w') as f:
+            f.write('AU,Australia\nDE,Germany\nUS,"United States"\n')
+        with open(regions, 'w') as f:
+            f.write('DE,02,Bayern\nUS,MO,Missouri\n')
+        index = geodb.load_csv(os.path.join(self.tmpdir, 'blocks.csv'),
+                               os.path.join(self.tmpdir, 'locations.csv'), countries, regions)
+        geo = geodb.get_geo(index, '10.0.0.17')
+        self.assertEqual(('United States', 'Missouri'), (geo['country_name'], geo['region_name']))
+        geo = geodb.get_geo(index, '1.0.0.255')
+        self.assertEqual('Australia', geo['country_name'])
+        self.assertFalse('region_name' in geo)
+        self.assertFalse('country_name' in geodb.get_geo(self.index, '10.0.0.17'))
+
+    def test_saved_index(self):
+        path = os.path.join(self.tmpdir, 'index')
+        geodb.save_index(self.index, path)
+        self.assertEqual(self.index, geodb.load_index(path))
+
+    def test_index_built_when_missing(self):
+        path = os.path.join(self.tmpdir, 'index')
+        blocks = os.path.join(self.tmpdir, 'blocks.csv')
+        locations = os.path.join(self.tmpdir, 'locations.csv')
+        self.assertEqual(self.index, geodb.index_for(path, blocks, locations))
+        self.assertEqual(self.index, geodb.load_index(path))
+        # rebuilt once the CSVs are newer
+        with open(blocks, 'a') as f:
+            f.write('"16777472","16777727","2"\n')
+        st = os.stat(path)
+        os.utime(blocks, (st.st_atime, st.st_mtime + 10))
+        self.assertEqual('US', geodb.get_geo(geodb.index_for(path, blocks, locations),
+                                             '1.0.1.1')['country_code'])
+        self.assertEqual('US', geodb.get_geo(geodb.load_index(path), '1.0.1.1')['country_code'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import json, os, shutil, tempfile, unittest
+import hcpdlstat.metrics as metrics
+import hcpdlstat.packagelog as ppl
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def test_report(self):
+        metrics.count('stage', 10)
+        metrics.add_time('stage', 2.0)
+        metrics.add_time('stage', 3.0)
+        snap = metrics.snapshot()
+        metrics.merge(snap)
+        r = metrics.report()
+        self.assertEqual(20, r['counters']['stage'])
+        self.assertEqual({'calls': 4, 'seconds': 10.0, 'max': 3.0, 'rate': 2.0},
+                         r['timers']['stage'])
+
+        path = os.path.join(self.tmpdir, 'metrics.jsonl')
+        metrics.write_metrics(path, 'test')
+        metrics.write_metrics(path, 'test')
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(2, len(entries))
+        self.assertEqual('test', entries[1]['program'])
+        self.assertEqual(20, entries[1]['counters']['stage'])
+
+    def test_parallel_parse(self):
+        logfile = os.path.join(self.tmpdir, 'pkg.log')
+        with open(logfile, 'w') as f:
+            for name in ['g1', 'g5', 'g20', 'q1_group_avg'] * 3:
+                with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                    f.write(src.read())
+        ppl.handle_file(logfile, ppl.init_stats(), 3)
+        r = metrics.report()
+        self.assertEqual(12, r['counters']['packagelog.parse'])
+        self.assertEqual(1, r['timers']['packagelog.parse']['calls'])
+
+if __name__ == '__main__':
+    unittest.main()
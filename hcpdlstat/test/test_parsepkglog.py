@@ -1,11 +1,12 @@
-import unittest
-import hcpdlstat.parsepkglog as ppl
+import datetime, gzip, os, pickle, shutil, tempfile, unittest
+from StringIO import StringIO
+import hcpdlstat.packagelog as ppl
 
 class TestParsePkgLog(unittest.TestCase):
-    def get_state(self, logfile):
-        s = ppl.init_state()
+    def get_state(self, logfile, fast=True):
+        s = ppl.init_stats()
         with open(logfile) as f:
-            ppl.handle_lines(f.readlines(), s)
+            ppl.handle_lines(f.readlines(), s, fast)
         return s
 
     def test_g1(self):
@@ -42,5 +43,228 @@ class TestParsePkgLog(unittest.TestCase):
         self.assertEqual(0, s['g20'])
         self.assertEqual(1, s['resources']['HCP_Q1']['Q1']['HCP_Q1-GroupAvgUnrelated20.zip'])
 
+    def test_fast_matches_grammar(self):
+        for name in ['g1', 'g5', 'g20', 'q1_group_avg']:
+            logfile = 'hcpdlstat/test/data/{}.log'.format(name)
+            self.assertEqual(self.get_state(logfile, False),
+                             self.get_state(logfile, True))
+
+    def test_fast_fallback(self):
+        # extra whitespace isn't handled by the fast path
+        line = '2013-03-05 12:21:50,502 dang downloading a_preproc , b_unproc x [100307,  114924] (10 bytes)'
+        self.assertEqual(None, ppl.fast_parse(line))
+        s = ppl.init_stats()
+        ppl.handle_lines([line], s)
+        self.assertEqual(4, s['files'])
+        self.assertEqual(2, s['preproc'])
+        self.assertEqual(2, s['unproc'])
+
+    def test_iter_lines(self):
+        text = 'a\nbcd\n\nefghij\nk'
+        self.assertEqual(['a\n', 'bcd\n', '\n', 'efghij\n', 'k'],
+                         list(ppl.iter_lines(StringIO(text), 3)))
+
+    def test_compressed_log(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open('hcpdlstat/test/data/g20.log') as src:
+                dst = gzip.open(os.path.join(tmpdir, 'pkg.log.2013-03-15.gz'), 'wb')
+                dst.write(src.read())
+                dst.close()
+            s = ppl.get_stats(tmpdir, 'pkg.log', datetime.date(2013, 3, 15))
+            self.assertEqual(1, s['g20'])
+            self.assertEqual(220, s['files'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_iter_stats_parallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dates = [datetime.date(2013, 3, d) for d in [15, 16, 17]]
+            for date, name in zip(dates, ['g20', 'q1_group_avg', 'g5']):
+                shutil.copy('hcpdlstat/test/data/{}.log'.format(name),
+                            os.path.join(tmpdir, 'pkg.log.' + date.isoformat()))
+            serial = list(ppl.iter_stats(tmpdir, 'pkg.log', dates))
+            parallel = list(ppl.iter_stats(tmpdir, 'pkg.log', dates, 2))
+            self.assertEqual(serial, parallel)
+            self.assertEqual(dates, [s['date'] for s in parallel])
+            self.assertEqual(1, parallel[1]['g20_avg'])
+            self.assertEqual(parallel, pickle.loads(pickle.dumps(parallel)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_merge_stats(self):
+        s = ppl.init_stats()
+        for name in ['g1', 'g5', 'q1_group_avg', 'q1_group_avg']:
+            other = self.get_state('hcpdlstat/test/data/{}.log'.format(name))
+            ppl.merge_stats(s, ppl.portable_stats(other))
+        ppl.count_resources(s)
+        self.assertEqual(1, s['g1'])
+        self.assertEqual(1, s['g5'])
+        self.assertEqual(18, s['files'])
+        self.assertEqual(2, s['g20_avg'])
+        self.assertEqual(3, ppl.sketches.hll_count(s['logins']))
+        self.assertEqual(2, ppl.distinct_logins([self.get_state('hcpdlstat/test/data/g1.log'),
+                                                 self.get_state('hcpdlstat/test/data/g5.log')]))
+
+    def test_split_log(self):
+        logfile = 'hcpdlstat/test/data/g20.log'
+        size = os.path.getsize(logfile)
+        self.assertEqual([(0, size)], ppl.split_log(logfile, 4))
+
+    def test_handle_file_parallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'pkg.log')
+            with open(logfile, 'w') as f:
+                for name in ['g1', 'g5', 'g20', 'q1_group_avg'] * 25:
+                    with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                        f.write(src.read())
+            ranges = ppl.split_log(logfile, 3)
+            self.assertEqual(3, len(ranges))
+            with open(logfile) as f:
+                for start, end in ranges:
+                    f.seek(start-1 if start else 0)
+                    self.assertTrue(0 == start or '\n' == f.read(1))
+            serial = ppl.handle_file(logfile, ppl.init_stats())
+            parallel = ppl.handle_file(logfile, ppl.init_stats(), 3)
+            self.assertEqual(serial, parallel)
+            self.assertEqual(25, parallel['g20_avg'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_quarantine(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'pkg.log')
+            quarantine = os.path.join(tmpdir, 'quarantine')
+            bad = 'garbage line\n'
+            offsets = []
+            with open(logfile, 'w') as f:
+                for i, name in enumerate(['g1', 'g5', 'g20', 'q1_group_avg'] * 10):
+                    if 17 == i or 33 == i:
+                        offsets.append(f.tell())
+                        f.write(bad)
+                    with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                        f.write(src.read())
+            self.assertRaises(ppl.ParseException, ppl.handle_file, logfile, ppl.init_stats())
+            expected = ['{}\t{}\t{}'.format(logfile, offset, bad) for offset in offsets]
+            for processes in [1, 3]:
+                stats = ppl.handle_file(logfile, ppl.init_stats(), processes,
+                                        quarantine_path=quarantine)
+                self.assertEqual(2, stats['parse_errors'])
+                self.assertEqual(10, stats['g20'])
+                with open(quarantine) as f:
+                    self.assertEqual(expected, sorted(f.readlines()))
+                os.remove(quarantine)
+            with ppl.quarantined(quarantine, logfile) as errors:
+                ppl.handle_lines(open(logfile).readlines(), ppl.init_stats(), False,
+                                 errors=errors)
+            with open(quarantine) as f:
+                self.assertEqual(expected, f.readlines())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tail_log(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'pkg.log')
+            checkpoint = os.path.join(tmpdir, 'checkpoint')
+            lines = [open('hcpdlstat/test/data/{}.log'.format(name)).read()
+                     for name in ['g1', 'g5', 'q1_group_avg']]
+            with open(logfile, 'w') as f:
+                f.write(lines[0])
+                f.write(lines[1][:20])    # partially written line
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint)
+            self.assertEqual(1, s['g1'])
+            self.assertEqual(0, s['g5'])
+            with open(logfile, 'a') as f:
+                f.write(lines[1][20:])
+                f.write(lines[2])
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint)
+            self.assertEqual(1, s['g1'])
+            self.assertEqual(1, s['g5'])
+            self.assertEqual(1, s['g20_avg'])
+            self.assertEqual(datetime.date.today(), s['date'])
+            # rotation: a new file with the same name starts over
+            os.rename(logfile, logfile + '.old')
+            shutil.copy('hcpdlstat/test/data/g20.log', logfile)
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint)
+            self.assertEqual(0, s['g1'])
+            self.assertEqual(1, s['g20'])
+            # no log yet after rotation: no downloads, and a fresh start
+            os.remove(logfile)
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint, precision=8)
+            self.assertEqual(0, s['g20'])
+            self.assertEqual(datetime.date.today(), s['date'])
+            self.assertEqual(8, s['logins']['p'])
+            with open(logfile, 'w') as f:
+                f.write(lines[0])
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint, precision=8)
+            self.assertEqual(1, s['g1'])
+            self.assertEqual(0, s['g20'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tail_log_quarantine(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'pkg.log')
+            checkpoint = os.path.join(tmpdir, 'checkpoint')
+            quarantine = os.path.join(tmpdir, 'quarantine')
+            with open(logfile, 'w') as f:
+                f.write(open('hcpdlstat/test/data/g1.log').read())
+                offset = f.tell()
+                f.write('garbage line\n')
+            self.assertRaises(ppl.ParseException, ppl.tail_log, tmpdir, 'pkg.log',
+                              os.path.join(tmpdir, 'strict'))
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint, quarantine_path=quarantine)
+            self.assertEqual(1, s['parse_errors'])
+            with open(logfile, 'a') as f:
+                f.write(open('hcpdlstat/test/data/g5.log').read())
+            s = ppl.tail_log(tmpdir, 'pkg.log', checkpoint, quarantine_path=quarantine)
+            self.assertEqual(1, s['g1'])
+            self.assertEqual(1, s['g5'])
+            self.assertEqual(1, s['parse_errors'])
+            with open(quarantine) as f:
+                self.assertEqual(['{}\t{}\tgarbage line\n'.format(logfile, offset)], f.readlines())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_batches_match_lines(self):
+        lines = []
+        for name in ['g1', 'g5', 'g20', 'q1_group_avg', 'g5', 'g1']:
+            with open('hcpdlstat/test/data/{}.log'.format(name)) as f:
+                lines.extend(f.readlines())
+        lines.append('2013-03-05 12:21:50,502 dang downloading a_preproc , b_unproc x [100307,  114924] (10 bytes)\n')
+        for fast in [True, False]:
+            s = ppl.init_stats()
+            ppl.handle_lines(lines, s, fast)
+            b = ppl.init_stats()
+            ppl.handle_batches(lines, b, fast, batchsize=4)
+            self.assertEqual(s, b)
+        self.assertEqual(2, b['g1'])
+        self.assertEqual(2, b['g5'])
+        self.assertEqual(1, b['g20_avg'])
+
+    def test_timeseries(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            date = datetime.date(2013, 3, 15)
+            with open(os.path.join(tmpdir, 'pkg.log.' + date.isoformat()), 'w') as f:
+                for name in ['g1', 'g5', 'g20', 'q1_group_avg', 'g1']:
+                    with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                        f.write(src.read())
+            s = ppl.get_stats(tmpdir, 'pkg.log', date, bucket=30, topk=4)
+            ts = s['timeseries']
+            self.assertEqual({19: [1, 313468534], 23: [2, 2*3020622548],
+                              24: [1, 26299080498], 26: [1, 266138230291]},
+                             ts['buckets'])
+            self.assertEqual([('pangloss', 266138230291, 0), ('dang', 26299080498, 0)],
+                             ppl.sketches.top_items(ts['top'], 2))
+            self.assertEqual(ppl.get_stats(tmpdir, 'pkg.log', date)['files'], s['files'])
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+import datetime, os, shutil, tempfile, unittest
+import hcpdlstat.asperastatscollector as aspera
+import hcpdlstat.packagelog as ppl
+import hcpdlstat.query as query
+import hcpdlstat.report as report
+import hcpdlstat.standin as standin
+from hcpdlstat.test.test_database import populate, sessions, files
+
+# log contents for some of the days from 2013-03-11 (Monday) to 2013-04-02
+logs = {datetime.date(2013, 3, 11): ['g1', 'g5'],
+        datetime.date(2013, 3, 15): ['g20', 'q1_group_avg'],
+        datetime.date(2013, 3, 17): ['g1'],
+        datetime.date(2013, 3, 18): ['g5', 'g5'],
+        datetime.date(2013, 4, 1): ['g1', 'g20']}
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for date, names in logs.iteritems():
+            with open(os.path.join(self.tmpdir, 'pkg.log.' + date.isoformat()), 'w') as f:
+                for name in names:
+                    with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                        f.write(src.read())
+        self.store = report.open_store(':memory:')
+        query.create_days_table(self.store)
+        self.start, self.end = datetime.date(2013, 3, 11), datetime.date(2013, 4, 3)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def expected(self, start, end):
+        stats = ppl.init_stats()
+        for date in query.iter_dates(start, end):
+            if date in logs:
+                ppl.merge_stats(stats, ppl.get_stats(self.tmpdir, 'pkg.log', date))
+        ppl.count_resources(stats)
+        return stats
+
+    def test_packages(self):
+        self.assertEqual(5, query.fill_days(self.store, self.tmpdir, 'pkg.log',
+                                            self.start, self.end, 2))
+        self.assertEqual(0, query.fill_days(self.store, self.tmpdir, 'pkg.log',
+                                            self.start, self.end, 2))
+
+        weeks = query.query(self.store, self.start, self.end, 'week', distinct=True)
+        self.assertEqual([datetime.date(2013, 3, 11), datetime.date(2013, 3, 18),
+                          datetime.date(2013, 3, 25), datetime.date(2013, 4, 1)],
+                         [first for first, _ in weeks])
+        for first, totals in weeks:
+            expected = self.expected(first, min(self.end, query.next_period(first, 'week')))
+            for k in query.day_columns:
+                self.assertEqual(expected[k], totals[k])
+        self.assertEqual(2, weeks[0][1]['g1'])
+        self.assertEqual(1, weeks[0][1]['g20_avg'])
+        self.assertEqual(2, weeks[1][1]['g5'])
+        self.assertEqual(0, weeks[2][1]['files'])
+        self.assertEqual(0, weeks[2][1]['logins'])
+        self.assertTrue(weeks[0][1]['logins'] > 0)
+
+        months = query.query(self.store, datetime.date(2013, 3, 15), self.end, 'month')
+        self.assertEqual([datetime.date(2013, 3, 1), datetime.date(2013, 4, 1)],
+                         [first for first, _ in months])
+        self.assertEqual(self.expected(datetime.date(2013, 3, 15), datetime.date(2013, 4, 1))['bytes'],
+                         months[0][1]['bytes'])
+        self.assertFalse('logins' in months[0][1])
+
+    def test_aspera(self):
+        db = standin.connect()
+        aspera.create_source_tables(db)
+        populate(db, sessions, files)
+        aspera.refresh_rollup(db)
+        query.fill_days(self.store, self.tmpdir, 'pkg.log', self.start, self.end)
+        days = dict(query.query(self.store, self.start, self.end, 'day', db))
+        self.assertEqual(2, days[datetime.date(2013, 3, 15)]['completed_users'])
+        self.assertEqual(3500, days[datetime.date(2013, 3, 15)]['completed_bytes'])
+        self.assertEqual(1, days[datetime.date(2013, 3, 15)]['g20'])
+
+        weeks = query.query(self.store, self.start, self.end, 'week', db)
+        self.assertEqual(4, weeks[0][1]['completed_sessions'])
+        self.assertEqual(4200, weeks[0][1]['completed_bytes'])
+        self.assertEqual(None, weeks[0][1]['completed_users'])
+        weeks = query.query(self.store, self.start, self.end, 'week', db, distinct=True)
+        self.assertEqual(2, weeks[0][1]['completed_users'])
+        self.assertEqual(1, weeks[0][1]['error_users'])
+        self.assertEqual(0, weeks[1][1]['completed_sessions'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import datetime, os, shutil, tempfile, unittest
+import hcpdlstat.asperastatscollector as aspera
+import hcpdlstat.packagelog as ppl
+import hcpdlstat.reconcile as reconcile
+import hcpdlstat.standin as standin
+
+transfers = [(1, '/data/100307_3T_Structural_preproc.zip', 1000, 'completed', '2013-03-05 12:30:00'),
+             (2, '/data/100307_3T_Structural_preproc.zip', 1200, 'completed', '2013-03-05 12:40:00'),
+             (3, '/data/114924_3T_rfMRI_REST2_preproc.zip', 500, 'cancelled', '2013-03-05 12:35:00'),
+             (4, '/data/125525_3T_tfMRI_EMOTION_preproc.zip', 800, 'completed', '2013-03-06 13:00:00'),
+             (5, '/q1/HCP_Q1-GroupAvgUnrelated20.zip', 313468534, 'completed', '2013-03-05 09:40:00'),
+             (6, '/data/other.zip', 5, 'completed', '2013-03-05 10:00:00')]
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.eventdir = os.path.join(self.tmpdir, 'events')
+        self.date = datetime.date(2013, 3, 5)
+        with open(os.path.join(self.tmpdir, 'pkg.log.' + self.date.isoformat()), 'w') as f:
+            for name in ['q1_group_avg', 'g5']:
+                with open('hcpdlstat/test/data/{}.log'.format(name)) as src:
+                    f.write(src.read())
+        ppl.get_stats(self.tmpdir, 'pkg.log', self.date, eventdir=self.eventdir)
+        self.db = standin.connect()
+        aspera.create_source_tables(self.db)
+        cur = self.db.cursor()
+        cur.executemany('insert into aspera_stats_collector.fasp_files'
+                        ' (id, file_fullpath, bytes_written, status, created_at)'
+                        ' values (%s, %s, %s, %s, %s)', transfers)
+        cur.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_reconcile(self):
+        requests, unmatched = reconcile.reconcile_range(self.db, self.eventdir, self.date,
+                                                        self.date + datetime.timedelta(days=1))
+        self.assertEqual(2, unmatched)
+        by_bundle = reconcile.summarize(requests, 'bundle')
+        self.assertEqual(15, by_bundle['g5']['files'])
+        self.assertEqual(1, by_bundle['g5']['delivered_files'])
+        self.assertEqual(1200, by_bundle['g5']['delivered_bytes'])
+        self.assertEqual(1.0, by_bundle['resource']['byte_completion'])
+        by_login = reconcile.summarize(requests, 'login')
+        self.assertEqual(1.0/15, by_login['dang']['file_completion'])
+        self.assertEqual(1, by_login['zamboni']['requests'])
+
+    def test_match_latest_request(self):
+        t = datetime.datetime(2013, 3, 5, 12)
+        hour = datetime.timedelta(hours=1)
+        requests = [{'time': t, 'files': ['a.zip', 'b.zip']},
+                    {'time': t + 2*hour, 'files': ['a.zip']}]
+        index = reconcile.build_index(requests)
+        matched = [i for i, _, _ in reconcile.match(index, [(t - hour, 'a.zip'), (t + hour, 'a.zip'),
+                                                         (t + 3*hour, 'a.zip'), (t + 3*hour, 'b.zip'),
+                                                         (t + 30*hour, 'b.zip')], 24*hour)]
+        self.assertEqual([None, 0, 1, 0, None], matched)
+
+    def test_ambiguous_login(self):
+        t = datetime.datetime(2013, 3, 5, 12)
+        hour = datetime.timedelta(hours=1)
+        requests = [{'time': t, 'login': 'alice', 'bundle': 'g1', 'files': ['a.zip'], 'bytes': 10},
+                    {'time': t + hour, 'login': 'bob', 'bundle': 'g1', 'files': ['a.zip'], 'bytes': 10},
+                    {'time': t + hour, 'login': 'bob', 'bundle': 'g1', 'files': ['b.zip'], 'bytes': 10}]
+        transfers = [(t + 2*hour, 'a.zip', 10, 'completed'),
+                     (t + 2*hour, 'b.zip', 10, 'completed')]
+        self.assertEqual([(1, True), (2, False)],
+                         [(i, a) for i, _, a in reconcile.match(reconcile.build_index(requests),
+                                                                transfers, 24*hour)])
+        reconcile.reconcile(requests, transfers, 24*hour)
+        self.assertEqual(2, reconcile.summarize(requests, 'bundle')['g1']['delivered_files'])
+        by_login = reconcile.summarize(requests, 'login')
+        self.assertEqual(1, by_login['bob']['delivered_files'])
+        self.assertEqual(0.5, by_login['bob']['file_completion'])
+
+if __name__ == '__main__':
+    unittest.main()
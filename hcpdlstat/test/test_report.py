@@ -0,0 +1,119 @@
+import csv, datetime, json, os, shutil, sqlite3, tempfile, unittest
+from collections import OrderedDict
+from openpyxl import Workbook, load_workbook
+import hcpdlstat.report as report
+import hcpdlstat.sketches as sketches
+import hcpdlstat.update as update
+
+def day_values(date, n):
+    stats = dict((k, n) for k in report.store_columns('stats'))
+    pkgs = dict((k, n) for k in report.store_columns('packages'))
+    stats['date'] = pkgs['date'] = date
+    return stats, pkgs
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'report.xlsx')
+        self.date = datetime.date(2013, 3, 15)
+        wb = Workbook()
+        s_stats = wb.get_active_sheet()
+        s_stats.title = 'Stats'
+        s_pkgs = wb.create_sheet(title='Packages')
+        stats, pkgs = day_values(self.date, 3)
+        for ws, table, values in [(s_stats, 'stats', stats), (s_pkgs, 'packages', pkgs)]:
+            ws.cell(row=0, column=0).value = 'Download statistics'
+            values['date'] = datetime.datetime.combine(self.date, datetime.time())
+            for i, v in enumerate(report.sheet_cells(table, values)):
+                ws.cell(row=2, column=i).value = v
+        wb.create_sheet(title='Notes').cell(row=0, column=0).value = 'kept as is'
+        wb.save(self.path)
+        self.store = report.open_store(os.path.join(self.tmpdir, 'stats.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.assertEqual(None, report.last_date(self.store))
+        update.import_workbook(self.store, self.path, 'Stats', 'Packages')
+        self.assertEqual(self.date, report.last_date(self.store))
+        next_date = self.date + datetime.timedelta(days=1)
+        report.append_days(self.store, [day_values(next_date, 4)])
+        self.assertEqual(next_date, report.last_date(self.store))
+        self.assertEqual([3, 4], [r['preproc_completed']
+                                  for r in report.iter_rows(self.store, 'packages')])
+
+        self.assertEqual(2, update.append_workbook(self.store, self.path, 'Stats', 'Packages'))
+        self.assertEqual(0, update.append_workbook(self.store, self.path, 'Stats', 'Packages'))
+        wb = load_workbook(self.path)
+        ws = wb.get_sheet_by_name('Packages')
+        self.assertEqual(4, ws.get_highest_row())
+        self.assertEqual('Download statistics', ws.cell(row=0, column=0).value)
+        self.assertEqual(next_date, ws.cell(row=3, column=0).value.date())
+        self.assertEqual(4, ws.cell(row=3, column=9).value)
+        self.assertEqual('kept as is', wb.get_sheet_by_name('Notes').cell(row=0, column=0).value)
+
+        # without a workbook, one is generated from the store
+        path = os.path.join(self.tmpdir, 'new.xlsx')
+        update.write_workbook(self.store, path, 'Stats', 'Packages')
+        ws = load_workbook(path).get_sheet_by_name('Packages')
+        self.assertEqual(3, ws.get_highest_row())
+        self.assertEqual(next_date, ws.cell(row=2, column=0).value.date())
+        self.assertEqual('unproc_completed', ws.cell(row=0, column=11).value)
+
+    def test_login_sketches(self):
+        # a store made before the sketch column gets it
+        path = os.path.join(self.tmpdir, 'old.db')
+        old = sqlite3.connect(path)
+        old.execute('create table packages (date text not null primary key, g1 integer)')
+        old.close()
+        store = report.open_store(path)
+        stats, pkgs = day_values(self.date, 1)
+        h = sketches.init_hll()
+        for login in ['a', 'b', 'c']:
+            sketches.hll_add(h, login)
+        pkgs = report.package_row(dict(pkgs, logins=h), pkgs)
+        report.append_days(store, [(stats, pkgs)])
+        row, = report.iter_rows(store, 'packages')
+        self.assertEqual(3, sketches.hll_count(sketches.hll_loads(row['logins'])))
+
+    def test_sinks(self):
+        days = [day_values(self.date + datetime.timedelta(days=i), i) for i in range(3)]
+        pkgs = [d[1] for d in days]
+        csvpath = os.path.join(self.tmpdir, 'packages.csv')
+        report.write_rows(csvpath, 'packages', pkgs[:2])
+        report.write_rows(csvpath, 'packages', pkgs[2:])
+        with open(csvpath) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(4, len(rows))
+        self.assertEqual('preproc_completed', rows[0][9])
+        self.assertEqual(['2013-03-17', '2'], rows[3][:2])
+        self.assertEqual(report.csv_fields('packages', pkgs[2]), rows[3])
+
+        jsonpath = os.path.join(self.tmpdir, 'stats.jsonl')
+        report.write_rows(jsonpath, 'stats', [d[0] for d in days])
+        with open(jsonpath) as f:
+            objs = [json.loads(line, object_pairs_hook=OrderedDict) for line in f]
+        self.assertEqual(report.store_columns('stats'), objs[0].keys())
+        self.assertEqual('2013-03-16', objs[1]['date'])
+
+        dbpath = os.path.join(self.tmpdir, 'stats.db')
+        report.write_rows(dbpath, 'packages', pkgs)
+        report.write_rows(dbpath, 'packages', [day_values(self.date, 7)[1]])
+        store = report.open_store(dbpath)
+        self.assertEqual([7, 1, 2], [r['g20'] for r in report.iter_rows(store, 'packages')])
+        undated = dict(pkgs[0], date='')
+        self.assertRaises(ValueError, report.write_rows, dbpath, 'packages', [undated])
+
+        # package log rows, without the Aspera columns, update only their own
+        partial = day_values(self.date, 9)[1]
+        del partial['preproc_completed'], partial['unproc_completed']
+        report.write_rows(dbpath, 'packages', [partial])
+        row = list(report.iter_rows(store, 'packages'))[0]
+        self.assertEqual((9, 7), (row['g20'], row['preproc_completed']))
+        partial = dict(partial, date=self.date + datetime.timedelta(days=10))
+        self.assertRaises(ValueError, report.write_rows, dbpath, 'packages', [partial])
+        self.assertEqual(3, len(list(report.iter_rows(store, 'packages'))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import random, unittest, ConfigParser
+import hcpdlstat.sketches as sketches
+
+class TestTopSketch(unittest.TestCase):
+    def test_exact_when_small(self):
+        s = sketches.init_top(3)
+        for item, w in [('a', 5), ('b', 1), ('a', 2), ('c', 4)]:
+            sketches.top_add(s, item, w)
+        self.assertEqual([('a', 7, 0), ('c', 4, 0), ('b', 1, 0)], sketches.top_items(s))
+        self.assertEqual([('a', 7, 0)], sketches.top_items(s, 1))
+
+    def test_heavy_hitters(self):
+        rand = random.Random(0)
+        s = sketches.init_top(10)
+        items = ['heavy{}'.format(i) for i in range(3)] * 200 + \
+            ['light{}'.format(i) for i in range(1000)]
+        rand.shuffle(items)
+        for item in items:
+            sketches.top_add(s, item, 10)
+        self.assertTrue(len(s['counts']) <= 10)
+        self.assertEqual(10, len(s['heap']))
+        top = sketches.top_items(s, 3)
+        self.assertEqual(['heavy0', 'heavy1', 'heavy2'], sorted(item for item, _, _ in top))
+        for item, total, error in top:
+            self.assertTrue(total - error <= 2000 <= total)
+
+class TestHyperLogLog(unittest.TestCase):
+    def fill(self, items, p=12):
+        h = sketches.init_hll(p)
+        for item in items:
+            sketches.hll_add(h, item)
+        return h
+
+    def test_count(self):
+        self.assertEqual(0, sketches.hll_count(sketches.init_hll()))
+        self.assertEqual(3, sketches.hll_count(self.fill(['a', 'b', 'a', u'c'])))
+        n = sketches.hll_count(self.fill('user{}'.format(i) for i in range(20000)))
+        self.assertTrue(abs(n - 20000) < 20000*0.05)
+        self.assertRaises(ValueError, sketches.init_hll, 17)
+
+    def test_merge(self):
+        a = self.fill('user{}'.format(i) for i in range(10000))
+        b = self.fill('user{}'.format(i) for i in range(5000, 15000))
+        union = self.fill('user{}'.format(i) for i in range(15000))
+        self.assertEqual(union, sketches.hll_merge(sketches.hll_copy(a), b))
+        # differing precisions fold to the lower one
+        c = self.fill(('user{}'.format(i) for i in range(5000, 15000)), 10)
+        merged = sketches.hll_merge(sketches.hll_copy(a), c)
+        self.assertEqual(10, merged['p'])
+        self.assertEqual(sketches.hll_fold(union, 10), merged)
+        self.assertEqual(merged, sketches.hll_loads(sketches.hll_dumps(merged)))
+
+    def test_precision_from_config(self):
+        config = ConfigParser.ConfigParser()
+        self.assertEqual(sketches.default_precision, sketches.precision_from_config(config))
+        config.add_section('statscollector')
+        config.set('statscollector', 'hll.precision', '8')
+        self.assertEqual(sketches.default_precision, sketches.precision_from_config(config))
+        config.add_section('reporting')
+        config.set('reporting', 'hll.precision', '10')
+        self.assertEqual(10, sketches.precision_from_config(config))
+
+if __name__ == '__main__':
+    unittest.main()
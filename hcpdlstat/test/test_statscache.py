@@ -0,0 +1,67 @@
+import datetime, os, shutil, tempfile, unittest
+import hcpdlstat.packagelog as ppl
+import hcpdlstat.statscache as cache
+
+class TestStatsCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        self.date = datetime.date(2013, 3, 15)
+        self.logfile = os.path.join(self.tmpdir, 'pkg.log.2013-03-15')
+        shutil.copy('hcpdlstat/test/data/g20.log', self.logfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_stats_cached(self):
+        cache.clear(self.cachedir)      # no cache directory yet
+        uncached = ppl.get_stats(self.tmpdir, 'pkg.log', self.date)
+        first = ppl.get_stats(self.tmpdir, 'pkg.log', self.date, cachedir=self.cachedir)
+        self.assertEqual(uncached, first)
+        self.assertTrue(cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+        second = ppl.get_stats(self.tmpdir, 'pkg.log', self.date, cachedir=self.cachedir)
+        self.assertEqual(uncached, second)
+
+    def test_invalidation(self):
+        ppl.get_stats(self.tmpdir, 'pkg.log', self.date, cachedir=self.cachedir)
+        # touched but unchanged: still valid
+        st = os.stat(self.logfile)
+        os.utime(self.logfile, (st.st_atime, st.st_mtime + 10))
+        self.assertTrue(cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+        # changed: invalid
+        with open(self.logfile, 'a') as f:
+            with open('hcpdlstat/test/data/g1.log') as src:
+                f.write(src.read())
+        self.assertEqual(None, cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+        s = ppl.get_stats(self.tmpdir, 'pkg.log', self.date, cachedir=self.cachedir)
+        self.assertEqual(1, s['g1'])
+        cache.invalidate(self.cachedir, self.logfile)
+        self.assertEqual(None, cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+
+    def test_version(self):
+        fp = cache.fingerprint(self.logfile)
+        cache.store(self.cachedir, fp, {'g1': 1}, version='1-old')
+        self.assertEqual(None, cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+        # entries from before versions were kept are stale too
+        entry = cache.read_pickle(cache._entry_path(self.cachedir, self.logfile))
+        del entry['version']
+        cache.write_pickle(cache._entry_path(self.cachedir, self.logfile), entry)
+        self.assertEqual(None, cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+        s = ppl.get_stats(self.tmpdir, 'pkg.log', self.date, cachedir=self.cachedir)
+        self.assertEqual(1, s['g20'])
+        self.assertTrue(cache.lookup(self.cachedir, self.logfile, ppl.stats_version))
+
+    def test_evict(self):
+        for i in range(4):
+            path = os.path.join(self.tmpdir, 'log{}'.format(i))
+            shutil.copy(self.logfile, path)
+            cache.store(self.cachedir, cache.fingerprint(path), {'i': i})
+        sizes = [os.path.getsize(os.path.join(self.cachedir, n))
+                 for n in os.listdir(self.cachedir)]
+        cache.evict(self.cachedir, sum(sizes) - 1)
+        self.assertEqual(3, len(os.listdir(self.cachedir)))
+        cache.clear(self.cachedir)
+        self.assertEqual([], os.listdir(self.cachedir))
+
+if __name__ == '__main__':
+    unittest.main()
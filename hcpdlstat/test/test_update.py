@@ -0,0 +1,75 @@
+import datetime, os, shutil, sys, tempfile, unittest
+from openpyxl import Workbook, load_workbook
+from pyparsing import ParseException
+import hcpdlstat.asperastatscollector as aspera
+import hcpdlstat.database as database
+import hcpdlstat.packagelog as ppl
+import hcpdlstat.standin as standin
+import hcpdlstat.update as update
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.argv = sys.argv
+        self.dates = [datetime.date.today() - datetime.timedelta(days=i) for i in [3, 2, 1]]
+        logdir = os.path.join(self.tmpdir, 'logs')
+        dbdir = os.path.join(self.tmpdir, 'db')
+        os.makedirs(logdir)
+        os.makedirs(dbdir)
+        for date, names in zip(self.dates[1:], [['g1', 'g5'], ['g20']]):
+            with open(os.path.join(logdir, 'pkg.log.' + date.isoformat()), 'w') as f:
+                for name in names:
+                    with open(os.path.join(self.cwd, 'hcpdlstat/test/data/{}.log'.format(name))) as src:
+                        f.write(src.read())
+        self.bad_log = os.path.join(logdir, 'pkg.log.' + self.dates[2].isoformat())
+        with open(self.bad_log, 'a') as f:
+            f.write('this is not a log line\n')
+        with open(os.path.join(self.tmpdir, 'site.cfg'), 'w') as f:
+            f.write('[packagelog]\nlogdir={}\nlogname=pkg.log\n'
+                    '[reporting]\nsheet.stats=Stats\nsheet.packages=Packages\n'.format(logdir))
+        # the configured server is the stand-in
+        self.connector = database.connector
+        database.connector = lambda config, section: lambda: standin.connect(dbdir)
+        db = standin.connect(dbdir)
+        aspera.create_source_tables(db)
+        db.close()
+
+        self.wb_path = os.path.join(self.tmpdir, 'report.xlsx')
+        wb = Workbook()
+        wb.get_active_sheet().title = 'Stats'
+        wb.create_sheet(title='Packages')
+        for name in ['Stats', 'Packages']:
+            wb.get_sheet_by_name(name).cell(row=1, column=0).value = \
+                datetime.datetime.combine(self.dates[0], datetime.time())
+        wb.save(self.wb_path)
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.argv = self.argv
+        database.connector = self.connector
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        sys.argv = ['update_dl_stats', self.wb_path]
+        self.assertRaises(ParseException, update.main)
+        checkpoint = ppl.load_checkpoint(self.wb_path + '.checkpoint')
+        self.assertEqual([self.dates[1]], checkpoint['days'].keys())
+
+        # the completed day isn't parsed again
+        os.remove(os.path.join(self.tmpdir, 'logs', 'pkg.log.' + self.dates[1].isoformat()))
+        quarantine = os.path.join(self.tmpdir, 'quarantine')
+        sys.argv = ['update_dl_stats', '-q', quarantine, self.wb_path]
+        update.main()
+        self.assertFalse(os.path.exists(self.wb_path + '.checkpoint'))
+        with open(quarantine) as f:
+            self.assertEqual(['{}\t{}\tthis is not a log line\n'.format(self.bad_log, os.path.getsize(self.bad_log) - 23)],
+                             f.readlines())
+        ws = load_workbook(self.wb_path).get_sheet_by_name('Packages')
+        self.assertEqual(4, ws.get_highest_row())
+        self.assertEqual([1, 1, 0], [ws.cell(row=r, column=c).value for r, c in [(2, 1), (2, 3), (2, 5)]])
+        self.assertEqual(1, ws.cell(row=3, column=5).value)
+
+if __name__ == '__main__':
+    unittest.main()
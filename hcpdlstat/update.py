@@ -1,44 +1,20 @@
 # Copyright (c) 2013 Washington University School of Medicine
 # Author: Kevin A. Archie <karchie@wustl.edu>
 
-import argparse, datetime, os
+import argparse, datetime, os, re, shutil, tempfile, zipfile
 import ConfigParser
-from openpyxl import load_workbook
-import pymysql
-import packagelog
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import column_index_from_string, coordinate_from_string, get_column_letter
+import database, metrics, packagelog, report, sketches, statscache
 import asperastatscollector as aspera
+from report import stats_columns, pkgs_columns, add_pkgs_columns
 
 _cfg_reporting = 'reporting'
 _cfg_packagelog = 'packagelog'
 _cfg_statscollector = 'asperastatscollector'
 
-stats_columns = ['date',
-                 'completed_sessions',
-                 'completed_users',
-                 'completed_bytes',
-                 None,
-                 'cancelled_sessions',
-                 'cancelled_users',
-                 None,
-                 'error_sessions',
-                 'error_users']
-
-pkgs_columns = ['date',
-                'g1', 'g1_files',
-                'g5', 'g5_files',
-                'g20', 'g20_files',
-                'g20_avg',
-                'preproc', None,
-                'unproc', None]
-
-# Some of the packages worksheet values are retrieved from the
-# Aspera stats collector database. This is the map of aspera stats
-# keys to packages worksheet columns.
-_add_pkgs_columns = {
-    'preproc_completed':9,
-    'unproc_completed':11
-}
-
 def cell_from_last_row(worksheet, column):
     """Return the cell from the given column in the last row of the
     given worksheet."""
@@ -82,10 +58,225 @@ def append_row_named(worksheet, keys, valdict):
     set_row_named(worksheet, row, keys, valdict)
     return row
 
+def import_workbook(store, path, stats_name, pkgs_name):
+    """Copies the data rows (those with a date in the first column) of
+    the two worksheets into the store, reading the workbook in
+    read-only mode."""
+    wb = load_workbook(path, use_iterators=True)
+    days = {}
+    for i, (table, name, columns) in enumerate([('stats', stats_name, stats_columns),
+                                                ('packages', pkgs_name, pkgs_columns)]):
+        extra = add_pkgs_columns if 'packages' == table else {}
+        for r in wb.get_sheet_by_name(name).iter_rows():
+            cells = [c.internal_value for c in r]
+            if not cells or not isinstance(cells[0], datetime.datetime):
+                continue
+            cells += [None] * (len(columns) - len(cells))
+            values = dict((k, v) for k, v in zip(columns, cells) if k)
+            for k, col in extra.iteritems():
+                values[k] = cells[col] if col < len(cells) else None
+            for k, v in values.items():
+                if isinstance(v, float):
+                    values[k] = int(v)
+            values['date'] = cells[0].date()
+            days.setdefault(values['date'], [None, None])[i] = values
+    report.append_days(store, [days[d] for d in sorted(days) if None not in days[d]])
+
+def write_workbook(store, path, stats_name, pkgs_name):
+    """Writes a new workbook with the two worksheets generated from the
+    store, streaming rows through openpyxl's write-only mode. For when
+    there is no workbook yet; see append_workbook."""
+    wb = Workbook(optimized_write=True)
+    for table, name, columns in [('stats', stats_name, stats_columns),
+                                 ('packages', pkgs_name, pkgs_columns)]:
+        ws = wb.create_sheet(title=name)
+        header = [c for c in columns]
+        if 'packages' == table:
+            for k, col in add_pkgs_columns.iteritems():
+                header[col] = k
+        ws.append(header)
+        for values in report.iter_rows(store, table):
+            values['date'] = datetime.datetime.combine(values['date'], datetime.time())
+            ws.append(report.sheet_cells(table, values))
+            metrics.count('update.workbook')
+    tmp = path + '.tmp.xlsx'
+    wb.save(tmp)
+    os.rename(tmp, path)
+
+# New rows are appended to the worksheets without loading the workbook:
+# an xlsx file is a zip archive of XML parts, so the rows are spliced in
+# before the end of the two worksheet parts, and every other part is
+# copied as is. The cost is a streaming read of the two worksheets (for
+# their last rows) and a copy of the archive, which still grows with the
+# size of the file, but nothing is built in memory and the rest of the
+# workbook (other sheets, formatting, formulas) is left untouched. The
+# new cells take the styles of the last row's.
+_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_pkg_rel_ns = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+_sheet_data_end = re.compile(r'</(\w+:)?sheetData>')
+_dimension = re.compile(r'(<(?:\w+:)?dimension ref=")([A-Z]+\d+)(?::([A-Z]+)\d+)?(")')
+
+def _sheet_parts(zf):
+    """Returns a dict mapping worksheet names to their parts in the
+    archive, and the epoch of the workbook's date serial numbers."""
+    rels = {}
+    for rel in ElementTree.fromstring(zf.read('xl/_rels/workbook.xml.rels')):
+        target = rel.get('Target')
+        rels[rel.get('Id')] = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+    wb = ElementTree.fromstring(zf.read('xl/workbook.xml'))
+    pr = wb.find(_ns + 'workbookPr')
+    epoch = (datetime.date(1904, 1, 1) if pr is not None and pr.get('date1904') in ('1', 'true')
+             else datetime.date(1899, 12, 30))
+    return dict((sheet.get('name'), rels[sheet.get(_rel_ns + 'id')])
+                for sheet in wb.iter(_ns + 'sheet')), epoch
+
+def _last_row(zf, part):
+    """Returns the number of the last row with values in the worksheet
+    part, and a dict mapping its column letters to (style, type, value),
+    reading the worksheet as a stream."""
+    number, cells = 0, {}
+    for _, elem in ElementTree.iterparse(zf.open(part)):
+        if _ns + 'row' == elem.tag:
+            row = dict((coordinate_from_string(c.get('r'))[0],
+                        (c.get('s'), c.get('t'), c.findtext(_ns + 'v')))
+                       for c in elem.findall(_ns + 'c') if c.find(_ns + 'v') is not None)
+            if row:
+                number, cells = int(elem.get('r')), row
+            elem.clear()
+    return number, cells
+
+def _last_date(name, last, epoch, path):
+    style, kind, value = last[1].get('A', (None, 's', None))
+    if kind not in (None, 'n'):
+        raise Exception('no date in the last row of {} in {};\n'
+                        'manual intervention is required'.format(name, path))
+    return epoch + datetime.timedelta(days=int(float(value)))
+
+def _row_xml(number, cells, styles, epoch):
+    xml = ['<row r="{}">'.format(number)]
+    for i, v in enumerate(cells):
+        if v is None:
+            continue
+        col = get_column_letter(i + 1)
+        style = styles.get(col, (None,))[0]
+        attrs = ' r="{}{}"'.format(col, number) + (' s="{}"'.format(style) if style else '')
+        if isinstance(v, datetime.datetime):
+            v = v.date()
+        if isinstance(v, datetime.date):
+            xml.append('<c{}><v>{}</v></c>'.format(attrs, (v - epoch).days))
+        elif isinstance(v, basestring):
+            xml.append('<c{} t="inlineStr"><is><t>{}</t></is></c>'.format(attrs, escape(v)))
+        else:
+            xml.append('<c{}><v>{}</v></c>'.format(attrs, v))
+    xml.append('</row>')
+    return ''.join(xml)
+
+def _splice_rows(src, dst, rows, last_row, width):
+    """Copies the worksheet part from src to dst, with the row XML
+    strings added at the end of its sheetData and its dimension
+    extended to cover them."""
+    def dimension(m):
+        end = get_column_letter(max(width, column_index_from_string(m.group(3) or 'A')))
+        return '{}{}:{}{}{}'.format(m.group(1), m.group(2), end, last_row, m.group(4))
+    buf, head = '', True
+    while True:
+        chunk = src.read(1 << 16)
+        buf += chunk
+        if head and (_sheet_data_end.search(buf) or '<sheetData' in buf or not chunk):
+            buf = _dimension.sub(dimension, buf, count=1)
+            head = False
+        m = _sheet_data_end.search(buf)
+        if m:
+            dst.write(buf[:m.start()])
+            dst.write(''.join(rows))
+            dst.write(buf[m.start():])
+            break
+        elif not chunk:
+            raise Exception('worksheet part has no sheetData')
+        if not head:
+            dst.write(buf[:-32])
+            buf = buf[-32:]
+    for chunk in iter(lambda: src.read(1 << 16), ''):
+        dst.write(chunk)
+
+def append_workbook(store, path, stats_name, pkgs_name):
+    """Appends the rows in the store dated after the last row of the
+    two worksheets, leaving the rest of the workbook as it was (see
+    above). Raises an Exception if the last dates of the worksheets
+    differ. Returns the number of rows appended."""
+    with zipfile.ZipFile(path) as zin:
+        parts, epoch = _sheet_parts(zin)
+        sheets = [(table, name, parts[name], _last_row(zin, parts[name]))
+                  for table, name in [('stats', stats_name), ('packages', pkgs_name)]]
+        statsdate, pkgsdate = [_last_date(name, last, epoch, path) for _, name, _, last in sheets]
+        if statsdate != pkgsdate:
+            raise Exception(
+"""last date of {} ({}) != last date of {} ({}) in {};
+manual intervention is required
+""".format(stats_name, statsdate, pkgs_name, pkgsdate, path))
+        start = statsdate + datetime.timedelta(days=1)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            spliced, n = {}, 0
+            for table, name, part, (number, styles) in sheets:
+                rows = [report.sheet_cells(table, values) for values in report.iter_rows(store, table, start)]
+                if not rows:
+                    continue
+                n += len(rows)
+                spliced[part] = os.path.join(tmpdir, str(len(spliced)))
+                with zin.open(part) as src, open(spliced[part], 'wb') as dst:
+                    _splice_rows(src, dst, [_row_xml(number + 1 + i, cells, styles, epoch)
+                                            for i, cells in enumerate(rows)],
+                                 number + len(rows), max(len(cells) for cells in rows))
+            if n:
+                tmp = path + '.tmp.xlsx'
+                with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zout:
+                    for info in zin.infolist():
+                        if info.filename in spliced:
+                            zout.write(spliced[info.filename], info.filename)
+                        else:
+                            zout.writestr(info, zin.read(info.filename))
+                os.rename(tmp, path)
+        finally:
+            shutil.rmtree(tmpdir)
+    return n
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def get_optional(config, section, option, default=None):
+    """Returns the configured value, or default if it isn't set."""
+    if config.has_option(section, option):
+        return config.get(section, option)
+    else:
+        return default
+
 def main():
     argparser = argparse.ArgumentParser(description='Extract statistics from XNAT package request log and Aspera stats collector database into an Excel spreadsheet.')
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of processes for parsing package logs')
+    argparser.add_argument('--refresh-cache', action='store_true',
+                           help='discard cached package log stats')
+    argparser.add_argument('--store',
+                           help='daily stats store (SQLite); new rows are appended to the store, then to the spreadsheet')
+    argparser.add_argument('--stats-output', action='append', default=[],
+                           metavar='PATH',
+                           help='also write the new stats rows to PATH (.csv, .jsonl, or .db); may be repeated')
+    argparser.add_argument('--packages-output', action='append', default=[],
+                           metavar='PATH',
+                           help='also write the new packages rows to PATH (.csv, .jsonl, or .db); may be repeated')
+    argparser.add_argument('-q', '--quarantine', metavar='PATH',
+                           help='write unparseable package log lines to PATH and keep going, instead of stopping')
+    argparser.add_argument('--checkpoint', metavar='PATH',
+                           help='file recording the days completed by an unfinished run (default: the spreadsheet name plus .checkpoint)')
     argparser.add_argument('file', nargs=1)
+    metrics.add_arguments(argparser)
     args = argparser.parse_args()
+    metrics.instrument('update_dl_stats', args.profile, args.metrics)
     wb_file_name = args.file[0]
 
     config = ConfigParser.ConfigParser()
@@ -93,37 +284,107 @@ def main():
 
     logdir = config.get(_cfg_packagelog, 'logdir')
     logname = config.get(_cfg_packagelog, 'logname')
+    cachedir = get_optional(config, _cfg_packagelog, 'cachedir')
+    eventdir = get_optional(config, _cfg_packagelog, 'eventdir')
+    cachesize = get_optional(config, _cfg_packagelog, 'cache.maxsize')
+    if cachesize:
+        cachesize = int(cachesize)
+    precision = sketches.precision_from_config(config)
+    store_path = args.store or get_optional(config, _cfg_reporting, 'store')
+    quarantine_path = args.quarantine or get_optional(config, _cfg_packagelog, 'quarantine')
+    checkpoint_path = args.checkpoint or wb_file_name + '.checkpoint'
+    if cachedir and args.refresh_cache:
+        statscache.clear(cachedir)
 
     stats_name = config.get(_cfg_reporting, 'sheet.stats')
     pkgs_name = config.get(_cfg_reporting, 'sheet.packages')
 
-    wb = load_workbook(wb_file_name)
-    s_stats = wb.get_sheet_by_name(stats_name)
-    s_pkgs = wb.get_sheet_by_name(pkgs_name)
-
-    host = config.get(_cfg_statscollector, 'mysql.host')
-    port = int(config.get(_cfg_statscollector, 'mysql.port'))
-    user = config.get(_cfg_statscollector, 'mysql.user')
-    passwd = config.get(_cfg_statscollector, 'mysql.password')
-    db = pymysql.connect(host=host,port=port,user=user,passwd=passwd)
-
-    date = get_last_date(s_stats, s_pkgs, wb_file_name)
+    if store_path:
+        # the store is seeded from the spreadsheet the first time it's used
+        store = report.open_store(store_path)
+        date = report.last_date(store)
+        if date is None:
+            import_workbook(store, wb_file_name, stats_name, pkgs_name)
+            date = report.last_date(store)
+            if date is None:
+                raise Exception('no dated rows in {} and {} of {} to seed the store {};\n'
+                                'manual intervention is required'.format(
+                        stats_name, pkgs_name, wb_file_name, store_path))
+    else:
+        with metrics.timer('update.workbook_load'):
+            wb = load_workbook(wb_file_name)
+        s_stats = wb.get_sheet_by_name(stats_name)
+        s_pkgs = wb.get_sheet_by_name(pkgs_name)
+        date = get_last_date(s_stats, s_pkgs, wb_file_name)
 
     # add rows up to (but excluding) today
+    last = date
+    dates = []
     while True:
         date += datetime.timedelta(days=1)
         if date >= datetime.date.today():
             break
+        dates.append(date)
+
+    # Aspera stats for the whole window come from the daily rollup
+    if dates:
+        pool = database.pool_from_config(config, _cfg_statscollector)
+        try:
+            with metrics.timer('update.aspera'):
+                database.call(pool, aspera.refresh_rollup, precision)
+                allfilestats = database.call(pool, aspera.get_rollup_stats, dates[0],
+                                             dates[-1] + datetime.timedelta(days=1))
+        finally:
+            database.close_pool(pool)
+
+    # An interrupted run leaves a checkpoint of the package log stats for
+    # the days it completed, valid as long as the spreadsheet hasn't
+    # changed since.
+    checkpoint = packagelog.load_checkpoint(checkpoint_path)
+    if not checkpoint or checkpoint['last'] != last:
+        checkpoint = {'last': last, 'days': {}}
+    done = checkpoint['days']
+    todo = [d for d in dates if d not in done]
+
+    # package logs may be parsed in parallel, but come back in date order
+    with metrics.timer('update.packagelog'):
+        for pkgstats in packagelog.iter_stats(logdir, logname, todo, args.jobs,
+                                               cachedir=cachedir, cachesize=cachesize,
+                                               eventdir=eventdir, precision=precision,
+                                               quarantine_path=quarantine_path):
+            done[pkgstats['date']] = dict((k, pkgstats[k]) for k in pkgs_columns + ['logins'] if k)
+            packagelog.save_checkpoint(checkpoint_path, checkpoint)
+    metrics.count('update.packagelog', len(todo))
+    days = [(allfilestats[d], report.package_row(done[d], allfilestats[d])) for d in dates]
+
+    if days:
+        for path in args.stats_output:
+            report.write_rows(path, 'stats', [d[0] for d in days])
+        for path in args.packages_output:
+            report.write_rows(path, 'packages', [d[1] for d in days])
 
-        pkgstats = packagelog.get_stats(logdir, logname, date)
-        pkgrow = append_row_named(s_pkgs, pkgs_columns, pkgstats)
+    if store_path:
+        # the workbook catches up with the store, even if an earlier run
+        # stopped between the two
+        report.append_days(store, days)
+        with metrics.timer('update.workbook'):
+            if os.path.exists(wb_file_name):
+                metrics.count('update.workbook',
+                              append_workbook(store, wb_file_name, stats_name, pkgs_name))
+            else:
+                write_workbook(store, wb_file_name, stats_name, pkgs_name)
+        remove_checkpoint(checkpoint_path)
+        return
 
-        filestats = aspera.get_stats(db, date)
-        filesrow = append_row_named(s_stats, stats_columns, filestats)
-        
-        # Some of thep
-        for k,col in _add_pkgs_columns.iteritems():
+    metrics.count('update.workbook', 2*len(days))
+    for filestats, pkgvalues in days:
+        pkgrow = append_row_named(s_pkgs, pkgs_columns, pkgvalues)
+        append_row_named(s_stats, stats_columns, filestats)
+        # Some of the packages columns come from the Aspera stats
+        for k,col in add_pkgs_columns.iteritems():
             s_pkgs.cell(row=pkgrow,column=col).value=filestats[k]
 
     # write the modified spreadsheet file
-    wb.save(wb_file_name)
+    with metrics.timer('update.workbook'):
+        wb.save(wb_file_name)
+    remove_checkpoint(checkpoint_path)
@@ -21,7 +21,12 @@ setup(name='hcpdlstat',
       packages=['hcpdlstat'],
       entry_points = {
           'console_scripts':['geolocate=hcpdlstat.geolocate:main',
-                             'update_dl_stats=hcpdlstat.update:main']
+                             'update_dl_stats=hcpdlstat.update:main',
+                             'benchmark_dl_stats=hcpdlstat.benchmark:main',
+                             'query_dl_events=hcpdlstat.eventstore:main',
+                             'reconcile_dl_stats=hcpdlstat.reconcile:main',
+                             'dl_stats_daemon=hcpdlstat.daemon:main',
+                             'query_dl_stats=hcpdlstat.query:main']
         },
       install_requires=[
         'openpyxl',